@@ -2,22 +2,140 @@
 
 # This script converts an mkv 3D movie given in the MVC format into the SBS format
 
-base_dir=/home/hauke/Master/MasterThesis/data/3dmovies/  #$1   # Basedir containing the expected folders (mvc_videos, sbs_videos, sbs_frames)
+# a failing decoder fails the conversion, even if the consumer of its output exits successfully
+set -o pipefail
+script_dir=$(cd "$(dirname "$0")" && pwd)
+
 video_name=$1   # The name of the movie (without the .mkv extension)
+base_dir=${2:-${SBS_BASE_DIR}}   # Basedir containing the expected folders (mvc_videos, sbs_videos, sbs_frames)
+FRIMDecode=${3:-${FRIMDECODE}}  # Path to the binary of FRIMDecode
+# x264: encode the sbs video (lossy, as in the paper)
+# raw: no sbs video, the frames and scene cuts are extracted directly from the decoder output (helper/extract_stream.py,
+#      run run_extractFrames.sh with the source raw afterwards)
+# ffv1 / lossless: as raw and additionally keep a lossless sbs video (ffv1 or x264 -preset ultrafast -qp 0)
+mode=${4:-x264}
+# number of chapter segments converted concurrently (1: the whole movie in one pass)
+num_jobs=${5:-1}
+
+if [ -z "${video_name}" ] || [ -z "${base_dir}" ]; then
+	echo "Usage: $0 video_name base_dir [FRIMDecode] [x264|raw|ffv1|lossless] [jobs]"
+	exit 1
+fi
+if [ -z "${SBS_DECODER}" ] && [ -z "${FRIMDecode}" ]; then
+	echo "The path to FRIMDecode needs to be given as 3rd argument (or FRIMDECODE)"
+	exit 1
+fi
+base_dir="${base_dir%/}/"
 
 input="${base_dir}mvc_videos/${video_name}.mkv"
 outputTitle="${video_name}_SBS"
 outputFolder="${base_dir}sbs_videos/${outputTitle}/"
-FRIMDecode="/home/hauke/Master/MasterThesis/depth_data_3DMovie/FRIM_x86_version_1.31/FRIMDecode32"  # Path to the binary of FRIMDecode
+segmentFolder="${outputFolder}segments/"
+# any command writing the raw sbs frames (3840x1080 yuv420p) to stdout can be used as decoder (SBS_DECODER),
+# it is run with SEGMENT_INPUT (the mvc track), SEGMENT_START_FRAME and SEGMENT_END_FRAME (frames of the movie) set
+decoder=${SBS_DECODER:-'wine "${FRIMDecode}" -i:mvc "${SEGMENT_INPUT}" -o - -sbs'}
+
+keep=""
+if [ "${mode}" != "x264" ] && [ "${mode}" != "raw" ]; then
+	keep="--keep ${mode}"
+fi
+
+decode() {
+	eval "${decoder}"
+}
+
+# encode or extract the decoded frames into the folder $1 (the final locations if not set)
+convert() {
+	if [ "${mode}" = "x264" ]; then
+		decode | ffmpeg -y -f rawvideo -s:v 3840x1080 -r 24000/1001 -i - -c:v libx264 ${1:-${outputFolder}}${outputTitle}.mkv
+	elif [ -z "$1" ]; then
+		decode | python ${script_dir}/helper/extract_stream.py --baseDir ${base_dir} --name ${outputTitle} ${keep}
+	else
+		decode | python ${script_dir}/helper/extract_stream.py --baseDir ${base_dir} --name ${outputTitle} ${keep} --segment $1
+	fi
+}
+
+# decode the segment $1 (frames $2 to $3) of the movie into its folder
+convert_segment() {
+	local name=$(printf "%03d" $1)
+	local dir="${segmentFolder}${name}/"
+	mkdir -p ${dir}
+	SEGMENT_INPUT="${segmentFolder}segment-${name}.264"
+	SEGMENT_START_FRAME=$2
+	SEGMENT_END_FRAME=$3
+
+	if [ -z "${SBS_DECODER}" ]; then
+		mkvextract tracks ${segmentFolder}segment-${name}.mkv 0:${SEGMENT_INPUT} || return 1
+		rm ${segmentFolder}segment-${name}.mkv
+	fi
+	convert ${dir} > ${dir}log.txt 2>&1 && touch ${dir}done
+	rm -f ${SEGMENT_INPUT}
+}
+
+# concatenate the videos of the segments (without re-encoding)
+concat_segments() {
+	for dir in ${segmentFolder}[0-9]*/; do
+		echo "file '${dir}${outputTitle}.mkv'"
+	done > ${segmentFolder}concat.txt
+	ffmpeg -y -loglevel error -f concat -safe 0 -i ${segmentFolder}concat.txt -c copy ${outputFolder}${outputTitle}.mkv
+}
 
 echo "Converting ${input} to SBS format."
 
 mkdir -p ${outputFolder}
 
-ffmpeg -i ${input} 2>&1 | grep Chapter | grep start | awk '{print $4 $6}' >> ${outputFolder}chapters.txt
+if [ -f ${input} ]; then
+	ffmpeg -i ${input} 2>&1 | grep Chapter | grep start | awk '{print $4 $6}' > ${outputFolder}chapters.txt
+fi
+
+if [ "${num_jobs}" -le 1 ]; then
+	if [ -z "${SBS_DECODER}" ]; then
+		mkvextract tracks ${input} 0:${input}.264
+	fi
+	SEGMENT_INPUT="${input}.264"
+	SEGMENT_START_FRAME=0
+	SEGMENT_END_FRAME=""
+	convert
+	status=$?
+	rm -f ${input}.264
+	exit ${status}
+fi
+
+# split the movie into segments at the first keyframe of every chapter and convert up to num_jobs segments concurrently
+rm -rf ${segmentFolder}
+mkdir -p ${segmentFolder}
+packets=""
+if [ -f ${input} ]; then
+	ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags -of csv=p=0 ${input} > ${segmentFolder}packets.csv
+	packets="--packets ${segmentFolder}packets.csv"
+fi
+python ${script_dir}/helper/chapter_segments.py --chapters ${outputFolder}chapters.txt ${packets} > ${segmentFolder}segments.txt || exit 1
+echo "$(wc -l < ${segmentFolder}segments.txt) segments, ${num_jobs} jobs"
+
+if [ -z "${SBS_DECODER}" ]; then
+	parts=$(awk '{printf "%s%s-%s", (NR > 1 ? "," : ""), $4, $5}' ${segmentFolder}segments.txt)
+	mkvmerge -q -o ${segmentFolder}segment.mkv --split parts:${parts} ${input} || exit 1
+fi
 
-mkvextract tracks ${input} 0:${input}.264
+while read index first end start_time end_time; do
+	while [ $(jobs -rp | wc -l) -ge ${num_jobs} ]; do
+		wait -n
+	done
+	convert_segment ${index} ${first} ${end} &
+done < ${segmentFolder}segments.txt
+wait
 
-wine ${FRIMDecode} -i:mvc ${input}.264 -o - -sbs | ffmpeg -y -f rawvideo -s:v 3840x1080 -r 24000/1001 -i - -c:v libx264 ${outputFolder}${outputTitle}.mkv
+while read index rest; do
+	if [ ! -f ${segmentFolder}$(printf "%03d" ${index})/done ]; then
+		echo "Conversion of segment ${index} failed (see ${segmentFolder}$(printf "%03d" ${index})/log.txt)"
+		exit 1
+	fi
+done < ${segmentFolder}segments.txt
 
-rm ${input}.264
+if [ "${mode}" != "x264" ]; then
+	python ${script_dir}/helper/extract_stream.py --baseDir ${base_dir} --name ${outputTitle} --merge ${segmentFolder} || exit 1
+fi
+if [ "${mode}" != "raw" ]; then
+	concat_segments || exit 1
+fi
+rm -rf ${segmentFolder}
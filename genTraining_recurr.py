@@ -4,7 +4,6 @@ import argparse
 import glob
 import os
 import math
-import cv2
 from random import shuffle
 from shutil import copyfile
 
@@ -40,8 +39,6 @@ parser.add_argument(
     default="-1",
 )
 
-args = parser.parse_args()
-
 
 def processChapter_cutlist(
     video,
@@ -52,13 +49,14 @@ def processChapter_cutlist(
     cutList,
     numRecurrent,
     fpsRecurrent,
+    fpsSingle,
 ):
     videoNameSplit = video.split("/")
     videoName = videoNameSplit[-2]
 
     imgPathRel = videoName + "/chapter" + str(chap) + "/"
 
-    modFrameFactorSingle = int(round(origFramerate / args.fpsSingle))
+    modFrameFactorSingle = int(round(origFramerate / fpsSingle))
 
     stepRecurrent = int(round(origFramerate / fpsRecurrent))
     numRecurrent = (
@@ -130,7 +128,34 @@ def processChapter_cutlist(
                         ofp_single.write(imgPathRel + imgFilename[ri] + "\n")
 
 
-def main():
+def process_video(args, video, origFramerate, outputFileSingle):
+    cutList = processShotFile(video, "shots.txt")
+    # print(len(cutList))
+    timingList = []
+    with open(video + args.chapterTiming, "r") as fp:
+        timingListTmp = fp.read().splitlines()
+        for timingLine in timingListTmp:
+            timingList.append([float(x) for x in timingLine.split(",")])
+
+    chapterList = glob.glob(video + "log*.txt")
+    numChapters = len(chapterList)
+    validChapters = range(2, numChapters)
+    trainingSet = validChapters
+    for chap in trainingSet:
+        processChapter_cutlist(
+            video,
+            chap,
+            origFramerate,
+            timingList[chap - 1],
+            outputFileSingle,
+            cutList,
+            args.numRecurrent,
+            args.fpsRecurrent,
+            args.fpsSingle,
+        )
+
+
+def main(args):
     path = os.path.join(args.baseDir, "sbs_frames/image_meta/")
     videoList = glob.glob(path + "*/")
     origFramerate = 24
@@ -158,29 +183,11 @@ def main():
             continue
         print("processing " + videoName)
         print("")
-        cutList = processShotFile(video, "shots.txt")
-        # print(len(cutList))
-        timingList = []
-        with open(video + args.chapterTiming, "r") as fp:
-            timingListTmp = fp.read().splitlines()
-            for timingLine in timingListTmp:
-                timingList.append([float(x) for x in timingLine.split(",")])
-
-        chapterList = glob.glob(video + "log*.txt")
-        numChapters = len(chapterList)
-        validChapters = range(2, numChapters)
-        trainingSet = validChapters
-        for chap in trainingSet:
-            processChapter_cutlist(
-                video,
-                chap,
-                origFramerate,
-                timingList[chap - 1],
-                trainingSingleFile,
-                cutList,
-                args.numRecurrent,
-                args.fpsRecurrent,
-            )
-
-
-main()
+        process_video(args, video, origFramerate, trainingSingleFile)
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,13 +1,15 @@
 import argparse
 import glob
 import os
-import shutil
 import json
+from joblib import Parallel, delayed
 
-from helper.helpers import createDir
+from helper.manifest import scene_dict_to_manifest, save_manifest
+from helper.helpers import createDir, silentremove, materialize, fingerprint_files, read_jsonl, append_jsonl
+from helper.metrics import get_metrics, timed_call
 
 
-def create_scene_folder_structure(baseDir, videoName, chapterSceneFrames):
+def create_scene_folder_structure(baseDir, videoName, chapterSceneFrames, mode="copy"):
     for chapter, sceneFrames in chapterSceneFrames.items():
         inPath = baseDir
         outPath = os.path.join(
@@ -24,7 +26,71 @@ def create_scene_folder_structure(baseDir, videoName, chapterSceneFrames):
                 split = frame.split("/")[-1].split(".")[0][3:]
                 outImage = os.path.join(
                     out, "out{}.jpg".format(str(split)))
-                shutil.copy(inImage, outImage)
+                materialize(inImage, outImage, mode)
+
+
+def process_video(args, video, oriFrameRate, frameSampleFactor):
+    """Subsample the scenes of a single video
+
+    Returns the filtered frames sorted with respect to their chapter and scene
+    and the list of all selected frames in the order they are written to the
+    txt file.
+    """
+    videoNameSplit = video.split("/")
+    videoName = videoNameSplit[-2]
+    print("processing " + videoName)
+    print("")
+
+    selectedFrames = []
+
+    # open json file containing the grouping of each frame to their scene
+    pathChapterSceneFramesRaw = os.path.join(
+        video, "sceneFramesRaw.json")
+    chapterSceneFramesFiltered = {}
+    with open(pathChapterSceneFramesRaw, "r") as fp:
+        chapterSceneFrames = json.load(fp)
+
+    for chap, sequenceDict in chapterSceneFrames.items():
+        temp = {}
+        for sequence, frames in sequenceDict.items():
+            frames = frames[1:-1] # remove first and last frame to remove frames at scene cuts
+            numFrames = len(frames)
+
+            # ignore scenes that are to short (shorter then .5s)
+            if numFrames <= oriFrameRate / 2:
+                continue
+
+            filteredFrames = []
+            for i, frame in enumerate(frames):
+                if i % frameSampleFactor == 0:
+                    filteredFrames.append(frame)
+
+            numFramesFiltered = len(filteredFrames)
+            short = False if numFramesFiltered >= 10 else True
+            if not short:
+                sectionLength = int(
+                    numFramesFiltered * args.sceneCoverage / 3.0)
+                front = filteredFrames[0:sectionLength]
+                middle = filteredFrames[2*sectionLength:3*sectionLength]
+                back = filteredFrames[-sectionLength:]
+                temp[sequence] = front + middle + back
+            else:
+                if numFramesFiltered <= 3:
+                    temp[sequence] = filteredFrames
+                elif 4 <= numFramesFiltered <= 5:
+                    temp[sequence] = [
+                        filteredFrames[0], filteredFrames[-1]]
+                else:
+                    temp[sequence] = filteredFrames[0:2] + \
+                        filteredFrames[-2:]
+
+            selectedFrames += temp[sequence]
+
+        chapterSceneFramesFiltered[chap] = temp
+
+    #create_scene_folder_structure(args.baseDir, videoName, chapterSceneFramesFiltered)
+
+    return videoName, chapterSceneFramesFiltered, selectedFrames
 
 
 def run(args):
@@ -45,77 +111,95 @@ def run(args):
                                     )
 
     frameSampleFactor = int(round(oriFrameRate / args.sampleFPS))
-    
+
+    # every video gets its own fragment (stored in the meta folder of the video).
+    # The index lists the videos in the order they were added to the data set,
+    # so the merged files keep the order (and therefore the image numbering)
+    # of videos already in the set
+    fragmentName = args.name + \
+        "_sampleFPS_{}".format(args.sampleFPS) + "_fragment.json"
+    indexFile = os.path.join(path,
+                             args.name +
+                             "_sampleFPS_{}".format(args.sampleFPS) + "_index.jsonl")
+    if args.rebuild:
+        silentremove(indexFile)
+
+    order = []
+    for record in read_jsonl(indexFile):
+        if record["video"] not in order:
+            order.append(record["video"])
+
+    params = "sampleFPS={} sceneCoverage={}".format(
+        args.sampleFPS, args.sceneCoverage)
+
+    selectedVideos = []
+    todo = []
+    fingerprints = {}
+    for video in videoList:
+        videoNameSplit = video.split("/")
+        videoName = videoNameSplit[-2]
+        if videoName in args.blacklist:
+            print(videoName + " on blacklist")
+            continue
+        selectedVideos.append(videoName)
+
+        fingerprint = fingerprint_files(
+            [os.path.join(video, "sceneFramesRaw.json")], videoName + " " + params)
+        fingerprints[videoName] = fingerprint
+
+        fragmentFile = os.path.join(video, fragmentName)
+        if not args.rebuild and os.path.exists(fragmentFile):
+            with open(fragmentFile, "r") as fp:
+                if json.load(fp)["fingerprint"] == fingerprint:
+                    print(videoName + " is up to date")
+                    continue
+        todo.append(video)
+
+    # the videos are independent of each other -> process them in parallel
+    metrics = get_metrics("dataset", workers=args.jobs, script="gen_data_set")
+    results = Parallel(n_jobs=args.jobs)(
+        delayed(timed_call)(process_video, args, video, oriFrameRate, frameSampleFactor)
+        for video in todo)
+
+    for (videoName, chapterSceneFramesFiltered, selectedFrames), seconds in results:
+        metrics.add(frames=len(selectedFrames), busy=seconds)
+        fragment = {"fingerprint": fingerprints[videoName],
+                    "scenes": chapterSceneFramesFiltered,
+                    "frames": selectedFrames}
+        with open(os.path.join(path, videoName, fragmentName), "w+") as fp:
+            json.dump(fragment, fp)
+
+    for videoName in selectedVideos:
+        if videoName not in order:
+            append_jsonl(indexFile, {"video": videoName})
+            order.append(videoName)
+
+    # merge the fragments of all selected videos
+
     # dictionary containing all videos with all filtered
     # frames sorted with respect to their chapter and scene
-    trainSetDict = {}   
+    trainSetDict = {}
 
     with open(trainSetTXTName, "w+") as logFile:
-        # iterate over all the videos
-        for video in videoList:
-            videoNameSplit = video.split("/")
-            videoName = videoNameSplit[-2]
-            if videoName in args.blacklist:
-                print(videoName + " on blacklist")
+        for videoName in order:
+            if videoName not in selectedVideos:
                 continue
-            print("processing " + videoName)
-            print("")
-
-            # open json file containing the grouping of each frame to their scene
-            pathChapterSceneFramesRaw = os.path.join(
-                video, "sceneFramesRaw.json")
-            chapterSceneFramesFiltered = {}
-            with open(pathChapterSceneFramesRaw, "r") as fp:
-                chapterSceneFrames = json.load(fp)
-
-            for chap, sequenceDict in chapterSceneFrames.items():
-                temp = {}
-                for sequence, frames in sequenceDict.items():
-                    frames = frames[1:-1] # remove first and last frame to remove frames at scene cuts
-                    numFrames = len(frames)
-
-                    # ignore scenes that are to short (shorter then .5s)
-                    if numFrames <= oriFrameRate / 2:
-                        continue
-
-                    filteredFrames = []
-                    for i, frame in enumerate(frames):
-                        if i % frameSampleFactor == 0:
-                            filteredFrames.append(frame)
-
-                    numFramesFiltered = len(filteredFrames)
-                    short = False if numFramesFiltered >= 10 else True
-                    if not short:
-                        sectionLength = int(
-                            numFramesFiltered * args.sceneCoverage / 3.0)
-                        front = filteredFrames[0:sectionLength]
-                        middle = filteredFrames[2*sectionLength:3*sectionLength]
-                        back = filteredFrames[-sectionLength:]
-                        temp[sequence] = front + middle + back
-
-                        for f in temp[sequence]:
-                            logFile.write(f + "\n")
-                    else:
-                        if numFramesFiltered <= 3:
-                            temp[sequence] = filteredFrames
-                        elif 4 <= numFramesFiltered <= 5:
-                            temp[sequence] = [
-                                filteredFrames[0], filteredFrames[-1]]
-                        else:
-                            temp[sequence] = filteredFrames[0:2] + \
-                                filteredFrames[-2:]
-
-                        for f in temp[sequence]:
-                            logFile.write(f + "\n")
-
-                chapterSceneFramesFiltered[chap] = temp
-
-            trainSetDict[videoName] = chapterSceneFramesFiltered
-
-            with open(trainSetJsonName, "w+") as fp:
-                json.dump(trainSetDict, fp, indent=True)
-
-            #create_scene_folder_structure(args.baseDir, videoName, chapterSceneFramesFiltered)
+
+            with open(os.path.join(path, videoName, fragmentName), "r") as fp:
+                fragment = json.load(fp)
+
+            for f in fragment["frames"]:
+                logFile.write(f + "\n")
+
+            trainSetDict[videoName] = fragment["scenes"]
+
+    with open(trainSetJsonName, "w+") as fp:
+        json.dump(trainSetDict, fp, indent=True)
+
+    # compact binary version of the data set (see helper/manifest.py)
+    records, strings = scene_dict_to_manifest(trainSetDict)
+    save_manifest(os.path.splitext(trainSetJsonName)[0] + ".manifest", records, strings)
+    metrics.close()
 
 
 if __name__ == "__main__":
@@ -144,7 +228,11 @@ if __name__ == "__main__":
         help="specifies list of selected videos, if not set all videos are selected",
         default="-1",
     )
+    parser.add_argument("--jobs", type=int,
+                        help="number of videos to process in parallel", default=1)
+    parser.add_argument("--rebuild", action="store_true",
+                        help="ignore the fragments of previous runs and process all videos again")
 
     args = parser.parse_args()
 
-run(args)
+    run(args)
@@ -8,11 +8,13 @@ import glob
 import os
 import errno
 import math
-import cv2
 from random import shuffle
 from shutil import copyfile
+from joblib import Parallel, delayed
 
-from helper.helpers import silentremove, processShotFile
+from helper.manifest import MANIFEST_DTYPE, save_manifest
+from helper.helpers import silentremove, processShotFile, fingerprint_files, read_jsonl, append_jsonl
+from helper.metrics import get_metrics, timed_call
 
 parser = argparse.ArgumentParser(
     description="create training/test/validation sets from video list"
@@ -38,6 +40,9 @@ parser.add_argument(
     help="specifies list of selected videos, if not set all videos are selected",
     default="-1",
 )
+parser.add_argument("--jobs", type=int, help="number of videos to process in parallel", default=1)
+parser.add_argument("--rebuild", action="store_true",
+                    help="ignore the fragments of previous runs and renumber all videos from zero")
 
 
 def processChapter_cutlist(
@@ -45,13 +50,18 @@ def processChapter_cutlist(
     chap,
     origFramerate,
     timing,
-    outputFileSingle,
     cutList,
     fps,
     minFrames,
     saved_frames,
     saved_sequences
 ):
+    """Collect the sequences of a single chapter
+
+    Returns the rows (chapter, frame path, sequence index, frame index) of the
+    chapter together with the number of added frames and sequences. The indices
+    start at saved_frames and saved_sequences respectively.
+    """
     videoName = video.split("/")[-2]
 
     imgPathRel = videoName + "/chapter" + str(chap) + "/"
@@ -64,69 +74,130 @@ def processChapter_cutlist(
     num_sequences_in_chap = 0
     added_sequences = 0
 
+    rows = []
+
     logFilename = video + "log" + str(chap) + ".txt"
     with open(logFilename, "r") as fp:
-        with open(outputFileSingle, "a") as ofp_single:
-            prevIdx = -1
-            # iterate over log list
-            for cnt, line in enumerate(fp):
+        prevIdx = -1
+        # iterate over log list
+        for cnt, line in enumerate(fp):
+
+            idx = line.find("pts_time:")
+            if idx == -1:
+                continue
+
+            pts_time = float(line[idx + 9: idx + 9 + 7])
+            idx2 = line.find("n:")
+            frame_idx = int(line[idx2 + 2: idx2 + 2 + 5]) + 1
+            # use floor here to be on the save side
+            if pts_time <= timing[0] or pts_time > math.floor(timing[1]):
+                continue
+            # ignore if at cut position
+            if pts_time in cutList:
+                continue
+            # sequence already processed
+            if frame_idx < prevIdx:
+                continue
+
+            largerElemCutList = [
+                x for x in cutList if x > pts_time and x < timing[1]
+            ]
+            largerElemCutList.append(timing[1])
+            cutTimeNext = min(largerElemCutList)
+            smallerElemCutList = [
+                x for x in cutList if x < pts_time and x > timing[0]
+            ]
+            smallerElemCutList.append(timing[0])
+
+            seqLength = (cutTimeNext - pts_time) * origFramerate
+
+            # for long sequences jump to some point later in the same sequence
+            jump = int(seqLength)
+            prevIdx = frame_idx + int(jump)
+
+            # ignore if sequence to short
+            if seqLength < minSequenceLength:
+                num_sequences_in_chap += 1
+                continue
 
-                idx = line.find("pts_time:")
-                if idx == -1:
-                    continue
+            imgFilename = {}
 
-                pts_time = float(line[idx + 9: idx + 9 + 7])
-                idx2 = line.find("n:")
-                frame_idx = int(line[idx2 + 2: idx2 + 2 + 5]) + 1
-                # use floor here to be on the save side
-                if pts_time <= timing[0] or pts_time > math.floor(timing[1]):
-                    continue
-                # ignore if at cut position
-                if pts_time in cutList:
-                    continue
-                # sequence already processed
-                if frame_idx < prevIdx:
-                    continue
+            for ri in range(0, int(seqLength)):
+                frame_str = "out" + str(frame_idx + ri + 1).zfill(8)
 
-                largerElemCutList = [
-                    x for x in cutList if x > pts_time and x < timing[1]
-                ]
-                largerElemCutList.append(timing[1])
-                cutTimeNext = min(largerElemCutList)
-                smallerElemCutList = [
-                    x for x in cutList if x < pts_time and x > timing[0]
-                ]
-                smallerElemCutList.append(timing[0])
-
-                seqLength = (cutTimeNext - pts_time) * origFramerate
-
-                # for long sequences jump to some point later in the same sequence
-                jump = int(seqLength)
-                prevIdx = frame_idx + int(jump)
-
-                # ignore if sequence to short
-                if seqLength < minSequenceLength:
-                    num_sequences_in_chap += 1
+                if ri % modFrameFactor != 0:
                     continue
 
-                imgFilename = {}
+                rows.append((chap, imgPathRel + frame_str,
+                             saved_sequences + added_sequences, saved_frames + added_frames))
 
-                for ri in range(0, int(seqLength)):
-                    frame_str = "out" + str(frame_idx + ri + 1).zfill(8)
-                    frame_out_name = "out" + str(saved_frames + added_frames).zfill(8)
-                    sequence_name = "seq" + str(saved_sequences + added_sequences).zfill(8)
+                added_frames += 1
 
-                    if ri % modFrameFactor != 0:
-                        continue
+            added_sequences += 1
+            num_sequences_in_chap += 1
 
-                    ofp_single.write(videoName + "," + str(chap) + "," + imgPathRel + frame_str + "," + sequence_name + "," + frame_out_name + "\n")
+    return rows, added_frames, added_sequences
 
-                    added_frames += 1
 
-                added_sequences += 1
-                num_sequences_in_chap += 1
+def process_video(args, video, origFramerate):
+    """Collect the sequences of all valid chapters of a single video
+
+    The sequence and frame indices of the returned rows are relative to the
+    video. The global offsets are assigned when merging all videos.
+    """
+    videoName = video.split("/")[-2]
+
+    print("Processing video: " + videoName)
+    print("")
+
+    cutList = processShotFile(video, "shots.txt")
+    timingList = []
+    with open(video + args.chapterTiming, "r") as fp:
+        timingListTmp = fp.read().splitlines()
+        for timingLine in timingListTmp:
+            timingList.append([float(x) for x in timingLine.split(",")])
+
+    chapterList = glob.glob(video + "log*.txt")
+    numChapters = len(chapterList)
+    validChapters = range(2, numChapters)
+    trainingSet = validChapters
+
+    rows = []
+    saved_frames = 0
+    saved_sequences = 0
+
+    for chap in trainingSet:
+        chap_rows, num_added_frames, num_added_sequences = processChapter_cutlist(
+            video,
+            chap,
+            origFramerate,
+            timingList[chap - 1],
+            cutList,
+            args.fps,
+            args.min_frames,
+            saved_frames,
+            saved_sequences
+        )
+
+        rows += chap_rows
+        saved_frames += num_added_frames
+        saved_sequences += num_added_sequences
+
+    return videoName, rows, saved_frames, saved_sequences
 
-    return added_frames, added_sequences
+
+def allocate_offsets(previous, num_frames, num_sequences, next_frame, next_sequence):
+    """Get the frame and sequence offsets of a video
+
+    A video that is already part of the data set keeps its offsets as long as its
+    frames and sequences still fit into the reserved range. Otherwise (and for
+    new videos) the range is appended at the end of the data set.
+    """
+    if previous is not None and num_frames <= previous["num_frames"] \
+            and num_sequences <= previous["num_sequences"]:
+        return previous["frame_offset"], previous["sequence_offset"]
+
+    return next_frame, next_sequence
 
 
 def run(args):
@@ -137,11 +208,29 @@ def run(args):
 
     trainingSingleFile = os.path.join(path, args.name + f"_{args.fps}fps" + ".csv")
 
-    silentremove(trainingSingleFile)
-
-    saved_frames = 0
-    saved_sequences = 0
-
+    # every video gets its own fragment with video relative indices (stored in
+    # the meta folder of the video). The index records the offsets of each video,
+    # so the ids of videos already in the data set stay the same when new videos
+    # are added
+    fragmentName = args.name + f"_{args.fps}fps" + ".csv"
+    indexFile = os.path.join(path, args.name + f"_{args.fps}fps" + "_index.jsonl")
+    if args.rebuild:
+        silentremove(indexFile)
+
+    # the last record of a video is the valid one
+    index = {}
+    next_frame = 0
+    next_sequence = 0
+    for record in read_jsonl(indexFile):
+        index[record["video"]] = record
+        next_frame = max(next_frame, record["frame_offset"] + record["num_frames"])
+        next_sequence = max(next_sequence, record["sequence_offset"] + record["num_sequences"])
+
+    params = f"fps={args.fps} min_frames={args.min_frames} chapterTiming={args.chapterTiming}"
+
+    selectedVideos = []
+    todo = []
+    fingerprints = {}
     for video in videoList:
 
         videoName = video.split("/")[-2]
@@ -153,37 +242,75 @@ def run(args):
             print(videoName + " not on whitelist")
             continue
 
-        print("Processing video: " + videoName)
-        print("")
-
-        cutList = processShotFile(video, "shots.txt")
-        timingList = []
-        with open(video + args.chapterTiming, "r") as fp:
-            timingListTmp = fp.read().splitlines()
-            for timingLine in timingListTmp:
-                timingList.append([float(x) for x in timingLine.split(",")])
-
-        chapterList = glob.glob(video + "log*.txt")
-        numChapters = len(chapterList)
-        validChapters = range(2, numChapters)
-        trainingSet = validChapters
-
-        for chap in trainingSet:
-            num_added_frames, num_added_sequences = processChapter_cutlist(
-                video,
-                chap,
-                origFramerate,
-                timingList[chap - 1],
-                trainingSingleFile,
-                cutList,
-                args.fps,
-                args.min_frames,
-                saved_frames,
-                saved_sequences
-            )
-
-            saved_frames += num_added_frames
-            saved_sequences += num_added_sequences
+        selectedVideos.append(videoName)
+
+        fingerprint = fingerprint_files(
+            glob.glob(video + "log*.txt") + [video + "shots.txt", video + args.chapterTiming], videoName + " " + params)
+        fingerprints[videoName] = fingerprint
+
+        if videoName in index and index[videoName]["fingerprint"] == fingerprint \
+                and os.path.exists(os.path.join(path, videoName, fragmentName)):
+            print(videoName + " is up to date")
+            continue
+
+        todo.append(video)
+
+    # the videos are processed independently -> first count the frames and
+    # sequences of every video and then assign the offsets in the order of the
+    # video list. This keeps the numbering identical to a serial run.
+    metrics = get_metrics("dataset", workers=args.jobs, script="gen_sequence_training_data")
+    results = Parallel(n_jobs=args.jobs)(
+        delayed(timed_call)(process_video, args, video, origFramerate) for video in todo)
+
+    for (videoName, rows, num_frames, num_sequences), seconds in results:
+        metrics.add(frames=num_frames, busy=seconds)
+
+        with open(os.path.join(path, videoName, fragmentName), "w") as ofp:
+            for chap, frame_path, seq_idx, frame_idx in rows:
+                ofp.write(str(chap) + "," + frame_path + "," + str(seq_idx) + "," + str(frame_idx) + "\n")
+
+        frame_offset, sequence_offset = allocate_offsets(
+            index.get(videoName), num_frames, num_sequences, next_frame, next_sequence)
+        next_frame = max(next_frame, frame_offset + num_frames)
+        next_sequence = max(next_sequence, sequence_offset + num_sequences)
+
+        index[videoName] = {
+            "video": videoName,
+            "fingerprint": fingerprints[videoName],
+            "frame_offset": frame_offset,
+            "sequence_offset": sequence_offset,
+            "num_frames": num_frames,
+            "num_sequences": num_sequences
+        }
+        append_jsonl(indexFile, index[videoName])
+
+    # merge the fragments of all selected videos ordered by their ids
+    silentremove(trainingSingleFile)
+
+    merge_order = sorted(selectedVideos, key=lambda name: index[name]["frame_offset"])
+
+    # columns of the compact binary version of the data set (see helper/manifest.py)
+    manifest_columns = []
+
+    with open(trainingSingleFile, "a") as ofp_single:
+        for video_id, videoName in enumerate(merge_order):
+            saved_frames = index[videoName]["frame_offset"]
+            saved_sequences = index[videoName]["sequence_offset"]
+
+            with open(os.path.join(path, videoName, fragmentName), "r") as fp:
+                for line in fp:
+                    chap, frame_path, seq_idx, frame_idx = line.rstrip("\n").split(",")
+                    sequence_name = "seq" + str(saved_sequences + int(seq_idx)).zfill(8)
+                    frame_out_name = "out" + str(saved_frames + int(frame_idx)).zfill(8)
+                    ofp_single.write(videoName + "," + chap + "," + frame_path + "," + sequence_name + "," + frame_out_name + "\n")
+
+                    manifest_columns.append((video_id, int(chap), -1, saved_sequences + int(seq_idx),
+                                             int(frame_path[-8:]), saved_frames + int(frame_idx)))
+
+    save_manifest(os.path.splitext(trainingSingleFile)[0] + ".manifest",
+                  np.array(manifest_columns, dtype=MANIFEST_DTYPE),
+                  {"videos": merge_order, "prefix": "", "suffix": ""})
+    metrics.close()
 
 
 if __name__ == '__main__':
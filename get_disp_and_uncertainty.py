@@ -1,31 +1,48 @@
 #!/usr/bin/env python
 """
     Generate disparity and uncertainty maps for given list.
-    Assumumption: (full-resolution; i.e. 1880x800) forward / backward flow is located
+    Assumumption: (full-resolution; e.g. 1880x800) forward / backward flow is located
     in the folders flow_forward and flow_backward.
+
+    The computation is also available without reading/writing files:
+    compute_disp_and_uncertainty (single frame) and compute_disp_and_uncertainty_batch.
+    Statistics of the disparity and uncertainty are written to meta/disp_stats.json.
 """
 import os
+import sys
+import time
 import argparse
 import numpy as np
 import cv2
 from PIL import PngImagePlugin
 from PIL import Image
 import imageio
-import glob
 from tqdm import tqdm
 from joblib import Parallel, delayed
 import multiprocessing
 
+from helper.disp_statistics import DatasetStatistics, frame_statistics
+from helper.metrics import get_metrics, timed_call
+from helper.frame_index import join_frames, report_missing
+from helper.layout import load_layout, get_layout, frame_file, output_file
+from helper.fused_disp import fused_disp_and_uncertainty, fused_supported, DISP_TOLERANCE, UNCERTAINTY_TOLERANCE
 
-def read_flow(filename):
+
+def load_flow(filename):
     flow = np.load(filename)
 
+    # the size depends on the crop of the movie (1880x800 with the fixed crop)
+    assert flow.ndim == 3 and flow.shape[2] == 2, f"flow needs to be of shape HxWx2 but is {flow.shape}"
+
+    return flow
+
+
+def read_flow(filename):
+    flow = load_flow(filename)
+
     u = flow[:, :, 0]
     v = flow[:, :, 1]
 
-    assert u.shape[0] == 800, f"hight of flow needs to be 800 but is {u.shape[0]}"
-    assert u.shape[1] == 1880, f"width of flow needs to be 1880 but is {u.shape[1]}"
-
     return u, v
 
 
@@ -49,8 +66,8 @@ def get_file_name(path):
     return path.split("/")[-1].split(".")[0]
 
 
-def create_log_header(use_filtering, l):
-    if use_filtering:
+def create_log_header(args, l):
+    if args.use_filtering:
         l.write("## Log file for disparity filtering\n\n")
         l.write(
             f"# v_threshold: {args.v_threshold} - threshold vertical flow check\n")
@@ -66,46 +83,56 @@ def create_log_header(use_filtering, l):
         l.write("## No filtering used for last run!")
 
 
-def get_disp_uncer_sing_iter(args, out_path_disp, out_path_uncer, file_forward, file_backward, file_sky):
-    file_name_f = get_file_name(file_forward)
-    file_name_b = get_file_name(file_backward)
-    file_name_s = get_file_name(file_sky)
-
-    # Check if all the data belongs to the same original image
-    assert file_name_f[0:11] == file_name_b[0:11] == file_name_s[0:11], f"file names for forwad and backward flow and\
-        sky segmentation should be the same - {file_name_f[0:11]} | {file_name_b[0:11]} | {file_name_s[0:11]}"
-
-    out_file_name = file_name_f[0:11]
-
-    # read flow
-    u_fw, v_fw = read_flow(file_forward)
-    u_bw, v_bw = read_flow(file_backward)
-    sky_seg_idx = read_sky_segmentation(file_sky)
-
-    if args.use_filtering:
-        check_v_fw = abs(v_fw) > args.v_threshold
-        v_fail_fw = 1.0 * np.count_nonzero(check_v_fw) / v_fw.size
-
-        if v_fail_fw >= args.max_v_fail:
-            return out_file_name + " v_fail_fw to large\n"
-
-        check_v_bw = abs(v_bw) > args.v_threshold
-        v_fail_bw = 1.0 * np.count_nonzero(check_v_bw) / v_bw.size
-
-        if v_fail_bw >= args.max_v_fail:
-            return out_file_name + " v_fail_fw too large\n"
-
-        range_fw = u_fw.max() - u_fw.min()
-
-        if range_fw <= args.range_threshold:
-            return out_file_name + " range_u_fw too small\n"
-
-        range_bw = u_bw.max() - u_bw.min()
-
-        if range_bw <= args.range_threshold:
-            return out_file_name + " range_threshold too small\n"
-
-    # compute uncertainty and disparity
+def add_filter_args(parser):
+    """Add the command line arguments of the filtering (see get_filter_params)"""
+    parser.add_argument(
+        "-f", "--use_filtering", action="store_true", help="Apply filtering based on flow?")
+    parser.add_argument(
+        "--v_threshold", type=float, default=2, help="threshold vertical flow check")
+    parser.add_argument(
+        "--max_v_fail",
+        type=float,
+        default=0.1,
+        help="max percentage of pixels that fail vertical flow check",)
+    parser.add_argument(
+        "--fbc_threshold",
+        type=float,
+        default=2,
+        help="threshold for forward-backward check")
+    parser.add_argument(
+        "--min_fbc_pass",
+        type=float,
+        default=0.7,
+        help="min percentage of pixels that pass forward-backward check")
+    parser.add_argument(
+        "--range_threshold",
+        type=float,
+        default=10,
+        help="threshold for horizontal flow range check")
+    parser.add_argument(
+        "--kernel",
+        type=str,
+        default="opencv",
+        choices=["opencv", "fused"],
+        help="compute the uncertainty, downscaling and quantization with OpenCV or the fused kernel \
+              (helper/fused_disp.py, less memory traffic)")
+
+
+def get_filter_params(args):
+    """Get the filter parameters of compute_disp_and_uncertainty from the command line arguments"""
+    return {
+        "use_filtering": args.use_filtering,
+        "v_threshold": args.v_threshold,
+        "max_v_fail": args.max_v_fail,
+        "fbc_threshold": args.fbc_threshold,
+        "min_fbc_pass": args.min_fbc_pass,
+        "range_threshold": args.range_threshold,
+        "kernel": args.kernel,
+    }
+
+
+def forward_backward_error(u_fw, u_bw):
+    """Difference of the forward flow and the warped (flipped) backward flow"""
     ind_y, ind_x = np.indices(u_fw.shape, dtype=np.float32)
     y_map = ind_y
     x_map = ind_x + u_fw
@@ -118,19 +145,19 @@ def get_disp_uncer_sing_iter(args, out_path_disp, out_path_uncer, file_forward,
         borderMode=cv2.BORDER_REPLICATE,
     )
 
-    uncertainty = abs(u_fw - flow_flipped_and_warped)
+    return abs(u_fw - flow_flipped_and_warped)
 
-    if args.use_filtering:
-        valid = uncertainty < args.fbc_threshold
-        fbc_pass = 1.0 * np.count_nonzero(valid) / uncertainty.size
 
-        if fbc_pass <= args.min_fbc_pass:
-            return out_file_name + " fbc_pass too small\n"
+def quantize_disp_and_uncertainty(disp, uncertainty, sky_seg_idx=None):
+    """Downsample and quantize the (full-resolution) disparity and uncertainty
 
-    disp = -u_fw
+    Returns the disparity (uint16), the uncertainty (uint8) and the quantization
+    metadata {"offset", "scale"} (disparity = offset + scale * quantized disparity).
+    """
 
     # use sky segmentation to set disparity of sky to minimum disp in image
-    disp[sky_seg_idx] = np.min(disp)
+    if sky_seg_idx is not None:
+        disp[sky_seg_idx] = np.min(disp)
 
     # downsample disparity and uncertainty
     downscaling = 0.5
@@ -168,63 +195,223 @@ def get_disp_uncer_sing_iter(args, out_path_disp, out_path_uncer, file_forward,
         offset = disp_min
         scale = 1.0
 
-    meta = PngImagePlugin.PngInfo()
-    meta.add_text("offset", str(offset))
-    meta.add_text("scale", str(scale))
-
     uncertainty = (10 * uncertainty).round()
     uncertainty[uncertainty > 255] = 255
 
-    # save disparity and uncertainty
+    return disp, uncertainty.astype(np.uint8), {"offset": offset, "scale": scale}
+
+
+def write_disp_and_uncertainty(disp, uncertainty, quantization, out_path_disp, out_path_uncer, out_file_name,
+                               layout=None):
+    """Save the quantized disparity (offset and scale as png text) and uncertainty
+
+    layout is the directory layout of the data set (see helper/layout.py, default flat).
+    """
+    layout = layout or get_layout()
+    meta = PngImagePlugin.PngInfo()
+    meta.add_text("offset", str(quantization["offset"]))
+    meta.add_text("scale", str(quantization["scale"]))
 
-    disp_out_path = os.path.join(
-        out_path_disp, out_file_name + ".png")
+    disp_out_path = output_file(out_path_disp, out_file_name + ".png", layout)
     imageio.imwrite(disp_out_path, disp, pnginfo=meta, prefer_uint8=False)
 
-    uncer_out_path = os.path.join(
-        out_path_uncer, out_file_name + ".png")
-    imageio.imwrite(uncer_out_path, uncertainty.astype(np.uint8))
+    uncer_out_path = output_file(out_path_uncer, out_file_name + ".png", layout)
+    imageio.imwrite(uncer_out_path, uncertainty)
+
+
+def save_disp_and_uncertainty(disp, uncertainty, sky_seg_idx, out_path_disp, out_path_uncer, out_file_name,
+                              layout=None):
+    """Downsample, quantize and save the (full-resolution) disparity and uncertainty"""
+    disp, uncertainty, quantization = quantize_disp_and_uncertainty(disp, uncertainty, sky_seg_idx)
+    write_disp_and_uncertainty(disp, uncertainty, quantization, out_path_disp, out_path_uncer, out_file_name,
+                               layout)
+
+    return disp, uncertainty, quantization
+
+
+def compute_disp_and_uncertainty(flow_forward, flow_backward, sky_seg_idx=None, use_filtering=False,
+                                 v_threshold=2, max_v_fail=0.1, fbc_threshold=2, min_fbc_pass=0.7,
+                                 range_threshold=10, kernel="opencv"):
+    """Compute the quantized disparity and uncertainty of a single frame in memory
+
+    flow_forward / flow_backward are the (full-resolution) flows of shape HxWx2
+    (u, v), sky_seg_idx the sky segmentation as returned by read_sky_segmentation.
+    The filter parameters are the same as the command line arguments. With
+    kernel="fused" the frame is processed by helper/fused_disp.py (frames with
+    odd width or height use OpenCV).
+
+    Returns the disparity (uint16), the uncertainty (uint8), the quantization
+    metadata and the verdict of the filtering ("0" if the frame is kept, otherwise
+    the reason). For filtered frames disparity, uncertainty and metadata are None.
+    """
+    u_fw, v_fw = flow_forward[:, :, 0], flow_forward[:, :, 1]
+    u_bw, v_bw = flow_backward[:, :, 0], flow_backward[:, :, 1]
+
+    if use_filtering:
+        check_v_fw = abs(v_fw) > v_threshold
+        v_fail_fw = 1.0 * np.count_nonzero(check_v_fw) / v_fw.size
+
+        if v_fail_fw >= max_v_fail:
+            return None, None, None, "v_fail_fw to large"
+
+        check_v_bw = abs(v_bw) > v_threshold
+        v_fail_bw = 1.0 * np.count_nonzero(check_v_bw) / v_bw.size
+
+        if v_fail_bw >= max_v_fail:
+            return None, None, None, "v_fail_fw too large"
+
+        range_fw = u_fw.max() - u_fw.min()
+
+        if range_fw <= range_threshold:
+            return None, None, None, "range_u_fw too small"
+
+        range_bw = u_bw.max() - u_bw.min()
+
+        if range_bw <= range_threshold:
+            return None, None, None, "range_threshold too small"
+
+    if kernel == "fused" and fused_supported(u_fw.shape):
+        disp, uncertainty, quantization, valid = fused_disp_and_uncertainty(
+            flow_forward, flow_backward, sky_seg_idx, fbc_threshold if use_filtering else None)
+
+        if use_filtering and 1.0 * valid / u_fw.size <= min_fbc_pass:
+            return None, None, None, "fbc_pass too small"
+
+        return disp, uncertainty, quantization, "0"
+
+    # compute uncertainty and disparity
+    uncertainty = forward_backward_error(u_fw, u_bw)
+
+    if use_filtering:
+        valid = uncertainty < fbc_threshold
+        fbc_pass = 1.0 * np.count_nonzero(valid) / uncertainty.size
+
+        if fbc_pass <= min_fbc_pass:
+            return None, None, None, "fbc_pass too small"
+
+    disp = -u_fw
+
+    disp, uncertainty, quantization = quantize_disp_and_uncertainty(disp, uncertainty, sky_seg_idx)
+
+    return disp, uncertainty, quantization, "0"
+
+
+def compute_disp_and_uncertainty_batch(flows_forward, flows_backward, sky_seg_idxs=None, **params):
+    """Compute the disparity and uncertainty of a batch of frames in memory
+
+    flows_forward / flows_backward are arrays of shape NxHxWx2 (or lists of HxWx2 flows),
+    sky_seg_idxs a list of sky segmentations (or None). Returns a list with the result of
+    compute_disp_and_uncertainty for every frame.
+    """
+    if sky_seg_idxs is None:
+        sky_seg_idxs = [None] * len(flows_forward)
+
+    return [compute_disp_and_uncertainty(flow_fw, flow_bw, sky, **params)
+            for flow_fw, flow_bw, sky in zip(flows_forward, flows_backward, sky_seg_idxs)]
+
+
+def get_disp_uncer_sing_iter(args, out_path_disp, out_path_uncer, layout, out_file_name, file_forward, file_backward,
+                             file_sky):
+    # out_file_name is the frame id the inputs are joined by (see helper/frame_index.py)
+    # read flow
+    flow_forward = load_flow(file_forward)
+    flow_backward = load_flow(file_backward)
+    sky_seg_idx = read_sky_segmentation(file_sky)
+
+    disp, uncertainty, quantization, verdict = compute_disp_and_uncertainty(
+        flow_forward, flow_backward, sky_seg_idx, **get_filter_params(args))
+
+    if verdict != "0":
+        return out_file_name + " " + verdict + "\n", None
+
+    write_disp_and_uncertainty(disp, uncertainty, quantization, out_path_disp, out_path_uncer, out_file_name, layout)
+
+    return "0", frame_statistics(out_file_name, disp, uncertainty, quantization, sky_seg_idx)
 
-    return "0"
+
+def check_kernel(args, inputs):
+    """Compare the fused kernel with the OpenCV path (speed and difference) on the first frames"""
+    params = get_filter_params(args)
+    durations = {"opencv": 0.0, "fused": 0.0}
+    max_diff_disp, max_diff_uncer, num_diff, num_pixels = 0, 0, 0, 0
+
+    for _, (file_forward, file_backward, file_sky), _ in tqdm(inputs[:args.check_kernel]):
+        flow_forward = load_flow(file_forward)
+        flow_backward = load_flow(file_backward)
+        sky_seg_idx = read_sky_segmentation(file_sky)
+
+        results = {}
+        for kernel in durations:
+            params["kernel"] = kernel
+            start_time = time.time()
+            results[kernel] = compute_disp_and_uncertainty(flow_forward, flow_backward, sky_seg_idx, **params)
+            durations[kernel] += time.time() - start_time
+
+        (disp, uncer, _, verdict), (disp_f, uncer_f, _, verdict_f) = results["opencv"], results["fused"]
+        if verdict != verdict_f:
+            print(f"{file_forward}: verdict {verdict} / {verdict_f}")
+            max_diff_disp = np.inf
+            continue
+        if verdict != "0":
+            continue
+        diff = np.abs(disp.astype(np.int32) - disp_f)
+        max_diff_disp = max(max_diff_disp, diff.max())
+        max_diff_uncer = max(max_diff_uncer, np.abs(uncer.astype(np.int32) - uncer_f).max())
+        num_diff += np.count_nonzero(diff)
+        num_pixels += diff.size
+
+    num_frames = min(args.check_kernel, len(inputs))
+    print(f"\n{'kernel':<10}{'s/frame':>10}")
+    for kernel, duration in durations.items():
+        print(f"{kernel:<10}{duration / max(num_frames, 1):>10.3f}")
+    print(f"\nmax difference disparity:   {max_diff_disp} (tolerance {DISP_TOLERANCE})")
+    print(f"max difference uncertainty: {max_diff_uncer} (tolerance {UNCERTAINTY_TOLERANCE})")
+    print(f"disparity pixels differing: {num_diff / max(num_pixels, 1):.6f}")
+
+    return max_diff_disp <= DISP_TOLERANCE and max_diff_uncer <= UNCERTAINTY_TOLERANCE
 
 
 def get_disp_and_uncertainty(args):
 
+    # join the inputs by frame id, frames with missing inputs are skipped
+    inputs, missing = join_frames(args.path, [("flow_forward", ".npy"), ("flow_backward", ".npy"),
+                                              ("sky_segmentation", ".png")])
+    report_missing(args.path, missing, "missing_inputs_disparity.txt")
+
+    if args.check_kernel > 0:
+        if not check_kernel(args, inputs):
+            sys.exit("fused kernel differs from the OpenCV path more than the tolerance")
+        return
+
     out_path_disp = os.path.join(args.path, args.out_dir_disp)
     out_path_uncer = os.path.join(args.path, args.out_dir_uncer)
     create_dir(out_path_disp)
     create_dir(out_path_uncer)
-
-    path_flow_f = sorted(
-        glob.glob(os.path.join(args.path, "flow_forward", "*.npy")))
-    path_flow_b = sorted(
-        glob.glob(os.path.join(args.path, "flow_backward", "*.npy")))
-    path_sky_seg = sorted(
-        glob.glob(os.path.join(args.path, "sky_segmentation", "*.png")))
-
-    assert len(path_flow_f) == len(
-        path_flow_b), "number of forward and backward flows not the same"
-    assert len(path_flow_f) == len(
-        path_sky_seg), "number of flow and sky segmentation not the same"
+    layout = load_layout(args.path)
 
     # Logfile to store which images are ignored and why
     if not os.path.exists(os.path.join(args.path, "meta")):
         os.makedirs(os.path.join(args.path, "meta"))
     log_file = os.path.join(args.path, "meta", "disp_filter_log.txt")
     l = open(log_file, "w")
-    create_log_header(args.use_filtering, l)
+    create_log_header(args, l)
 
     num_cores = multiprocessing.cpu_count()
     print(f"\nRunning on {num_cores} cores\n")
 
-    inputs = zip(path_flow_f, path_flow_b, path_sky_seg)
-    inputs = tqdm(inputs, total=len(path_flow_f))
+    metrics = get_metrics("disparity", workers=num_cores, total=len(inputs))
 
-    returns = Parallel(n_jobs=num_cores)(delayed(get_disp_uncer_sing_iter)(args, out_path_disp, out_path_uncer, i, j, k)
-                                         for i, j, k in inputs)
-    # for file_forward, file_backward, file_sky in tqdm(zip(path_flow_f, path_flow_b, path_sky_seg), total=len(path_flow_f)):
+    # the statistics are merged while the results of the workers come in
+    returns = Parallel(n_jobs=num_cores, return_as="generator")(
+        delayed(timed_call)(get_disp_uncer_sing_iter, args, out_path_disp, out_path_uncer, layout, frame, *files)
+        for frame, files, _ in tqdm(inputs))
+    stats = DatasetStatistics(args.path)
     num_filterd = 0
-    for res in returns:
+    for (frame, files, _), ((res, frame_stats), seconds) in zip(inputs, returns):
+        stats.add_result(res, frame_stats)
+        name = frame + ".png"
+        metrics.add_result(res, seconds, files,
+                           [frame_file(out_path_disp, name, layout), frame_file(out_path_uncer, name, layout)])
         if res == "0":
             continue
         l.write(res)
@@ -233,14 +420,17 @@ def get_disp_and_uncertainty(args):
     # Log percentage of filterd images
     if args.use_filtering:
         l.write(
-            f"\nPercentage of filtered images: {num_filterd/len(returns)}")
-        l.close()
+            f"\nPercentage of filtered images: {num_filterd/max(len(inputs), 1)}")
+    l.close()
+
+    stats.save(args.path)
+    metrics.close()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Generate disparity and uncertainty maps for given list. Assumumption: \
-                                                  (full-resolution; i.e. 1880x800) forward / backward flow is located in \
+                                                  (full-resolution; e.g. 1880x800) forward / backward flow is located in \
                                                   the folders flow_forward and flow_backward.")
     parser.add_argument(
         "path", type=str, help="path to folder of dataset - needs to contain flow_forward / flow_backward / sky_segmentation")
@@ -248,30 +438,10 @@ if __name__ == "__main__":
         "--out_dir_disp", type=str, default="disparity", help="name of the output dir for disparity (default=disparity)")
     parser.add_argument(
         "--out_dir_uncer", type=str, default="uncertainty", help="name of the output dir for uncertainty")
+    add_filter_args(parser)
     parser.add_argument(
-        "-f", "--use_filtering", action="store_true", help="Apply filtering based on flow?")
-    parser.add_argument(
-        "--v_threshold", type=float, default=2, help="threshold vertical flow check")
-    parser.add_argument(
-        "--max_v_fail",
-        type=float,
-        default=0.1,
-        help="max percentage of pixels that fail vertical flow check",)
-    parser.add_argument(
-        "--fbc_threshold",
-        type=float,
-        default=2,
-        help="threshold for forward-backward check")
-    parser.add_argument(
-        "--min_fbc_pass",
-        type=float,
-        default=0.7,
-        help="min percentage of pixels that pass forward-backward check")
-    parser.add_argument(
-        "--range_threshold",
-        type=float,
-        default=10,
-        help="threshold for horizontal flow range check")
+        "--check_kernel", type=int, default=0,
+        help="only compare the fused kernel with the OpenCV path on the first check_kernel frames")
     args = parser.parse_args()
 
     get_disp_and_uncertainty(args)
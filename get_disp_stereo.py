@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""
+    Generate disparity and uncertainty maps directly from the (approximately rectified)
+    stereo pairs in image_left / image_right without computing a dense 2D optical flow.
+
+    The left and right disparity are computed with OpenCV StereoSGBM (horizontal search
+    only). The search range is estimated once per scene from a few low resolution frames.
+    The uncertainty is the error of the left-right consistency check (the equivalent of the
+    forward-backward check of the flow) and both maps are saved in the same format as
+    get_disp_and_uncertainty.py.
+"""
+import os
+import time
+import argparse
+import numpy as np
+import cv2
+from tqdm import tqdm
+from joblib import Parallel, delayed
+import multiprocessing
+
+from get_disp_and_uncertainty import create_dir, read_flow, read_sky_segmentation, \
+    save_disp_and_uncertainty
+from helper.manifest import manifest_exists, load_manifest, out_name
+from helper.disp_statistics import DatasetStatistics, frame_statistics
+from helper.metrics import get_metrics, timed_call
+from helper.frame_index import join_frames, report_missing
+from helper.layout import load_layout, frame_file
+
+
+SGBM_MODES = {
+    "sgbm": cv2.STEREO_SGBM_MODE_SGBM,
+    "3way": cv2.STEREO_SGBM_MODE_SGBM_3WAY,
+    "hh": cv2.STEREO_SGBM_MODE_HH,
+}
+
+
+def dataset_file(args, folder, filename):
+    """Path of the file of a frame in a folder of the data set (see helper/layout.py)"""
+    return frame_file(os.path.join(args.path, folder), filename, load_layout(args.path))
+
+
+def get_scenes(args, names):
+    """Group the frames of the data set (names of the images) by their scene (or sequence)
+
+    The grouping is taken from the manifest of the data set. Without manifest
+    groups of --scene_frames consecutive frames are used.
+    """
+    manifest_file = os.path.join(args.path, "meta", args.name + ".manifest")
+    available = set(names)
+
+    if manifest_exists(manifest_file):
+        scenes = {}
+        records, _ = load_manifest(manifest_file)
+        for r in records:
+            name = out_name(r)
+            if name not in available:
+                continue
+            if r["scene"] >= 0:
+                key = (r["video"], r["chapter"], r["scene"])
+            elif r["sequence"] >= 0:
+                key = (r["video"], r["sequence"])
+            else:
+                key = (r["video"], r["chapter"])
+            scenes.setdefault(key, []).append(name)
+
+        # frames not part of the manifest
+        covered = set(n for scene in scenes.values() for n in scene)
+        rest = [n for n in names if n not in covered]
+        scenes = list(scenes.values())
+    else:
+        print(f"Manifest {manifest_file} not found. Using groups of {args.scene_frames} frames ...")
+        scenes = []
+        rest = names
+
+    scenes += [rest[i:i + args.scene_frames] for i in range(0, len(rest), args.scene_frames)]
+    return scenes
+
+
+def estimate_disparity_range(args, names):
+    """Estimate the disparity search range of a scene
+
+    The disparity of a few frames of the scene is estimated with a fast (DIS) optical flow
+    on a low resolution version of the images. Returns minDisparity and numDisparities
+    for StereoSGBM (multiple of 16).
+    """
+    cv2.setNumThreads(1)
+
+    samples = names[::max(1, len(names) // args.range_samples)][:args.range_samples]
+    flow_method = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+
+    disps = []
+    for name in samples:
+        left = cv2.imread(dataset_file(args, "image_left", name + ".jpg"), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        right = cv2.imread(dataset_file(args, "image_right", name + ".jpg"), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        if left is None or right is None:
+            continue
+        disps.append(-4 * flow_method.calc(left, right, None)[:, :, 0].ravel())
+
+    if not disps:
+        return args.min_disparity_default, args.max_disparities
+
+    disp_low, disp_high = np.percentile(np.concatenate(disps), [1, 99])
+
+    min_disparity = int(np.floor((disp_low - args.range_margin) / 16)) * 16
+    num_disparities = int(np.ceil((disp_high + args.range_margin - min_disparity) / 16)) * 16
+    num_disparities = int(np.clip(num_disparities, 16, args.max_disparities))
+
+    return min_disparity, num_disparities
+
+
+def create_matcher(args, min_disparity, num_disparities):
+    block_size = args.block_size
+    return cv2.StereoSGBM_create(
+        minDisparity=min_disparity,
+        numDisparities=num_disparities,
+        blockSize=block_size,
+        P1=8 * block_size ** 2,
+        P2=32 * block_size ** 2,
+        disp12MaxDiff=-1,
+        uniquenessRatio=10,
+        speckleWindowSize=100,
+        speckleRange=2,
+        mode=SGBM_MODES[args.mode],
+    )
+
+
+def fill_invalid(disp, valid):
+    """Fill invalid pixels with the last valid disparity to their left (background of occlusions)"""
+    idx = np.where(valid, np.arange(disp.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    filled = disp[np.arange(disp.shape[0])[:, None], idx]
+
+    # pixels without a valid pixel to their left
+    if valid.any():
+        filled[~valid & (idx == 0) & ~valid[:, :1]] = disp[valid].min()
+    return filled
+
+
+def compute_stereo_disparity(args, left, right, min_disparity, num_disparities):
+    """Compute the left and right disparity of a (rectified) stereo pair
+
+    The disparity of the left image is -u_fw of the forward flow, the disparity of the
+    right image is u_bw of the backward flow. Returns both disparities (float32, filled)
+    and the mask of the pixels of the left disparity StereoSGBM found a match for.
+    """
+    matcher = create_matcher(args, min_disparity, num_disparities)
+
+    disp_left = matcher.compute(left, right).astype(np.float32) / 16
+    # the right disparity is computed on the mirrored images
+    disp_right = matcher.compute(right[:, ::-1].copy(), left[:, ::-1].copy())[:, ::-1].astype(np.float32) / 16
+
+    valid_left = disp_left >= min_disparity
+    valid_right = disp_right >= min_disparity
+
+    return fill_invalid(disp_left, valid_left), fill_invalid(disp_right, valid_right), valid_left
+
+
+def left_right_uncertainty(disp_left, disp_right, valid_left, invalid_uncertainty=51.0):
+    """Left-right consistency error (corresponds to the forward-backward error of the flow)"""
+    ind_y, ind_x = np.indices(disp_left.shape, dtype=np.float32)
+
+    disp_right_warped = cv2.remap(
+        disp_right,
+        ind_x - disp_left,
+        ind_y,
+        interpolation=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_REPLICATE,
+    )
+
+    uncertainty = np.abs(disp_left - disp_right_warped)
+    uncertainty[~valid_left] = invalid_uncertainty
+
+    return uncertainty
+
+
+def get_disp_stereo_sing_iter(args, out_path_disp, out_path_uncer, name, file_sky, disparity_range):
+    cv2.setNumThreads(1)
+
+    left = cv2.imread(dataset_file(args, "image_left", name + ".jpg"), cv2.IMREAD_GRAYSCALE)
+    right = cv2.imread(dataset_file(args, "image_right", name + ".jpg"), cv2.IMREAD_GRAYSCALE)
+    if left is None or right is None:
+        return name + " image could not be read\n", None
+
+    disp, disp_right, valid = compute_stereo_disparity(args, left, right, *disparity_range)
+    uncertainty = left_right_uncertainty(disp, disp_right, valid)
+
+    if args.use_filtering:
+        if disp.max() - disp.min() <= args.range_threshold:
+            return name + " range_disp too small\n", None
+
+        lrc_pass = 1.0 * np.count_nonzero(uncertainty < args.fbc_threshold) / uncertainty.size
+        if lrc_pass <= args.min_fbc_pass:
+            return name + " lrc_pass too small\n", None
+
+    if file_sky is not None:
+        sky_seg_idx = read_sky_segmentation(file_sky)
+    else:
+        sky_seg_idx = np.zeros(disp.shape, dtype=bool)
+
+    disp, uncertainty, quantization = save_disp_and_uncertainty(
+        disp, uncertainty, sky_seg_idx, out_path_disp, out_path_uncer, name, load_layout(args.path))
+
+    return "0", frame_statistics(name, disp, uncertainty, quantization, sky_seg_idx)
+
+
+def create_log_header(args, l):
+    if args.use_filtering:
+        l.write("## Log file for disparity filtering (stereo matching)\n\n")
+        l.write(
+            f"# fbc_threshold: {args.fbc_threshold} - threshold for left-right check\n")
+        l.write(
+            f"# min_fbc_pass: {args.min_fbc_pass} - min percentage of pixels that pass left-right check\n")
+        l.write(
+            f"# range_threshold: {args.range_threshold} - threshold for disparity range check\n\n")
+    else:
+        l.write("## No filtering used for last run!")
+
+
+def benchmark(args, names, sky_files):
+    """Compare speed and agreement of the stereo matching with the flow based disparity
+
+    The reference is the flow in flow_forward / flow_backward (if it exists), otherwise
+    the flow is computed with the DIS optical flow (see get_flow_cpu.py).
+    """
+    from get_flow_cpu import create_flow_method, compute_flow
+
+    cv2.setNumThreads(1)
+    flow_method = create_flow_method("dis", args.benchmark_preset)
+
+    time_stereo = 0
+    time_flow = 0
+    agreement = []
+
+    for name in tqdm(names[:args.benchmark]):
+        left = cv2.imread(dataset_file(args, "image_left", name + ".jpg"), cv2.IMREAD_GRAYSCALE)
+        right = cv2.imread(dataset_file(args, "image_right", name + ".jpg"), cv2.IMREAD_GRAYSCALE)
+
+        start_time = time.time()
+        disparity_range = estimate_disparity_range(args, [name])
+        disp, disp_right, valid = compute_stereo_disparity(args, left, right, *disparity_range)
+        uncertainty = left_right_uncertainty(disp, disp_right, valid)
+        time_stereo += time.time() - start_time
+
+        start_time = time.time()
+        flow_fw = compute_flow(flow_method, left, right)
+        flow_bw = compute_flow(flow_method, right, left)
+        time_flow += time.time() - start_time
+
+        file_forward = dataset_file(args, "flow_forward", name + ".npy")
+        file_backward = dataset_file(args, "flow_backward", name + ".npy")
+        if os.path.exists(file_forward) and os.path.exists(file_backward):
+            u_fw, _ = read_flow(file_forward)
+            u_bw, _ = read_flow(file_backward)
+        else:
+            u_fw, u_bw = flow_fw[:, :, 0], flow_bw[:, :, 0]
+
+        disp_flow = -u_fw
+        uncertainty_flow = left_right_uncertainty(disp_flow, u_bw, np.ones(disp.shape, dtype=bool))
+
+        # compare on pixels both methods are confident about (and that are not sky)
+        mask = (uncertainty < args.fbc_threshold) & (uncertainty_flow < args.fbc_threshold)
+        if name in sky_files:
+            mask &= read_sky_segmentation(sky_files[name]) == 0
+        if not mask.any():
+            continue
+
+        diff = np.abs(disp - disp_flow)[mask]
+        agreement.append((diff.mean(), np.count_nonzero(diff < 1) / diff.size, mask.mean()))
+
+    num_frames = min(args.benchmark, len(names))
+    print(f"\nBenchmark on {num_frames} frames (single core)\n")
+    print(f"stereo ({args.mode}):       {num_frames / time_stereo:.2f} frames/s")
+    print(f"flow (dis/{args.benchmark_preset}): {num_frames / time_flow:.2f} frames/s (without reading/writing the flow)")
+    if agreement:
+        mean_error, within_1px, coverage = np.mean(agreement, axis=0)
+        print(f"\nmean absolute difference: {mean_error:.3f} px")
+        print(f"pixels within 1 px:       {within_1px:.3f}")
+        print(f"pixels compared:          {coverage:.3f}")
+
+
+def get_disp_stereo(args):
+
+    # join the images by frame id, frames with a missing image are skipped
+    frames, missing = join_frames(args.path, [("image_left", ".jpg"), ("image_right", ".jpg")],
+                                  [("sky_segmentation", ".png")])
+    report_missing(args.path, missing, "missing_inputs_stereo.txt")
+    names = [frame for frame, _, _ in frames]
+    sky_files = {frame: sky for frame, _, (sky,) in frames if sky is not None}
+
+    if not sky_files:
+        print("No sky segmentation found. Not setting the disparity of the sky.")
+
+    if args.benchmark > 0:
+        benchmark(args, names, sky_files)
+        return
+
+    out_path_disp = os.path.join(args.path, args.out_dir_disp)
+    out_path_uncer = os.path.join(args.path, args.out_dir_uncer)
+    create_dir(out_path_disp)
+    create_dir(out_path_uncer)
+
+    if not os.path.exists(os.path.join(args.path, "meta")):
+        os.makedirs(os.path.join(args.path, "meta"))
+    log_file = os.path.join(args.path, "meta", "disp_filter_log.txt")
+    l = open(log_file, "w")
+    create_log_header(args, l)
+
+    num_cores = min(args.numCores, multiprocessing.cpu_count()) if args.numCores > 0 \
+        else multiprocessing.cpu_count()
+    print(f"\nRunning on {num_cores} cores\n")
+
+    scenes = get_scenes(args, names)
+    print(f"Estimating the disparity range of {len(scenes)} scenes ...")
+    ranges = Parallel(n_jobs=num_cores)(delayed(estimate_disparity_range)(args, scene) for scene in tqdm(scenes))
+
+    with open(os.path.join(args.path, "meta", "disp_range_log.txt"), "w") as fp:
+        for scene, (min_disparity, num_disparities) in zip(scenes, ranges):
+            fp.write(f"{scene[0]} {scene[-1]} {len(scene)} {min_disparity} {num_disparities}\n")
+
+    inputs = [(name, disparity_range) for scene, disparity_range in zip(scenes, ranges) for name in scene]
+
+    metrics = get_metrics("disparity", workers=num_cores, total=len(inputs), engine="stereo")
+    returns = Parallel(n_jobs=num_cores, return_as="generator")(
+        delayed(timed_call)(get_disp_stereo_sing_iter, args, out_path_disp, out_path_uncer, name,
+                            sky_files.get(name[0:11]), r)
+        for name, r in tqdm(inputs))
+    stats = DatasetStatistics(args.path)
+
+    num_filterd = 0
+    for (name, _), ((res, frame_stats), seconds) in zip(inputs, returns):
+        stats.add_result(res, frame_stats)
+        metrics.add_result(res, seconds,
+                           [dataset_file(args, "image_left", name + ".jpg"),
+                            dataset_file(args, "image_right", name + ".jpg")],
+                           [frame_file(out_path_disp, name + ".png", load_layout(args.path)),
+                            frame_file(out_path_uncer, name + ".png", load_layout(args.path))])
+        if res == "0":
+            continue
+        l.write(res)
+        num_filterd += 1
+
+    if args.use_filtering:
+        l.write(
+            f"\nPercentage of filtered images: {num_filterd/max(len(inputs), 1)}")
+    l.close()
+
+    stats.save(args.path)
+    metrics.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generate disparity and uncertainty maps directly from the stereo \
+                                                  pairs with StereoSGBM (alternative to the optical flow + \
+                                                  get_disp_and_uncertainty.py).")
+    parser.add_argument(
+        "path", type=str, help="path to folder of dataset - needs to contain image_left / image_right (and sky_segmentation)")
+    parser.add_argument(
+        "--name", type=str, default="training", help="name of the data set (manifest located in meta)")
+    parser.add_argument(
+        "--out_dir_disp", type=str, default="disparity", help="name of the output dir for disparity (default=disparity)")
+    parser.add_argument(
+        "--out_dir_uncer", type=str, default="uncertainty", help="name of the output dir for uncertainty")
+    parser.add_argument(
+        "--mode", type=str, default="3way", choices=list(SGBM_MODES), help="mode of StereoSGBM")
+    parser.add_argument(
+        "--block_size", type=int, default=5, help="block size of StereoSGBM")
+    parser.add_argument(
+        "--range_samples", type=int, default=3, help="number of frames per scene used to estimate the search range")
+    parser.add_argument(
+        "--range_margin", type=float, default=16, help="margin (pixels) added to the estimated search range")
+    parser.add_argument(
+        "--max_disparities", type=int, default=256, help="maximum size of the search range")
+    parser.add_argument(
+        "--min_disparity_default", type=int, default=-128,
+        help="minimum disparity if the search range could not be estimated")
+    parser.add_argument(
+        "--scene_frames", type=int, default=50, help="frames per group if no manifest is available")
+    parser.add_argument(
+        "-f", "--use_filtering", action="store_true", help="Apply filtering based on the left-right check?")
+    parser.add_argument(
+        "--fbc_threshold",
+        type=float,
+        default=2,
+        help="threshold for left-right check")
+    parser.add_argument(
+        "--min_fbc_pass",
+        type=float,
+        default=0.7,
+        help="min percentage of pixels that pass left-right check")
+    parser.add_argument(
+        "--range_threshold",
+        type=float,
+        default=10,
+        help="threshold for disparity range check")
+    parser.add_argument(
+        "--numCores", type=int, default=0, help="number of cores (default: all)")
+    parser.add_argument(
+        "--benchmark", type=int, default=0,
+        help="only run a benchmark against the flow based disparity on the given number of frames")
+    parser.add_argument(
+        "--benchmark_preset", type=str, default="medium", help="DIS preset of the flow used in the benchmark")
+    args = parser.parse_args()
+
+    get_disp_stereo(args)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+    Compute the forward (left -> right) and backward (right -> left) optical flow
+    on the CPU using OpenCV (DIS or Farneback).
+    The flow is saved (full-resolution; e.g. 1880x800x2 float32) into the folders
+    flow_forward and flow_backward as expected by get_disp_and_uncertainty.py.
+    With --fused the disparity and uncertainty are computed directly from the flow
+    in memory and the flow is not saved.
+"""
+import os
+import time
+import argparse
+import numpy as np
+import cv2
+from tqdm import tqdm
+from joblib import Parallel, delayed
+import multiprocessing
+
+from get_disp_and_uncertainty import add_filter_args, get_filter_params, create_log_header, \
+    compute_disp_and_uncertainty, write_disp_and_uncertainty, read_sky_segmentation
+from helper.disp_statistics import DatasetStatistics, frame_statistics
+from helper.metrics import get_metrics, timed_call
+from helper.frame_index import join_frames, report_missing
+from helper.layout import load_layout, frame_file, output_file
+
+
+DIS_PRESETS = {
+    "ultrafast": cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST,
+    "fast": cv2.DISOPTICAL_FLOW_PRESET_FAST,
+    "medium": cv2.DISOPTICAL_FLOW_PRESET_MEDIUM,
+}
+
+
+def create_dir(path):
+    try:
+        os.makedirs(path, exist_ok=True)
+    except:
+        print(f"Failed to create dir: {path}")
+    else:
+        print(f"Created dir: {path}")
+
+
+def get_file_name(path):
+    return path.split("/")[-1].split(".")[0]
+
+
+def create_flow_method(method, preset):
+    if method == "dis":
+        return cv2.DISOpticalFlow_create(DIS_PRESETS[preset])
+    return None
+
+
+def compute_flow(flow_method, first, second):
+    """Compute the flow from the first to the second (grayscale) image"""
+    if flow_method is not None:
+        return flow_method.calc(first, second, None)
+
+    return cv2.calcOpticalFlowFarneback(first, second, None, pyr_scale=0.5, levels=5, winsize=15,
+                                        iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
+
+
+def get_flow_sing_iter(args, out_path_fw, out_path_bw, layout, file_left, file_right, file_sky=None):
+    file_name = get_file_name(file_left)
+
+    # with --fused out_path_fw / out_path_bw are the output folders of disparity / uncertainty
+    ext = ".png" if args.fused else ".npy"
+    out_fw = frame_file(out_path_fw, file_name + ext, layout)
+    out_bw = frame_file(out_path_bw, file_name + ext, layout)
+    if not args.overwrite and os.path.exists(out_fw) and os.path.exists(out_bw):
+        return "0", None
+
+    # every worker is one process -> don't use additional threads in OpenCV
+    cv2.setNumThreads(1)
+
+    left = cv2.imread(file_left, cv2.IMREAD_GRAYSCALE)
+    right = cv2.imread(file_right, cv2.IMREAD_GRAYSCALE)
+    if left is None or right is None:
+        return file_name + " image could not be read\n", None
+    if left.shape != right.shape:
+        return file_name + f" image size {left.shape} / {right.shape} not the same\n", None
+
+    flow_method = create_flow_method(args.method, args.preset)
+
+    flow_fw = compute_flow(flow_method, left, right)
+    flow_bw = compute_flow(flow_method, right, left)
+
+    if args.fused:
+        sky_seg_idx = read_sky_segmentation(file_sky) if file_sky is not None else None
+        disp, uncertainty, quantization, verdict = compute_disp_and_uncertainty(
+            flow_fw, flow_bw, sky_seg_idx, **get_filter_params(args))
+        if verdict != "0":
+            return file_name + " " + verdict + "\n", None
+        write_disp_and_uncertainty(disp, uncertainty, quantization, out_path_fw, out_path_bw, file_name, layout)
+        return "0", frame_statistics(file_name, disp, uncertainty, quantization, sky_seg_idx)
+
+    np.save(output_file(out_path_fw, file_name + ext, layout), flow_fw.astype(np.float32))
+    np.save(output_file(out_path_bw, file_name + ext, layout), flow_bw.astype(np.float32))
+
+    return "0", None
+
+
+def flow_quality(flow_fw, flow_bw, fbc_threshold=2, v_threshold=2):
+    """Forward-backward consistency of the horizontal flow and percentage of large vertical flow"""
+    u_fw = flow_fw[:, :, 0]
+    ind_y, ind_x = np.indices(u_fw.shape, dtype=np.float32)
+    warped = cv2.remap(-flow_bw[:, :, 0], ind_x + u_fw, ind_y,
+                       interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    fb_error = np.abs(u_fw - warped)
+
+    return fb_error.mean(), np.count_nonzero(fb_error < fbc_threshold) / fb_error.size, \
+        np.count_nonzero(np.abs(flow_fw[:, :, 1]) > v_threshold) / u_fw.size
+
+
+def benchmark(args, path_left, path_right):
+    """Compare speed (single core) and quality of all methods/presets on the first frames"""
+    cv2.setNumThreads(1)
+
+    pairs = []
+    for file_left, file_right in list(zip(path_left, path_right))[:args.benchmark]:
+        pairs.append((cv2.imread(file_left, cv2.IMREAD_GRAYSCALE),
+                      cv2.imread(file_right, cv2.IMREAD_GRAYSCALE)))
+
+    print(f"\nBenchmark on {len(pairs)} frames (single core)\n")
+    print(f"{'method':<20}{'frames/s':>10}{'fb error':>12}{'fbc pass':>12}{'v fail':>10}")
+
+    configs = [("dis", p) for p in DIS_PRESETS] + [("farneback", "-")]
+    for method, preset in configs:
+        flow_method = create_flow_method(method, preset)
+
+        quality = []
+        start_time = time.time()
+        for left, right in pairs:
+            flow_fw = compute_flow(flow_method, left, right)
+            flow_bw = compute_flow(flow_method, right, left)
+            quality.append(flow_quality(flow_fw, flow_bw))
+        duration = time.time() - start_time
+
+        fb_error, fbc_pass, v_fail = np.mean(quality, axis=0)
+        name = method if preset == "-" else f"{method}/{preset}"
+        print(f"{name:<20}{len(pairs) / duration:>10.2f}{fb_error:>12.3f}{fbc_pass:>12.3f}{v_fail:>10.3f}")
+
+
+def get_flow(args):
+
+    # join the images by frame id, frames with a missing image are skipped
+    frames, missing = join_frames(args.path, [("image_left", ".jpg"), ("image_right", ".jpg")],
+                                  [("sky_segmentation", ".png")])
+    report_missing(args.path, missing,
+                   "missing_inputs_disparity.txt" if args.fused else "missing_inputs_flow.txt")
+    path_left = [files[0] for _, files, _ in frames]
+    path_right = [files[1] for _, files, _ in frames]
+
+    if args.benchmark > 0:
+        benchmark(args, path_left, path_right)
+        return
+
+    if args.fused:
+        out_path_fw = os.path.join(args.path, "disparity")
+        out_path_bw = os.path.join(args.path, "uncertainty")
+    else:
+        out_path_fw = os.path.join(args.path, "flow_forward")
+        out_path_bw = os.path.join(args.path, "flow_backward")
+    create_dir(out_path_fw)
+    create_dir(out_path_bw)
+    layout = load_layout(args.path)
+
+    sky_files = [sky for _, _, (sky,) in frames]
+    if args.fused and not any(sky_files):
+        print("No sky segmentation found. Not setting the disparity of the sky.")
+
+    num_cores = min(args.numCores, multiprocessing.cpu_count()) if args.numCores > 0 \
+        else multiprocessing.cpu_count()
+    print(f"\nRunning on {num_cores} cores\n")
+
+    inputs = list(zip(path_left, path_right, sky_files))
+    metrics = get_metrics("disparity" if args.fused else "flow", workers=num_cores, total=len(inputs),
+                          engine="flow_cpu")
+
+    returns = Parallel(n_jobs=num_cores, return_as="generator")(
+        delayed(timed_call)(get_flow_sing_iter, args, out_path_fw, out_path_bw, layout, i, j, k)
+        for i, j, k in tqdm(inputs))
+
+    if args.fused:
+        os.makedirs(os.path.join(args.path, "meta"), exist_ok=True)
+        l = open(os.path.join(args.path, "meta", "disp_filter_log.txt"), "w")
+        create_log_header(args, l)
+        stats = DatasetStatistics(args.path)
+
+    ext = ".png" if args.fused else ".npy"
+    num_filterd = 0
+    for (i, j, _), ((res, frame_stats), seconds) in zip(inputs, returns):
+        name = get_file_name(i)
+        metrics.add_result(res, seconds, [i, j],
+                           [frame_file(out_path_fw, name + ext, layout), frame_file(out_path_bw, name + ext, layout)])
+        if args.fused:
+            stats.add_result(res, frame_stats)
+        if res == "0":
+            continue
+        if args.fused:
+            l.write(res)
+        print(res.rstrip())
+        num_filterd += 1
+
+    if args.fused:
+        if args.use_filtering:
+            l.write(f"\nPercentage of filtered images: {num_filterd/max(len(path_left), 1)}")
+        l.close()
+        stats.save(args.path)
+    metrics.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compute the forward (left -> right) and backward (right -> left) \
+                                                  optical flow on the CPU and save it into the folders flow_forward \
+                                                  and flow_backward.")
+    parser.add_argument(
+        "path", type=str, help="path to folder of dataset - needs to contain image_left / image_right")
+    parser.add_argument(
+        "--method", type=str, default="dis", choices=["dis", "farneback"], help="optical flow method")
+    parser.add_argument(
+        "--preset", type=str, default="medium", choices=list(DIS_PRESETS), help="preset of the DIS flow")
+    parser.add_argument(
+        "--numCores", type=int, default=0, help="number of cores (default: all)")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="recompute flow that already exists")
+    parser.add_argument(
+        "--benchmark", type=int, default=0,
+        help="only run a benchmark of all methods/presets on the given number of frames")
+    parser.add_argument(
+        "--fused", action="store_true",
+        help="directly compute the disparity and uncertainty (get_disp_and_uncertainty.py) without saving the flow")
+    add_filter_args(parser)
+    args = parser.parse_args()
+
+    get_flow(args)
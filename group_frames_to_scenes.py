@@ -1,16 +1,15 @@
 from __future__ import print_function
 import shutil
-import numpy as np
 import argparse
 import glob
 import os
 import math
-import cv2
 from random import shuffle
 from shutil import copyfile
 import json
+from joblib import Parallel, delayed
 
-from helper.helpers import processShotFile, createDir, truncate
+from helper.helpers import processShotFile, createDir, truncate, materialize
 
 
 def get_chapter_scene_times(sceneCutList, chapterTimingList, validChapters):
@@ -99,7 +98,7 @@ def get_chapter_scene_frames(video, validChapters, chapterSceneTimes):
     return chapterSceneFrames
 
 
-def create_scene_folder_structure(videoName, chapterSceneFrames):
+def create_scene_folder_structure(videoName, chapterSceneFrames, mode="copy"):
     for chapter, sceneFrames in chapterSceneFrames.items():
         inPath = os.path.join(
             args.baseDir, "sbs_frames/image_left/", videoName, chapter)
@@ -115,13 +114,70 @@ def create_scene_folder_structure(videoName, chapterSceneFrames):
                     inPath, "out{}.jpg".format(str(frame).zfill(8)))
                 outImage = os.path.join(
                     out, "out{}.jpg".format(str(frame).zfill(8)))
-                shutil.copy(inImage, outImage)
+                materialize(inImage, outImage, mode)
+
+
+def process_video(args, video):
+    videoNameSplit = video.split("/")
+    videoName = videoNameSplit[-2]
+    print("processing " + videoName)
+    print("")
+
+    chapterTimingList = []
+    with open(video + args.chapterTiming, "r") as fp:
+        timingListTmp = fp.read().splitlines()
+        for timingLine in timingListTmp:
+            chapterTimingList.append(
+                [truncate(float(x), 2) for x in timingLine.split(",")])
+
+    chapterList = glob.glob(video + "log*.txt")
+    numChapters = len(chapterList)
+    validChapters = range(2, numChapters-1)
+
+    # extract the individual scenes
+    sceneCutList = processShotFile(video, "shots.txt")
+
+    # get the individual scenes of belonging to each chapter
+    chapterScenesTimes = get_chapter_scene_times(sceneCutList,
+                                                 chapterTimingList,
+                                                 validChapters)
+    # get the frames belonging the each scene
+    chapterSceneFrames = get_chapter_scene_frames(video,
+                                                  validChapters,
+                                                  chapterScenesTimes)
+
+    outFile = os.path.join(args.baseDir,
+                           "sbs_frames/image_meta/",
+                           videoName, "sceneFramesRaw.json")
+
+    max = 0
+    num = 0
+    total = 0
+    name = ""
+    for keys in chapterSceneFrames.keys():
+        for k in chapterSceneFrames[keys].keys():
+            total += 1
+            if len(chapterSceneFrames[keys][k]) > max:
+                max = len(chapterSceneFrames[keys][k])
+                name = keys + "  " + k
+            if len(chapterSceneFrames[keys][k])/24 > 1:
+                num += 1
+    print(max/24)
+    print(num)
+    print(total)
+    print(name)
+
+    with open(outFile, "w+") as fp:
+        json.dump(chapterSceneFrames, fp, indent=True)
+
+    #create_scene_folder_structure(videoName, chapterSceneFrames)
 
 
 def run(args):
     path = os.path.join(args.baseDir, "sbs_frames/image_meta/")
     videoList = glob.glob(path + "*/")
 
+    selectedVideos = []
     for video in videoList:
         videoNameSplit = video.split("/")
         videoName = videoNameSplit[-2]
@@ -131,57 +187,11 @@ def run(args):
         if args.whitelist != "-1" and videoName not in args.whitelist:
             print(videoName + " not on whitelist")
             continue
-        print("processing " + videoName)
-        print("")
-
-        chapterTimingList = []
-        with open(video + args.chapterTiming, "r") as fp:
-            timingListTmp = fp.read().splitlines()
-            for timingLine in timingListTmp:
-                chapterTimingList.append(
-                    [truncate(float(x), 2) for x in timingLine.split(",")])
-
-        chapterList = glob.glob(video + "log*.txt")
-        numChapters = len(chapterList)
-        validChapters = range(2, numChapters-1)
-
-        # extract the individual scenes
-        sceneCutList = processShotFile(video, "shots.txt")
-
-        # get the individual scenes of belonging to each chapter
-        chapterScenesTimes = get_chapter_scene_times(sceneCutList,
-                                                     chapterTimingList,
-                                                     validChapters)
-        # get the frames belonging the each scene
-        chapterSceneFrames = get_chapter_scene_frames(video,
-                                                      validChapters,
-                                                      chapterScenesTimes)
-
-        outFile = os.path.join(args.baseDir,
-                               "sbs_frames/image_meta/",
-                               videoName, "sceneFramesRaw.json")
-        
-        max = 0
-        num = 0
-        total = 0
-        name = ""
-        for keys in chapterSceneFrames.keys():
-            for k in chapterSceneFrames[keys].keys():
-                total += 1
-                if len(chapterSceneFrames[keys][k]) > max:
-                    max = len(chapterSceneFrames[keys][k])
-                    name = keys + "  " + k
-                if len(chapterSceneFrames[keys][k])/24 > 1:
-                    num += 1
-        print(max/24)
-        print(num)
-        print(total)
-        print(name)
-
-        with open(outFile, "w+") as fp:
-            json.dump(chapterSceneFrames, fp, indent=True)
-
-        #create_scene_folder_structure(videoName, chapterSceneFrames)
+        selectedVideos.append(video)
+
+    # the videos are independent of each other -> process them in parallel
+    Parallel(n_jobs=args.jobs)(
+        delayed(process_video)(args, video) for video in selectedVideos)
 
 
 if __name__ == "__main__":
@@ -208,6 +218,8 @@ if __name__ == "__main__":
         help="specifies list of selected videos, if not set all videos are selected",
         default="-1",
     )
+    parser.add_argument("--jobs", type=int,
+                        help="number of videos to process in parallel", default=1)
 
     args = parser.parse_args()
 
@@ -0,0 +1,92 @@
+"""
+    Split a movie into segments at the chapters for the parallel conversion of convertToSbs.sh.
+
+    A segment starts at the first keyframe at or after the start of a chapter, so
+    every segment can be decoded on its own (GOP-safe). The keyframes are read from
+    the packets of the mvc video (ffprobe -show_entries packet=pts_time,flags -of csv=p=0),
+    without packets (stand-in decoder) every frame is a keyframe.
+
+    One line per segment is printed:
+        index first_frame end_frame start_timestamp end_timestamp
+    (frames [first_frame, end_frame) of the movie, the timestamps in the format of
+    mkvmerge --split parts:, the end timestamp of the last segment is empty).
+"""
+import math
+import argparse
+
+
+def read_chapters(filename):
+    with open(filename, "r") as fp:
+        return [tuple(float(x) for x in line.split(",")) for line in fp.read().splitlines() if line]
+
+
+def read_packets(filename):
+    """Presentation times of all frames (sorted) and the indices of the keyframes"""
+    packets = []
+    with open(filename, "r") as fp:
+        for line in fp:
+            cols = line.strip().split(",")
+            if len(cols) < 2 or cols[0] in ["", "N/A"]:
+                continue
+            packets.append((float(cols[0]), "K" in cols[1]))
+    packets.sort()
+    times = [t for t, _ in packets]
+    keyframes = [i for i, (_, key) in enumerate(packets) if key]
+    return times, keyframes
+
+
+def first_frame(t, fps):
+    """Index of the first frame at or after the time t"""
+    return max(int(math.ceil(t * fps - 1e-6)), 0)
+
+
+def timestamp(t):
+    hours, rest = divmod(t, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return "{:02d}:{:02d}:{:012.9f}".format(int(hours), int(minutes), seconds)
+
+
+def get_segments(chapters, fps, times=None, keyframes=None):
+    """Segments (first frame, end frame) starting at the first keyframe of every chapter"""
+    if times is None:
+        num_frames = first_frame(chapters[-1][1], fps)
+        keyframes = range(num_frames)
+    else:
+        num_frames = len(times)
+
+    boundaries = [0]
+    k = 0
+    for start, _ in chapters[1:]:
+        frame = first_frame(start, fps)
+        while k < len(keyframes) and keyframes[k] < frame:
+            k += 1
+        if k == len(keyframes) or keyframes[k] >= num_frames:
+            break
+        if keyframes[k] > boundaries[-1]:
+            boundaries.append(keyframes[k])
+
+    return list(zip(boundaries, boundaries[1:] + [num_frames]))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="split a movie into segments at the first keyframe of every chapter")
+    parser.add_argument("--chapters", type=str, required=True, help="chapter timing file (chapters.txt)")
+    parser.add_argument("--packets", type=str, default="",
+                        help="packets of the video (csv pts_time,flags of ffprobe), every frame is a keyframe if \
+                              not given")
+    parser.add_argument("--fps", type=str, default="24000/1001", help="frame rate of the movie")
+
+    args = parser.parse_args()
+
+    fps_num, fps_den = (int(x) for x in args.fps.split("/"))
+    fps = fps_num / fps_den
+    times, keyframes = read_packets(args.packets) if args.packets else (None, None)
+    segments = get_segments(read_chapters(args.chapters), fps, times, keyframes)
+
+    for i, (first, end) in enumerate(segments):
+        start_time = times[first] if times is not None else first / fps
+        end_time = ""
+        if i + 1 < len(segments):
+            end_time = timestamp(times[end] if times is not None else end / fps)
+        print(f"{i + 1} {first} {end} {timestamp(start_time)} {end_time}")
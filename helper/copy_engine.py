@@ -0,0 +1,127 @@
+"""
+    Concurrent copy engine used by the helper scripts.
+
+    Copying (and linking) files releases the GIL, so a pool of threads keeps
+    multiple requests in flight, which is much faster than serial copies on
+    network file systems. Missing files and other errors are collected and
+    reported at the end instead of aborting the whole run.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+
+from helpers import materialize
+from metrics import get_metrics, timed_call
+
+
+def copy_file(src, dst, mode, retries):
+    """Materialize a single file and retry on errors other than a missing source
+
+    Returns the number of bytes of the file and the used materialize mode.
+    """
+    for attempt in range(retries + 1):
+        try:
+            used_mode = materialize(src, dst, mode)
+            return os.path.getsize(src), used_mode
+        except FileNotFoundError:
+            raise
+        except OSError:
+            if attempt == retries:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def copy_files(jobs, mode="copy", num_threads=8, queue_depth=64, retries=2, desc="Copying"):
+    """Copy all the (src, dst) pairs of jobs with a pool of threads
+
+    At most queue_depth copies are submitted at the same time. Returns the list of
+    copied (src, dst) pairs, the list of missing source files and a list of
+    (src, dst, error) for all other failures. The lists keep the order of jobs.
+    """
+    jobs = list(jobs)
+    done = [None] * len(jobs)
+    missing = []
+    failed = []
+
+    num_bytes = 0
+    start_time = time.time()
+    metrics = get_metrics("copy", workers=num_threads, total=len(jobs), mode=mode)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor, \
+            tqdm(total=len(jobs), desc=desc) as progress:
+        pending = {}
+        job_iter = iter(enumerate(jobs))
+
+        while True:
+            # keep the queue filled
+            for i, (src, dst) in job_iter:
+                pending[executor.submit(timed_call, copy_file, src, dst, mode, retries)] = i
+                if len(pending) >= queue_depth:
+                    break
+
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = pending.pop(future)
+                src, dst = jobs[i]
+                try:
+                    (size, used_mode), seconds = future.result()
+                    num_bytes += size
+                    done[i] = (src, dst)
+                    metrics.add(frames=1, bytes_read=size if used_mode == "copy" else 0,
+                                bytes_written=size if used_mode == "copy" else 0, busy=seconds)
+                except FileNotFoundError:
+                    missing.append((i, src))
+                    metrics.failure("file not found")
+                except OSError as e:
+                    failed.append((i, src, dst, e))
+                    metrics.failure(type(e).__name__)
+                progress.update(1)
+
+    duration = max(time.time() - start_time, 1e-6)
+    print(f"Copied {len(jobs) - len(missing) - len(failed)} of {len(jobs)} files "
+          f"({num_bytes / 2**20:.1f} MB) in {duration:.1f}s - "
+          f"{len(jobs) / duration:.1f} files/s, {num_bytes / 2**20 / duration:.1f} MB/s")
+
+    metrics.close()
+
+    done = [d for d in done if d is not None]
+    missing = [src for _, src in sorted(missing)]
+    failed = [(src, dst, e) for _, src, dst, e in sorted(failed, key=lambda f: f[0])]
+
+    return done, missing, failed
+
+
+def create_dirs(dirs, num_threads=8):
+    """Create all the given folders with a pool of threads"""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(lambda d: os.makedirs(d, exist_ok=True), dirs))
+    print(f"Created {len(dirs)} folders")
+
+
+def report_errors(missing, failed, report_file=None):
+    """Print (and optionally write to report_file) all files that could not be copied"""
+    if not missing and not failed:
+        return
+
+    lines = []
+    if missing:
+        lines.append(f"# {len(missing)} files were not found")
+        lines += missing
+    if failed:
+        lines.append(f"# {len(failed)} files could not be copied")
+        lines += [f"{src} {dst} {e}" for src, dst, e in failed]
+
+    print("")
+    for line in lines:
+        print(line)
+    print("")
+
+    if report_file is not None:
+        with open(report_file, "w") as fp:
+            for line in lines:
+                fp.write(line + "\n")
+        print(f"Wrote list of files with errors to {report_file}")
@@ -1,99 +1,138 @@
 import os
 import argparse
-from tqdm import tqdm
 import shutil
-import pandas as pd
+import numpy as np
 
-from helpers import createDir
+from helpers import createDir, silentremove, MATERIALIZE_MODES
+from copy_engine import copy_files, create_dirs, report_errors
+from manifest import manifest_is_current, load_manifest, get_manifest_files, frame_path, out_name, \
+    parse_frame_path
+from layout import LAYOUTS, get_layout, save_layout, frame_file
 
 
-def copy_images(args, rel_path, out_name):
+def get_image_jobs(args, rel_path, out_name):
+    """Get the (src, dst) pairs of the left and right image of a frame"""
 
     inPathLeft = os.path.join(
         args.baseDir, "sbs_frames", "image_left", rel_path + ".jpg")
     inPathRight = os.path.join(
         args.baseDir, "sbs_frames", "image_right", rel_path + ".jpg")
-    outPathLeft = os.path.join(
-        args.outDir, "image_left", out_name + ".jpg")
-    outPathRight = os.path.join(
-        args.outDir, "image_right", out_name + ".jpg")
+    outPathLeft = frame_file(
+        os.path.join(args.outDir, "image_left"), out_name + ".jpg", args.layout)
+    outPathRight = frame_file(
+        os.path.join(args.outDir, "image_right"), out_name + ".jpg", args.layout)
 
-    try:
-        shutil.copy(inPathLeft, outPathLeft)
-    except OSError as e:
-        return e
+    return [(inPathLeft, outPathLeft), (inPathRight, outPathRight)]
 
-    try:
-        shutil.copy(inPathRight, outPathRight)
-    except OSError as e:
-        return e
 
-    return None
+def copy_images(args, jobs):
+    """Copy all images with the copy engine and report the files that could not be copied"""
 
+    # subfolders of the sharded layout
+    if args.layout["layout"] != "flat":
+        create_dirs(sorted(set(os.path.dirname(dst) for _, dst in jobs)), args.numThreads)
 
-def create_sequence_data_set(args):
+    done, missing, failed = copy_files(jobs, args.materialize, args.numThreads,
+                                       args.queueDepth, args.retries)
 
-    dataFile = os.path.join(args.baseDir, "sbs_frames", "image_meta", args.name + ".csv")
+    # store the original of every file, so later stages can resolve it
+    with open(os.path.join(args.outDir, "meta", "materialize_log.txt"), "w") as mapping_log:
+        mapping_log.write(f"# materialize: {args.materialize}\n")
+        for src, dst in done:
+            mapping_log.write(os.path.relpath(dst, args.outDir) + " " + os.path.realpath(src) + "\n")
 
-    data = pd.read_csv(dataFile, delimiter=",", header=None)
+    report_errors(missing, failed, os.path.join(args.outDir, "meta", "copy_error_log.txt"))
 
-    paths = data.iloc[:, 2].values
-    out_names = data.iloc[:, 4].values
+    return missing, failed
 
-    print(f"Copying dataset of size: {paths.shape[0]}")
 
-    files_with_error = []
+def copy_manifest(args, manifestFile, useManifest):
+    """Copy the manifest (if it was used) into the meta folder for the later stages"""
+    for f in get_manifest_files(manifestFile):
+        # remove a manifest of a previous run that does not match the data set anymore
+        silentremove(os.path.join(args.outDir, "meta", os.path.basename(f)))
+    if useManifest:
+        for f in get_manifest_files(manifestFile):
+            shutil.copy(f, os.path.join(args.outDir, "meta", os.path.basename(f)))
 
-    for path, out_name in tqdm(zip(paths, out_names), total=paths.shape[0]):
 
-        error = copy_images(args, path, out_name)
+def create_sequence_data_set(args):
 
-        if error is not None:
-            print("")
-            print(error)
-            print(f"The file {path} does not exist. Skipping ...")
-            files_with_error.append(path)
+    dataFile = os.path.join(args.baseDir, "sbs_frames", "image_meta", args.name + ".csv")
+    manifestFile = os.path.join(args.baseDir, "sbs_frames", "image_meta", args.name + ".manifest")
+
+    useManifest = manifest_is_current(manifestFile, dataFile)
+    if useManifest:
+        readFile = manifestFile
+        records, strings = load_manifest(manifestFile)
+        paths = np.array([frame_path(r, strings, prefix="", suffix="") for r in records])
+        out_names = np.array([out_name(r) for r in records])
+    else:
+        # pandas is only needed without manifest (slow import)
+        import pandas as pd
+        readFile = dataFile
+        data = pd.read_csv(dataFile, delimiter=",", header=None)
 
-    print("Done copying files!")
-    print("The following files were not found ...")
-    print("")
-    for file in files_with_error:
-        print(file)
+        paths = data.iloc[:, 2].values
+        out_names = data.iloc[:, 4].values
+
+    print(f"Copying dataset of size: {paths.shape[0]}")
 
-    print("")
-    print(f"Remove these files from {dataFile}")
+    jobs = []
+    for path, outName in zip(paths, out_names):
+        jobs += get_image_jobs(args, path, outName)
+
+    missing, failed = copy_images(args, jobs)
+
+    print("Done copying files!")
+    if missing or failed:
+        print(f"Remove the frames of these files from {readFile}")
 
     shutil.copy(dataFile, os.path.join(args.outDir, "meta", args.name + ".csv"))
+    copy_manifest(args, manifestFile, useManifest)
 
 
 def create_paper_data_set(args):
 
     dataFile = os.path.join(args.baseDir, "sbs_frames",
                             "image_meta", args.name + ".txt")
+    manifestFile = os.path.join(args.baseDir, "sbs_frames",
+                                "image_meta", args.name + ".manifest")
     logFile = os.path.join(args.outDir, "meta", "image_mapping_log.txt")
 
-    # Just count the number of lines in order to see how many images need to copied
-    counter = 0
-    with open(dataFile, "r") as f:
-
-        for _ in f:
-            counter += 1
-    print(f"Copying dataset of size: {counter}")
-
-    with open(dataFile, "r") as f, open(logFile, "w+") as l:
+    # list of the frame paths (relative to image_left/image_right) and the frame
+    # names written to the mapping log
+    frames = []
 
-        for i, line in tqdm(enumerate(f), total=(counter)):
-            line = line.rstrip()
-            if not line:
-                continue
-
-            outName = "out" + str(i).zfill(8)
-
-            copy_images(args, line, outName)
+    useManifest = manifest_is_current(manifestFile, dataFile)
+    if useManifest:
+        records, strings = load_manifest(manifestFile)
+        for r in records:
+            frames.append((frame_path(r, strings, prefix="", suffix=""), frame_path(r, strings), out_name(r)))
+    else:
+        with open(dataFile, "r") as f:
+            for i, line in enumerate(f):
+                line = line.rstrip()
+                if not line:
+                    continue
+                # path relative to image_left/image_right without file ending (as from the manifest)
+                _, video, chapter, frame, _ = parse_frame_path(line)
+                rel_path = video + "/chapter" + str(chapter) + "/out" + str(frame).zfill(8)
+                frames.append((rel_path, line, "out" + str(i).zfill(8)))
+
+    print(f"Copying dataset of size: {len(frames)}")
+
+    jobs = []
+    with open(logFile, "w+") as l:
+        for rel_path, line, outName in frames:
+            jobs += get_image_jobs(args, rel_path, outName)
 
             # wirte to log file the mapping of the old image name to the new name
             l.write(line + " " + outName + "\n")
 
+    copy_images(args, jobs)
+    copy_manifest(args, manifestFile, useManifest)
+
 
 def run(args):
 
@@ -101,6 +140,7 @@ def run(args):
     createDir(os.path.join(args.outDir, "image_left"))
     createDir(os.path.join(args.outDir, "image_right"))
     createDir(os.path.join(args.outDir, "meta"))
+    save_layout(args.outDir, args.layout)
 
     if args.sequence:
         create_sequence_data_set(args)
@@ -120,7 +160,20 @@ if __name__ == '__main__':
                         help="name of the output folder")
     parser.add_argument("--sequence", type=bool, default=False,
                         help="true if the data set is a sequence data set (see README)")
+    parser.add_argument("--materialize", type=str, choices=MATERIALIZE_MODES, default="copy",
+                        help="how to create the images in the data set (copy, hardlink, reflink or symlink). \
+                              Falls back to the next possible mode if not supported by the file system")
+    parser.add_argument("--numThreads", type=int, default=16,
+                        help="number of threads copying the images")
+    parser.add_argument("--queueDepth", type=int, default=64,
+                        help="maximum number of copies in flight")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="number of retries if copying a file fails (missing files are not retried)")
+    parser.add_argument("--layout", type=str, choices=LAYOUTS, default="flat",
+                        help="directory layout of the per frame folders (sharded: subfolders of 10000 frames, \
+                              see helper/layout.py)")
 
     args = parser.parse_args()
+    args.layout = get_layout(args.layout)
 
     run(args)
@@ -0,0 +1,199 @@
+"""
+    Remove near-duplicate frames from a data set before computing the optical flow.
+
+    Static shots produce many nearly identical frames. For every left image a
+    perceptual difference hash (dHash) is computed on a low resolution version
+    of the image. Inside every scene (or sequence) a frame is dropped if the
+    hamming distance of its hash to an already kept frame is at most
+    --max_distance.
+
+    The kept frames are written to meta/dedup_list.txt and the dropped frames
+    (together with the kept frame they duplicate) to meta/dedup_log.txt.
+    With --remove the dropped images are moved into the folder duplicates/.
+"""
+import os
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+from tqdm import tqdm
+from joblib import Parallel, delayed
+
+from helpers import createDir, update_materialize_log
+from manifest import manifest_exists, load_manifest, out_name, parse_frame_path
+from layout import load_layout, frame_file, list_frame_files
+
+
+def dhash(filename, hash_size=8):
+    """Compute the difference hash of an image (hash_size * hash_size bits packed into bytes)
+
+    The jpeg is decoded with a reduced resolution (1/8), which is much faster than
+    decoding the full image.
+    """
+    image = cv2.imread(filename, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hash_images(filenames, hash_size):
+    return [dhash(f, hash_size) for f in filenames]
+
+
+# number of set bits of every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+
+def hamming_distance(h, hashes):
+    return POPCOUNT[np.bitwise_xor(hashes, h)].sum(axis=1)
+
+
+def get_groups(args):
+    """Get the frames (names inside the data set) of every scene/sequence
+
+    The grouping is taken from the manifest of the data set. If it does not
+    exist the frames are grouped by their chapter (from image_mapping_log.txt).
+    """
+    groups = {}
+    manifest_file = os.path.join(args.baseDir, "meta", args.name + ".manifest")
+    mapping_file = os.path.join(args.baseDir, "meta", "image_mapping_log.txt")
+
+    if manifest_exists(manifest_file):
+        records, _ = load_manifest(manifest_file)
+        for r in records:
+            if r["scene"] >= 0:
+                key = (r["video"], r["chapter"], r["scene"])
+            elif r["sequence"] >= 0:
+                key = (r["video"], r["sequence"])
+            else:
+                key = (r["video"], r["chapter"])
+            groups.setdefault(key, []).append(out_name(r))
+    elif os.path.exists(mapping_file):
+        print(f"Manifest {manifest_file} not found. Grouping frames by chapter ...")
+        with open(mapping_file, "r") as fp:
+            for line in fp:
+                path, name = line.split()
+                _, video, chapter, _, _ = parse_frame_path(path)
+                groups.setdefault((video, chapter), []).append(name)
+    else:
+        print("Neither manifest nor image mapping log found. Using all frames as a single group ...")
+        names = sorted(os.path.basename(f)[:-len(".jpg")]
+                       for f in list_frame_files(os.path.join(args.baseDir, "image_left"), ".jpg"))
+        groups[0] = names
+
+    return groups
+
+
+def dedup_group(names, hashes, max_distance):
+    """Greedily keep the frames of a group (in temporal order) that are not close to a kept frame
+
+    Returns the kept names and a list of (removed name, kept name, distance).
+    """
+    kept = []
+    removed = []
+
+    # hashes of the kept frames in a preallocated array (frames that could not be
+    # read are kept - later stages will report them)
+    valid = [h for h in hashes if h is not None]
+    if not valid:
+        return list(names), removed
+    kept_hashes = np.empty((len(valid), len(valid[0])), dtype=np.uint8)
+    kept_hash_names = []
+
+    for name, h in zip(names, hashes):
+        num_kept = len(kept_hash_names)
+        if h is not None and num_kept:
+            distances = hamming_distance(h, kept_hashes[:num_kept])
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= max_distance:
+                removed.append((name, kept_hash_names[nearest], int(distances[nearest])))
+                continue
+
+        kept.append(name)
+        if h is not None:
+            kept_hashes[num_kept] = h
+            kept_hash_names.append(name)
+
+    return kept, removed
+
+
+def move_duplicates(args, removed):
+    # the materialize log keeps the originals of the moved (linked) images
+    moved = {}
+    for folder in ["image_left", "image_right"]:
+        out_folder = os.path.join(args.baseDir, "duplicates", folder)
+        createDir(out_folder, verbose=False)
+        for name, _, _ in removed:
+            src = frame_file(os.path.join(args.baseDir, folder), name + ".jpg", load_layout(args.baseDir))
+            if os.path.exists(src):
+                os.replace(src, os.path.join(out_folder, name + ".jpg"))
+                moved[src] = os.path.join(out_folder, name + ".jpg")
+    update_materialize_log(args.baseDir, moved)
+
+
+def run(args):
+
+    groups = get_groups(args)
+    names = [name for group in groups.values() for name in group]
+    filenames = [frame_file(os.path.join(args.baseDir, "image_left"), name + ".jpg", load_layout(args.baseDir))
+                 for name in names]
+
+    num_cores = min(args.numCores, multiprocessing.cpu_count())
+    print(f"Hashing {len(filenames)} images on {num_cores} cores ...")
+
+    # hash the images in chunks to reduce the overhead of the workers
+    chunk_size = 256
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    hashes = Parallel(n_jobs=num_cores)(
+        delayed(hash_images)(chunk, args.hash_size) for chunk in tqdm(chunks))
+    hashes = dict(zip(names, [h for chunk in hashes for h in chunk]))
+
+    kept = []
+    removed = []
+    for group in groups.values():
+        group_kept, group_removed = dedup_group(group, [hashes[n] for n in group], args.max_distance)
+        kept += group_kept
+        removed += group_removed
+
+    with open(os.path.join(args.baseDir, "meta", "dedup_list.txt"), "w") as fp:
+        for name in kept:
+            fp.write(name + "\n")
+
+    with open(os.path.join(args.baseDir, "meta", "dedup_log.txt"), "w") as fp:
+        fp.write("## Log file for near-duplicate removal\n\n")
+        fp.write(f"# hash_size: {args.hash_size} - size of the difference hash\n")
+        fp.write(f"# max_distance: {args.max_distance} - max hamming distance of duplicates\n\n")
+        for name, kept_name, distance in removed:
+            fp.write(f"{name} {kept_name} {distance}\n")
+        fp.write(f"\nPercentage of removed images: {len(removed) / max(len(names), 1)}")
+
+    print(f"Kept {len(kept)} of {len(names)} frames ({len(removed)} near-duplicates)")
+
+    if args.remove:
+        move_duplicates(args, removed)
+        print(f"Moved the near-duplicates to {os.path.join(args.baseDir, 'duplicates')}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="remove near-duplicate frames of a data set (run after createDataSet.py)")
+
+    parser.add_argument("--baseDir", type=str, required=True,
+                        help="path to folder of the data set (containing image_left, image_right, meta)")
+    parser.add_argument("--name", type=str, default="training",
+                        help="name of the data set (manifest located in meta)")
+    parser.add_argument("--hash_size", type=int, default=8,
+                        help="size of the difference hash (hash_size^2 bits)")
+    parser.add_argument("--max_distance", type=int, default=4,
+                        help="frames with a hamming distance of at most max_distance to a kept frame are dropped")
+    parser.add_argument("--remove", action="store_true",
+                        help="move the near-duplicates into the folder duplicates/")
+    parser.add_argument("--numCores", type=int, default=8,
+                        help="number of cores used to compute the hashes")
+
+    args = parser.parse_args()
+
+    run(args)
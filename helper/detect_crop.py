@@ -0,0 +1,168 @@
+"""
+    Detect the black bars (letterbox / pillarbox) of an sbs movie.
+
+    Frames are sampled over the whole movie (decoded with ffmpeg, or read from a
+    folder of extracted sbs images) and scanned with NumPy: a row / column is part
+    of the picture if enough of its pixels are brighter than the limit in at least
+    one of the sampled frames. The crop is the same for the left and the right
+    view (x is relative to the view), so both views keep the same size. The size
+    is a multiple of --align after removing --margin pixels on every side (soft
+    edges of the bars).
+
+    The crop is stored as json ({"x", "y", "width", "height", "frame_width",
+    "frame_height"}) and can be printed as
+        ffmpeg - filter graph cropping both views while decoding (used by run_extractFrames.sh)
+        split  - w:h:x:y for the option --crop of splitImagesChapters.py
+    If nothing can be detected (e.g. only dark frames) the fixed crop of the
+    paper (--paddingAR 280 --paddingAR_side 40) is used.
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import subprocess
+import numpy as np
+import cv2
+
+
+def probe_video(video):
+    """Get width, height and duration of the video with ffprobe"""
+    out = subprocess.check_output(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height:format=duration",
+         "-of", "default=noprint_wrappers=1", video]).decode()
+    info = dict(line.split("=", 1) for line in out.split())
+    return int(info["width"]), int(info["height"]), float(info["duration"])
+
+
+def decode_frame(video, t, width, height):
+    """Decode the (grayscale) frame at time t"""
+    out = subprocess.check_output(
+        ["ffmpeg", "-v", "error", "-ss", str(t), "-i", video, "-frames:v", "1",
+         "-f", "rawvideo", "-pix_fmt", "gray", "-"])
+    if len(out) < width * height:
+        return None
+    return np.frombuffer(out[:width * height], dtype=np.uint8).reshape(height, width)
+
+
+def sample_video(video, samples):
+    width, height, duration = probe_video(video)
+
+    # skip the beginning and the end (logos, credits)
+    times = np.linspace(0.05 * duration, 0.95 * duration, samples)
+    frames = [decode_frame(video, t, width, height) for t in times]
+    return [f for f in frames if f is not None]
+
+
+def sample_folder(folder, samples):
+    files = sorted(glob.glob(os.path.join(folder, "**", "*.jpg"), recursive=True))
+    if not files:
+        return []
+    idx = np.unique(np.linspace(0, len(files) - 1, samples).astype(int))
+    return [cv2.imread(files[i], cv2.IMREAD_GRAYSCALE) for i in idx]
+
+
+def content_range(bright, min_fraction):
+    """First and last (exclusive) index with more than min_fraction bright pixels"""
+    idx = np.flatnonzero(bright > min_fraction)
+    if idx.size == 0:
+        return None
+    return idx[0], idx[-1] + 1
+
+
+def fixed_crop(frame_width, frame_height, padding_ar=280, padding_ar_side=40):
+    """Crop of splitImagesChapters.py with --paddingAR / --paddingAR_side"""
+    return {"x": padding_ar_side // 2, "y": padding_ar // 2,
+            "width": frame_width // 2 - padding_ar_side, "height": frame_height - padding_ar,
+            "frame_width": frame_width, "frame_height": frame_height, "detected": False}
+
+
+def align_range(start, end, margin, align):
+    start, end = start + margin, end - margin
+    extra = (end - start) % align
+    start += extra // 2
+    return start, end - (extra - extra // 2)
+
+
+def detect_crop(frames, limit=32, min_fraction=0.02, margin=4, align=8):
+    """Detect the crop of the views of the sampled sbs frames (None if nothing is detected)"""
+    if not frames:
+        return None
+
+    bright = np.max(np.stack(frames), axis=0) > limit
+    frame_height, frame_width = bright.shape
+    view_width = frame_width // 2
+
+    rows = content_range(bright.mean(axis=1), min_fraction)
+    cols_left = content_range(bright[:, :view_width].mean(axis=0), min_fraction)
+    cols_right = content_range(bright[:, view_width:2 * view_width].mean(axis=0), min_fraction)
+    if rows is None or cols_left is None or cols_right is None:
+        return None
+
+    # same crop for both views - remove the bars of both
+    y0, y1 = align_range(rows[0], rows[1], margin, align)
+    x0, x1 = align_range(max(cols_left[0], cols_right[0]), min(cols_left[1], cols_right[1]), margin, align)
+    if x1 - x0 < align or y1 - y0 < align:
+        return None
+
+    return {"x": int(x0), "y": int(y0), "width": int(x1 - x0), "height": int(y1 - y0),
+            "frame_width": frame_width, "frame_height": frame_height, "detected": True}
+
+
+def ffmpeg_filter(crop):
+    """Filter graph cropping the left and right view while decoding (and logging the frames)"""
+    c = crop
+    x_right = c["frame_width"] // 2 + c["x"]
+    return (f"split[a][b];[a]crop={c['width']}:{c['height']}:{c['x']}:{c['y']}[l];"
+            f"[b]crop={c['width']}:{c['height']}:{x_right}:{c['y']}[r];[l][r]hstack,showinfo")
+
+
+def load_crop(filename):
+    with open(filename, "r") as fp:
+        return json.load(fp)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="detect the black bars of an sbs movie on sampled frames")
+    parser.add_argument("--video", type=str, default="", help="sbs video (decoded with ffmpeg)")
+    parser.add_argument("--frames", type=str, default="", help="folder of extracted sbs images (instead of --video)")
+    parser.add_argument("--samples", type=int, default=24, help="number of sampled frames")
+    parser.add_argument("--limit", type=int, default=32, help="pixels brighter than the limit are picture")
+    parser.add_argument("--minFraction", type=float, default=0.02,
+                        help="minimum fraction of bright pixels of a row / column of the picture")
+    parser.add_argument("--margin", type=int, default=4, help="pixels removed additionally on every side")
+    parser.add_argument("--align", type=int, default=8, help="width and height are a multiple of align")
+    parser.add_argument("--out", type=str, default="", help="json file the crop is written to")
+    parser.add_argument("--print", type=str, default="", choices=["", "ffmpeg", "split"],
+                        help="print the crop as ffmpeg filter graph or w:h:x:y for splitImagesChapters.py")
+
+    args = parser.parse_args()
+
+    if args.video:
+        frames = sample_video(args.video, args.samples)
+    else:
+        frames = sample_folder(args.frames, args.samples)
+        if not frames:
+            sys.exit(f"No images found in {args.frames}")
+
+    crop = detect_crop(frames, args.limit, args.minFraction, args.margin, args.align)
+    if crop is None:
+        if args.video:
+            width, height, _ = probe_video(args.video)
+        else:
+            height, width = frames[0].shape
+        crop = fixed_crop(width, height)
+        print(f"No crop detected - using the fixed crop {crop}", file=sys.stderr)
+    else:
+        print(f"Detected crop {crop['width']}x{crop['height']} at {crop['x']},{crop['y']} "
+              f"(on {len(frames)} frames)", file=sys.stderr)
+
+    if args.out:
+        with open(args.out, "w") as fp:
+            json.dump(crop, fp, indent=True)
+
+    if args.print == "ffmpeg":
+        print(ffmpeg_filter(crop))
+    elif args.print == "split":
+        print("{width}:{height}:{x}:{y}".format(**crop))
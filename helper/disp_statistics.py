@@ -0,0 +1,221 @@
+"""
+    Statistics of the disparity and uncertainty maps computed while they are generated.
+
+    Every worker computes the statistics of its frame (frame_statistics) and the main
+    process merges them into a DatasetStatistics while the results come in, so no second
+    pass over the written images is needed. The disparity distribution is kept in a
+    HistogramSketch: a sparse histogram with a fixed bin width, which can be merged
+    exactly across workers, runs and data sets.
+
+    The result is written to meta/disp_stats.json:
+        frames          - number of processed / kept frames
+        filtered        - number of frames per filter reason
+        disparity       - histogram sketch, min, max and percentiles (in pixels)
+        uncertainty     - histogram (bins of 0.1 pixels, as saved in the png) and percentiles
+        sky_fraction    - mean fraction of sky pixels of the kept frames
+        movies / scenes - disparity range (min, max, p1, p99) and number of frames
+"""
+import os
+import glob
+import json
+import numpy as np
+
+from helper.manifest import load_manifest, out_name
+
+
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+
+class HistogramSketch:
+    """Sparse histogram with a fixed bin width (mergeable)"""
+
+    def __init__(self, bin_width=0.1):
+        self.bin_width = bin_width
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        if values.size == 0:
+            return
+        bins = np.floor(values / self.bin_width).astype(np.int64)
+        low = bins.min()
+        self.add_counts(low, np.bincount(bins - low))
+
+    def add_counts(self, offset, counts):
+        """Add the counts of the bins offset, offset + 1, ..."""
+        if self.counts.size == 0:
+            self.offset, self.counts = int(offset), counts.astype(np.int64)
+            return
+
+        start = min(self.offset, offset)
+        end = max(self.offset + self.counts.size, offset + counts.size)
+        merged = np.zeros(end - start, dtype=np.int64)
+        merged[self.offset - start:self.offset - start + self.counts.size] += self.counts
+        merged[offset - start:offset - start + counts.size] += counts
+        self.offset, self.counts = int(start), merged
+
+    def merge(self, other):
+        assert self.bin_width == other.bin_width, "sketches with different bin width can not be merged"
+        if other.counts.size:
+            self.add_counts(other.offset, other.counts)
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def percentiles(self, qs=PERCENTILES):
+        """Percentiles (center of the bin) - the error is at most half the bin width"""
+        cumsum = np.cumsum(self.counts)
+        idx = np.searchsorted(cumsum, np.asarray(qs) / 100 * cumsum[-1])
+        idx = np.minimum(idx, self.counts.size - 1)
+        return {str(q): round(float((self.offset + i + 0.5) * self.bin_width), 6) for q, i in zip(qs, idx)}
+
+    def to_dict(self):
+        nonzero = np.flatnonzero(self.counts)
+        if nonzero.size == 0:
+            return {"bin_width": self.bin_width, "offset": 0, "counts": []}
+        counts = self.counts[nonzero[0]:nonzero[-1] + 1]
+        return {"bin_width": self.bin_width, "offset": int(self.offset + nonzero[0]), "counts": counts.tolist()}
+
+    @staticmethod
+    def from_dict(d):
+        sketch = HistogramSketch(d["bin_width"])
+        if d["counts"]:
+            sketch.add_counts(d["offset"], np.array(d["counts"], dtype=np.int64))
+        return sketch
+
+
+def frame_statistics(name, disp, uncertainty, quantization, sky_seg_idx=None, bin_width=0.1):
+    """Statistics of a single (quantized) frame - computed by the workers"""
+    disp = quantization["offset"] + quantization["scale"] * disp.astype(np.float64)
+
+    sketch = HistogramSketch(bin_width)
+    sketch.add(disp)
+
+    if sky_seg_idx is not None:
+        sky_fraction = np.count_nonzero(sky_seg_idx) / np.size(sky_seg_idx)
+    else:
+        sky_fraction = 0.0
+
+    low, high = sketch.percentiles([1, 99]).values()
+
+    return {
+        "name": name,
+        "disparity": sketch,
+        "uncertainty": np.bincount(uncertainty.ravel(), minlength=256),
+        "sky_fraction": sky_fraction,
+        "range": [float(disp.min()), float(disp.max()), float(low), float(high)],
+    }
+
+
+def find_manifest(path):
+    """Get the manifest in the meta folder of the data set (None if there is not exactly one)"""
+    files = glob.glob(os.path.join(path, "meta", "*.manifest.npy"))
+    if len(files) != 1:
+        return None
+    return files[0][:-len(".npy")]
+
+
+def get_frame_groups(path):
+    """Map the names of the frames to (video, scene key) using the manifest of the data set"""
+    manifest_file = find_manifest(path)
+    if manifest_file is None:
+        return {}
+
+    records, strings = load_manifest(manifest_file)
+    groups = {}
+    for r in records:
+        video = strings["videos"][r["video"]]
+        if r["scene"] >= 0:
+            scene = "{}/chapter{}/scene{}".format(video, r["chapter"], r["scene"])
+        elif r["sequence"] >= 0:
+            scene = "{}/seq{}".format(video, str(r["sequence"]).zfill(8))
+        else:
+            scene = "{}/chapter{}".format(video, r["chapter"])
+        groups[out_name(r)] = (video, scene)
+    return groups
+
+
+def merge_range(ranges, key, frame_range):
+    r = ranges.setdefault(key, {"frames": 0, "min": np.inf, "max": -np.inf, "p1": np.inf, "p99": -np.inf})
+    r["frames"] += 1
+    r["min"] = min(r["min"], frame_range[0])
+    r["max"] = max(r["max"], frame_range[1])
+    r["p1"] = min(r["p1"], frame_range[2])
+    r["p99"] = max(r["p99"], frame_range[3])
+
+
+class DatasetStatistics:
+    """Merge the statistics of the frames (in the main process)"""
+
+    def __init__(self, path, bin_width=0.1):
+        self.groups = get_frame_groups(path)
+        self.disparity = HistogramSketch(bin_width)
+        self.uncertainty = np.zeros(256, dtype=np.int64)
+        self.sky_fraction = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.frames = 0
+        self.kept = 0
+        self.filtered = {}
+        self.movies = {}
+        self.scenes = {}
+
+    def add_filtered(self, reason):
+        self.frames += 1
+        self.filtered[reason] = self.filtered.get(reason, 0) + 1
+
+    def add(self, stats):
+        self.frames += 1
+        self.kept += 1
+        self.disparity.merge(stats["disparity"])
+        self.uncertainty += stats["uncertainty"]
+        self.sky_fraction += stats["sky_fraction"]
+        self.min = min(self.min, stats["range"][0])
+        self.max = max(self.max, stats["range"][1])
+
+        video, scene = self.groups.get(stats["name"], ("unknown", "unknown"))
+        merge_range(self.movies, video, stats["range"])
+        merge_range(self.scenes, scene, stats["range"])
+
+    def add_result(self, res, stats):
+        """Add the result of a worker ("0" or the filter reason and the frame statistics)"""
+        if res == "0":
+            if stats is not None:
+                self.add(stats)
+        else:
+            # res: "<name> <reason>\n"
+            self.add_filtered(res.strip().split(" ", 1)[-1])
+
+    def to_dict(self):
+        d = {
+            "frames": {"processed": self.frames, "kept": self.kept},
+            "filtered": self.filtered,
+            "sky_fraction": self.sky_fraction / max(self.kept, 1),
+            "movies": self.movies,
+            "scenes": self.scenes,
+        }
+
+        if self.kept:
+            cumsum = np.cumsum(self.uncertainty)
+            unc_percentiles = np.searchsorted(cumsum, np.asarray(PERCENTILES) / 100 * cumsum[-1])
+            d["disparity"] = {
+                "min": self.min,
+                "max": self.max,
+                "percentiles": self.disparity.percentiles(),
+                "sketch": self.disparity.to_dict(),
+            }
+            d["uncertainty"] = {
+                "unit": 0.1,
+                "mean": float(np.dot(np.arange(256), self.uncertainty) / self.uncertainty.sum() / 10),
+                "percentiles": {str(q): v / 10 for q, v in zip(PERCENTILES, unc_percentiles.tolist())},
+                "histogram": self.uncertainty.tolist(),
+            }
+
+        return d
+
+    def save(self, path):
+        filename = os.path.join(path, "meta", "disp_stats.json")
+        with open(filename, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=True)
+        print(f"Wrote statistics of {self.kept} frames to {filename}")
@@ -0,0 +1,387 @@
+"""
+    Extract the frames of an sbs movie directly from the raw output of the MVC decoder.
+
+    Instead of encoding the decoded sbs stream into an intermediate video (x264)
+    and decoding it twice again (scene detection and frame extraction), the raw
+    frames (rawvideo on stdin, e.g. FRIMDecode -o - -sbs) are processed in one pass:
+        - the scene score of every frame is computed as by the select filter of
+          ffmpeg (select=gt(scene,0.1)) and the cuts are written to shots.txt
+          (format of ffprobe -show_frames)
+        - the frames are assigned to the chapters by their timestamp (start <= t < end
+          of chapters.txt) and written to image_raw/<name>/chapterN/out%08d.jpg with
+          the showinfo log logN.txt (as run_extractFrames.sh)
+    The crop is detected on the extracted frames afterwards (run_extractFrames.sh
+    with the source raw).
+
+    Optionally the stream is also encoded into a lossless intermediate
+    sbs_videos/<name>/<name>.mkv (--keep ffv1 or lossless = x264 -preset ultrafast -qp 0).
+    Any process writing rawvideo to stdout can be used as decoder (e.g.
+    helper/synthetic_movie.py --source raw).
+
+    For the parallel conversion (convertToSbs.sh with more than one job) every
+    segment of the movie is extracted with --segment DIR: the frames are written
+    with their index in the segment to DIR/out%08d.jpg together with the frame
+    differences (mafd.npy) and the first and last frame of the segment. --merge
+    DIR then numbers the frames of all segments (DIR/001, DIR/002, ...) in movie
+    order, moves them into the chapters and computes the scene scores (the
+    differences at the segment boundaries are computed from the stored frames),
+    so the result is the same as extracting the whole stream.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import cv2
+
+from metrics import get_metrics
+from chapter_segments import read_chapters
+
+
+PIX_FMTS = {"yuv420p": 1.5, "bgr24": 3}
+
+KEEP_CODECS = {
+    "ffv1": ["-c:v", "ffv1", "-level", "3", "-slices", "16"],
+    "lossless": ["-c:v", "libx264", "-preset", "ultrafast", "-qp", "0"],
+}
+
+
+def frame_size(width, height, pix_fmt):
+    return int(width * height * PIX_FMTS[pix_fmt])
+
+
+def to_bgr(buf, width, height, pix_fmt):
+    if pix_fmt == "yuv420p":
+        return cv2.cvtColor(np.frombuffer(buf, np.uint8).reshape(height * 3 // 2, width), cv2.COLOR_YUV2BGR_I420)
+    return np.frombuffer(buf, np.uint8).reshape(height, width, 3)
+
+
+def read_frame(stream, size):
+    """Read one frame (None at the end of the stream)"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = stream.readinto(view[pos:])
+        if not n:
+            if pos:
+                print(f"Incomplete last frame ({pos} of {size} bytes) ignored", file=sys.stderr)
+            return None
+        pos += n
+    return buf
+
+
+def mafd(frame, prev):
+    """Mean absolute frame difference (all planes)"""
+    return cv2.norm(frame, prev, cv2.NORM_L1) / frame.size
+
+
+def scene_score(mafd, prev_mafd):
+    return min(max(min(mafd, abs(mafd - prev_mafd)) / 100.0, 0.0), 1.0)
+
+
+class SceneDetector:
+    """Scene score of the select filter of ffmpeg (mean absolute frame difference of all planes)"""
+
+    def __init__(self):
+        self.prev = None
+        self.prev_mafd = 0.0
+
+    def score(self, frame):
+        score = 0.0
+        if self.prev is not None:
+            value = mafd(frame, self.prev)
+            score = scene_score(value, self.prev_mafd)
+            self.prev_mafd = value
+        self.prev = frame
+        return score
+
+
+def write_log_line(fp, n, pts_time, width, height):
+    # same fields as the showinfo filter of ffmpeg (parsed by group_frames_to_scenes.py)
+    fp.write(f"[Parsed_showinfo_0 @ 0x0] n:{n:5d} pts:{int(round(pts_time * 1000)):7d} "
+             f"pts_time:{pts_time:<10.6g} pos:-1 fmt:yuvj420p sar:1/1 s:{width}x{height}\n")
+
+
+def write_shot_line(fp, pts_time, score):
+    # same fields as ffprobe -show_frames -of compact=p=0 (parsed by processShotFile)
+    fp.write(f"media_type=video|stream_index=0|key_frame=0|pkt_pts={int(round(pts_time * 1000))}|"
+             f"pkt_pts_time={pts_time:.6f}|lavfi.scene_score={score:.6f}\n")
+
+
+def write_image(filename, buf, width, height, pix_fmt, quality):
+    cv2.imwrite(filename, to_bgr(buf, width, height, pix_fmt), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return os.path.getsize(filename)
+
+
+class ImageWriter:
+    """Encode the jpeg images in threads (OpenCV releases the GIL), at most 2 frames per thread are in flight"""
+
+    def __init__(self, args, width, height, metrics):
+        self.args, self.width, self.height, self.metrics = args, width, height, metrics
+        self.pool = ThreadPoolExecutor(max_workers=args.numCores)
+        self.pending = set()
+        self.written = 0
+
+    def collect(self, futures):
+        for f in futures:
+            self.metrics.add(frames=1, bytes_written=f.result())
+        self.written += len(futures)
+
+    def write(self, filename, buf):
+        self.pending.add(self.pool.submit(write_image, filename, buf, self.width, self.height,
+                                          self.args.pixFmt, self.args.quality))
+        if len(self.pending) >= 2 * self.args.numCores:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            self.collect(done)
+
+    def close(self):
+        self.collect(self.pending)
+        self.pending = set()
+        self.pool.shutdown()
+        return self.written
+
+
+class ChapterWriter:
+    """Assign the frames to the chapters by their timestamp and write the showinfo logs"""
+
+    def __init__(self, chapters, raw_dir, meta_dir, width, height):
+        self.chapters, self.raw_dir, self.width, self.height = chapters, raw_dir, width, height
+        self.logs = []
+        for i in range(len(chapters)):
+            os.makedirs(os.path.join(raw_dir, f"chapter{i + 1}"), exist_ok=True)
+            self.logs.append(open(os.path.join(meta_dir, f"log{i + 1}.txt"), "w"))
+        self.counts = [0] * len(chapters)
+
+    def frame_files(self, t):
+        """File names of the frame at the time t (one per chapter containing t)"""
+        files = []
+        for c, (start, end) in enumerate(self.chapters):
+            if not start <= t < end:
+                continue
+            n = self.counts[c]
+            self.counts[c] += 1
+            write_log_line(self.logs[c], n, t, self.width, self.height)
+            files.append(os.path.join(self.raw_dir, f"chapter{c + 1}", "out{}.jpg".format(str(n + 1).zfill(8))))
+        return files
+
+    def close(self):
+        for fp in self.logs:
+            fp.close()
+
+
+def open_intermediate(filename, keep, width, height, pix_fmt, fps):
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", pix_fmt,
+           "-s:v", f"{width}x{height}", "-r", fps, "-i", "-"] + KEEP_CODECS[keep] + [filename]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+
+def get_dirs(args):
+    return (os.path.join(args.baseDir, "sbs_videos", args.name),
+            os.path.join(args.baseDir, "sbs_frames", "image_raw", args.name),
+            os.path.join(args.baseDir, "sbs_frames", "image_meta", args.name))
+
+
+def extract_stream(args, stream):
+    width, height = (int(x) for x in args.size.split("x"))
+    fps_num, fps_den = (int(x) for x in args.fps.split("/"))
+    size = frame_size(width, height, args.pixFmt)
+
+    video_dir, raw_dir, meta_dir = get_dirs(args)
+    os.makedirs(meta_dir, exist_ok=True)
+
+    chapters = read_chapters(args.chapters or os.path.join(video_dir, "chapters.txt"))
+    chapter_writer = ChapterWriter(chapters, raw_dir, meta_dir, width, height)
+    shots = open(os.path.join(meta_dir, "shots.txt"), "w")
+
+    intermediate = None
+    if args.keep:
+        os.makedirs(video_dir, exist_ok=True)
+        intermediate = open_intermediate(os.path.join(video_dir, args.name + ".mkv"), args.keep,
+                                         width, height, args.pixFmt, args.fps)
+
+    metrics = get_metrics("extract", workers=args.numCores, name=args.name)
+    image_writer = ImageWriter(args, width, height, metrics)
+    detector = SceneDetector()
+    start_time = time.time()
+    num_frames = 0
+
+    buf = read_frame(stream, size)
+    while buf is not None:
+        t = num_frames * fps_den / fps_num
+        num_frames += 1
+
+        # luma and chroma planes like the scene detection of ffmpeg on the decoded video
+        score = detector.score(np.frombuffer(buf, np.uint8))
+        if score > args.sceneThreshold:
+            write_shot_line(shots, t, score)
+
+        if intermediate is not None:
+            intermediate.stdin.write(buf)
+
+        for filename in chapter_writer.frame_files(t):
+            image_writer.write(filename, buf)
+        buf = read_frame(stream, size)
+    num_written = image_writer.close()
+
+    chapter_writer.close()
+    shots.close()
+    close_intermediate(intermediate)
+    metrics.add(bytes_read=num_frames * size)
+    metrics.close()
+
+    duration = time.time() - start_time
+    print(f"Read {num_frames} frames, wrote {num_written} frames of {len(chapters)} chapters "
+          f"in {duration:.1f}s ({num_frames / max(duration, 1e-6):.1f} frames/s)")
+    return num_frames
+
+
+def close_intermediate(intermediate):
+    if intermediate is None:
+        return
+    intermediate.stdin.close()
+    if intermediate.wait() != 0:
+        sys.exit(f"ffmpeg failed to write the intermediate video (return code {intermediate.returncode})")
+
+
+def extract_segment(args, stream):
+    """Write the frames of a segment of the movie with their index in the segment to args.segment"""
+    width, height = (int(x) for x in args.size.split("x"))
+    size = frame_size(width, height, args.pixFmt)
+    os.makedirs(args.segment, exist_ok=True)
+
+    intermediate = None
+    if args.keep:
+        intermediate = open_intermediate(os.path.join(args.segment, args.name + ".mkv"), args.keep,
+                                         width, height, args.pixFmt, args.fps)
+
+    segment_name = os.path.basename(os.path.normpath(args.segment))
+    metrics = get_metrics("extract", workers=args.numCores, name=args.name, segment=segment_name)
+    image_writer = ImageWriter(args, width, height, metrics)
+    mafds = []
+    first, prev = None, None
+
+    buf = read_frame(stream, size)
+    while buf is not None:
+        frame = np.frombuffer(buf, np.uint8)
+        # the difference to the last frame of the previous segment is computed by merge_segments
+        mafds.append(mafd(frame, prev) if prev is not None else 0.0)
+        if first is None:
+            first = frame
+        prev = frame
+
+        if intermediate is not None:
+            intermediate.stdin.write(buf)
+        image_writer.write(os.path.join(args.segment, "out{}.jpg".format(str(len(mafds)).zfill(8))), buf)
+        buf = read_frame(stream, size)
+    image_writer.close()
+
+    close_intermediate(intermediate)
+    metrics.add(bytes_read=len(mafds) * size)
+    metrics.close()
+
+    np.save(os.path.join(args.segment, "mafd.npy"), np.array(mafds, dtype=np.float64))
+    if first is not None:
+        first.tofile(os.path.join(args.segment, "first.raw"))
+        prev.tofile(os.path.join(args.segment, "last.raw"))
+    with open(os.path.join(args.segment, "segment.json"), "w") as fp:
+        json.dump({"frames": len(mafds), "size": args.size, "pix_fmt": args.pixFmt}, fp)
+    print(f"Extracted {len(mafds)} frames of the segment {args.segment}")
+    return len(mafds)
+
+
+def merge_segments(args):
+    """Move the frames of the segments into the chapters and compute the scene cuts of the movie"""
+    width, height = (int(x) for x in args.size.split("x"))
+    fps_num, fps_den = (int(x) for x in args.fps.split("/"))
+
+    video_dir, raw_dir, meta_dir = get_dirs(args)
+    os.makedirs(meta_dir, exist_ok=True)
+    segments = sorted(d for d in glob.glob(os.path.join(args.merge, "*")) if
+                      os.path.exists(os.path.join(d, "segment.json")))
+    if not segments:
+        sys.exit(f"No extracted segments found in {args.merge}")
+
+    chapters = read_chapters(args.chapters or os.path.join(video_dir, "chapters.txt"))
+    chapter_writer = ChapterWriter(chapters, raw_dir, meta_dir, width, height)
+    shots = open(os.path.join(meta_dir, "shots.txt"), "w")
+
+    num_frames, prev_mafd, last = 0, 0.0, None
+    for segment in segments:
+        with open(os.path.join(segment, "segment.json"), "r") as fp:
+            info = json.load(fp)
+        if info["frames"] == 0:
+            continue
+        mafds = np.load(os.path.join(segment, "mafd.npy"))
+        if last is not None:
+            mafds[0] = mafd(np.fromfile(os.path.join(segment, "first.raw"), np.uint8), last)
+        last = np.fromfile(os.path.join(segment, "last.raw"), np.uint8)
+
+        for i, value in enumerate(mafds):
+            t = num_frames * fps_den / fps_num
+            if num_frames > 0:
+                score = scene_score(value, prev_mafd)
+                prev_mafd = value
+                if score > args.sceneThreshold:
+                    write_shot_line(shots, t, score)
+            num_frames += 1
+
+            # frames of several chapters are copied, frames of no chapter removed
+            src = os.path.join(segment, "out{}.jpg".format(str(i + 1).zfill(8)))
+            files = chapter_writer.frame_files(t)
+            for filename in files[:-1]:
+                shutil.copyfile(src, filename)
+            if files:
+                os.replace(src, files[-1])
+            else:
+                os.remove(src)
+
+    chapter_writer.close()
+    shots.close()
+    print(f"Merged {num_frames} frames of {len(segments)} segments into {len(chapters)} chapters")
+    return num_frames
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="extract the frames and scene cuts of an sbs movie from the raw \
+                                                  decoder output (stdin)")
+    parser.add_argument("--baseDir", type=str, required=True,
+                        help="path to folder containing the expected folders (sbs_videos, sbs_frames)")
+    parser.add_argument("--name", type=str, required=True, help="name of the sbs movie (e.g. movie_SBS)")
+    parser.add_argument("--chapters", type=str, default="",
+                        help="chapter timing file (default sbs_videos/<name>/chapters.txt)")
+    parser.add_argument("--input", type=str, default="-", help="raw video file (default: stdin)")
+    parser.add_argument("--size", type=str, default="3840x1080", help="size of the sbs frames")
+    parser.add_argument("--pixFmt", type=str, default="yuv420p", choices=list(PIX_FMTS),
+                        help="pixel format of the raw frames")
+    parser.add_argument("--fps", type=str, default="24000/1001", help="frame rate of the stream")
+    parser.add_argument("--sceneThreshold", type=float, default=0.1, help="scene score of a cut")
+    parser.add_argument("--quality", type=int, default=95, help="jpeg quality of the extracted frames")
+    parser.add_argument("--keep", type=str, default="", choices=["", "ffv1", "lossless"],
+                        help="also write a lossless intermediate video sbs_videos/<name>/<name>.mkv")
+    parser.add_argument("--numCores", type=int, default=multiprocessing.cpu_count(),
+                        help="number of threads encoding the frames")
+    parser.add_argument("--segment", type=str, default="",
+                        help="only write the frames of a segment of the movie to this folder (parallel conversion)")
+    parser.add_argument("--merge", type=str, default="",
+                        help="merge the extracted segments in the subfolders of this folder (no input is read)")
+
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_segments(args)
+        sys.exit(0)
+
+    extract = extract_segment if args.segment else extract_stream
+    if args.input == "-":
+        extract(args, sys.stdin.buffer)
+    else:
+        with open(args.input, "rb") as fp:
+            extract(args, fp)
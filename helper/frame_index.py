@@ -0,0 +1,98 @@
+"""
+    Join the per frame inputs of a data set (flow_forward, flow_backward,
+    sky_segmentation, image_left, ...) by frame id instead of sorting and zipping
+    globbed file lists.
+
+    Every folder is listed once with os.scandir into a dict frame id -> path (flat
+    and sharded layout, see helper/layout.py). The
+    frame id is the first 11 characters of the file name (outXXXXXXXX), so
+    suffixes added by the flow / segmentation scripts do not matter. The frames
+    are taken from the manifest of the data set (if there is one) or from the
+    union of the folders. Frames pruned on purpose (moved into duplicates/ by
+    dedup_data_set.py --remove or into prescreen_rejected/ by prescreen_stereo.py
+    --remove) are dropped. Frames missing one of the required inputs are reported
+    (meta/missing_inputs_<stage>.txt) and skipped, so only complete frames are processed.
+"""
+import os
+
+from helper.manifest import load_manifest, out_name
+from helper.disp_statistics import find_manifest
+from helper.layout import iter_frame_files, ID_LENGTH
+
+# folders the pruned frames are moved into (dedup_data_set.py, prescreen_stereo.py)
+PRUNED_FOLDERS = ["duplicates", "prescreen_rejected"]
+
+
+def scan_frames(folder, ext):
+    """Index the files with the extension ext in folder by frame id (one os.scandir pass per folder)"""
+    return {name[0:ID_LENGTH]: path for name, path in iter_frame_files(folder, ext)}
+
+
+def manifest_frames(path):
+    """Frame ids of the manifest of the data set (None without manifest)"""
+    manifest_file = find_manifest(path)
+    if manifest_file is None:
+        return None
+    records, _ = load_manifest(manifest_file)
+    return [out_name(r) for r in records]
+
+
+def pruned_frames(path):
+    """Frame ids of the frames removed from the data set by dedup_data_set.py / prescreen_stereo.py --remove"""
+    pruned = set()
+    for folder in PRUNED_FOLDERS:
+        pruned.update(scan_frames(os.path.join(path, folder, "image_left"), ".jpg"))
+    return pruned
+
+
+def join_frames(path, required, optional=()):
+    """Join the inputs of the frames of the data set by frame id
+
+    required and optional are lists of (folder, extension). Returns the sorted
+    list of (frame id, [paths of required], [paths of optional or None]) of the
+    frames with all required inputs and a dict frame id -> missing folders.
+    """
+    required_index = [scan_frames(os.path.join(path, folder), ext) for folder, ext in required]
+    optional_index = [scan_frames(os.path.join(path, folder), ext) for folder, ext in optional]
+
+    frames = manifest_frames(path)
+    if frames is None:
+        frames = set()
+        for index in required_index:
+            frames.update(index)
+    frames = sorted(set(frames) - pruned_frames(path))
+
+    complete, missing = [], {}
+    for frame in frames:
+        paths = [index.get(frame) for index in required_index]
+        if None in paths:
+            missing[frame] = [folder for (folder, _), p in zip(required, paths) if p is None]
+            continue
+        complete.append((frame, paths, [index.get(frame) for index in optional_index]))
+
+    return complete, missing
+
+
+def report_missing(path, missing, log_name):
+    """Print a summary of the frames with missing inputs and write them to meta/log_name
+
+    Every stage has its own log (e.g. missing_inputs_flow.txt), so the report of a stage is not
+    overwritten by the later stages.
+    """
+    log_file = os.path.join(path, "meta", log_name)
+    if not missing:
+        if os.path.exists(log_file):
+            os.remove(log_file)
+        return
+
+    counts = {}
+    for folders in missing.values():
+        for folder in folders:
+            counts[folder] = counts.get(folder, 0) + 1
+    summary = ", ".join(f"{folder}: {count}" for folder, count in sorted(counts.items()))
+    print(f"Skipping {len(missing)} frames with missing inputs ({summary}) - see {log_file}")
+
+    os.makedirs(os.path.join(path, "meta"), exist_ok=True)
+    with open(log_file, "w") as f:
+        for frame, folders in sorted(missing.items()):
+            f.write(f"{frame} {','.join(folders)}\n")
@@ -0,0 +1,176 @@
+"""
+    Fused CPU kernel for the disparity and uncertainty of get_disp_and_uncertainty.py.
+
+    The OpenCV path materializes several full resolution float32 temporaries per
+    frame (index grids, maps, the remapped flow, the absolute difference, the
+    resized copies). Here the frame is processed in bands of BAND_ROWS rows: the
+    backward-warp sample, the forward-backward difference, the 2x2 downscale and
+    the running min / max are computed in preallocated buffers of the size of a
+    band (which stay in the cache), only the half resolution results are kept
+    for the final quantization pass.
+
+    The remap is linear with BORDER_REPLICATE as cv2.remap, the 0.5 resize is the
+    2x2 mean, so the results agree with the OpenCV path within DISP_TOLERANCE /
+    UNCERTAINTY_TOLERANCE quantization steps (order of the float operations,
+    OpenCV < 4.11 additionally rounds the remap positions to 1/32 pixel). Only
+    even widths and heights are supported (see fused_supported).
+"""
+import numpy as np
+
+
+BAND_ROWS = 16
+
+# maximum difference to the OpenCV path (quantized disparity / uncertainty)
+DISP_TOLERANCE = 1
+UNCERTAINTY_TOLERANCE = 1
+
+_workspaces = {}
+
+
+class Workspace:
+    """Buffers of a band (reused for all frames of the same width)"""
+
+    def __init__(self, width, rows):
+        self.cols = np.arange(width, dtype=np.float32)
+        self.x = np.empty((rows, width), dtype=np.float32)
+        self.a = np.empty((rows, width), dtype=np.float32)
+        self.s0 = np.empty((rows, width), dtype=np.float32)
+        self.s1 = np.empty((rows, width), dtype=np.float32)
+        self.i0 = np.empty((rows, width), dtype=np.intp)
+        self.i1 = np.empty((rows, width), dtype=np.intp)
+        self.small = np.empty((rows // 2, width // 2), dtype=np.float32)
+        self.tmp = np.empty((rows // 2, width // 2), dtype=np.float32)
+        self.valid = np.empty((rows, width), dtype=bool)
+
+
+def get_workspace(width, rows=BAND_ROWS):
+    key = (width, rows)
+    if key not in _workspaces:
+        _workspaces[key] = Workspace(width, rows)
+    return _workspaces[key]
+
+
+def fused_supported(shape):
+    return shape[0] % 2 == 0 and shape[1] % 2 == 0
+
+
+def sky_mask(sky_seg_idx, shape):
+    """Pixels set to the minimum disparity as by disp[sky_seg_idx] = min in the OpenCV path
+
+    An integer array (read_sky_segmentation) indexes rows, a boolean array pixels.
+    Returns (row flags, pixel mask or None).
+    """
+    rows = np.zeros(shape[0], dtype=bool)
+    if sky_seg_idx is None:
+        return rows, None
+    sky_seg_idx = np.asarray(sky_seg_idx)
+    if sky_seg_idx.dtype == bool:
+        return rows, sky_seg_idx
+    rows[np.unique(sky_seg_idx)] = True
+    return rows, None
+
+
+def downscale(src, out, tmp):
+    """Mean of the 2x2 blocks of src (0.5 resize with INTER_LINEAR)"""
+    np.add(src[0::2, 0::2], src[0::2, 1::2], out=out)
+    np.add(src[1::2, 0::2], src[1::2, 1::2], out=tmp)
+    np.add(out, tmp, out=out)
+    np.multiply(out, np.float32(0.25), out=out)
+    return out
+
+
+def warp_band(ws, u, flow_bw_flat, r0, width):
+    """Linear sample of the backward flow at x + u_fw (rows r0.. of the band) -> ws.s0"""
+    h = u.shape[0]
+    x, a, s0, s1 = ws.x[:h], ws.a[:h], ws.s0[:h], ws.s1[:h]
+    i0, i1 = ws.i0[:h], ws.i1[:h]
+
+    np.add(u, ws.cols, out=x)
+    np.floor(x, out=a)
+    np.copyto(i0, a, casting="unsafe")
+    np.subtract(x, a, out=a)
+
+    # replicate border, index of the u component in the interleaved flow
+    offsets = (np.arange(r0, r0 + h, dtype=np.intp) * width)[:, None]
+    np.add(i0, 1, out=i1)
+    np.clip(i0, 0, width - 1, out=i0)
+    np.clip(i1, 0, width - 1, out=i1)
+    np.add(i0, offsets, out=i0)
+    np.add(i1, offsets, out=i1)
+    np.multiply(i0, 2, out=i0)
+    np.multiply(i1, 2, out=i1)
+
+    np.take(flow_bw_flat, i0, out=s0)
+    np.take(flow_bw_flat, i1, out=s1)
+    np.subtract(s1, s0, out=s1)
+    np.multiply(s1, a, out=s1)
+    np.add(s0, s1, out=s0)
+    return s0
+
+
+def fused_disp_and_uncertainty(flow_forward, flow_backward, sky_seg_idx=None, fbc_threshold=None):
+    """Quantized disparity and uncertainty (same result as quantize_disp_and_uncertainty of the OpenCV path)
+
+    flow_forward / flow_backward are HxWx2 float32 flows (H and W even). Returns the
+    disparity (uint16), the uncertainty (uint8), the quantization metadata and the
+    number of full resolution pixels with an uncertainty below fbc_threshold (None
+    without threshold).
+    """
+    height, width = flow_forward.shape[:2]
+    u_fw = flow_forward[:, :, 0]
+    flow_bw_flat = np.ascontiguousarray(flow_backward, dtype=np.float32).reshape(-1)
+
+    ws = get_workspace(width, BAND_ROWS)
+    sky_rows, sky_pixels = sky_mask(sky_seg_idx, (height, width))
+    sky_value = -u_fw.max() if sky_rows.any() or sky_pixels is not None else None
+
+    disp = np.empty((height // 2, width // 2), dtype=np.float32)
+    uncertainty = np.empty((height // 2, width // 2), dtype=np.uint8)
+    valid = 0 if fbc_threshold is not None else None
+    disp_min, disp_max = np.float32(np.inf), np.float32(-np.inf)
+
+    for r0 in range(0, height, BAND_ROWS):
+        r1 = min(r0 + BAND_ROWS, height)
+        h = r1 - r0
+        u = u_fw[r0:r1]
+        small, tmp = ws.small[:h // 2], ws.tmp[:h // 2]
+
+        # forward-backward difference |u_fw - (-u_bw warped)|
+        unc = warp_band(ws, u, flow_bw_flat, r0, width)
+        np.add(unc, u, out=unc)
+        np.abs(unc, out=unc)
+        if fbc_threshold is not None:
+            np.less(unc, fbc_threshold, out=ws.valid[:h])
+            valid += np.count_nonzero(ws.valid[:h])
+
+        downscale(unc, small, tmp)
+        np.multiply(small, np.float32(10 * 0.5), out=small)
+        np.rint(small, out=small)
+        np.minimum(small, 255, out=small)
+        np.copyto(uncertainty[r0 // 2:r1 // 2], small, casting="unsafe")
+
+        # disparity -u_fw (sky set to the minimum disparity)
+        d = ws.s1[:h]
+        np.negative(u, out=d)
+        if sky_value is not None:
+            d[sky_rows[r0:r1]] = sky_value
+            if sky_pixels is not None:
+                np.copyto(d, sky_value, where=sky_pixels[r0:r1])
+        out = disp[r0 // 2:r1 // 2]
+        downscale(d, out, tmp)
+        np.multiply(out, np.float32(0.5), out=out)
+        disp_min = min(disp_min, out.min())
+        disp_max = max(disp_max, out.max())
+
+    # quantization (single pass over the half resolution disparity)
+    if disp_max - disp_min > 0:
+        np.subtract(disp, disp_min, out=disp)
+        np.divide(disp, disp_max - disp_min, out=disp)
+        np.multiply(disp, 65535, out=disp)
+        np.rint(disp, out=disp)
+        scale = 1.0 * (disp_max - disp_min) / 65535
+    else:
+        disp.fill(0)
+        scale = 1.0
+
+    return disp.astype(np.uint16), uncertainty, {"offset": disp_min, "scale": scale}, valid
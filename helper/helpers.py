@@ -1,6 +1,9 @@
 
 import os
 import errno
+import hashlib
+import json
+import shutil
 
 
 def createDir(path, verbose=True):
@@ -38,4 +41,133 @@ def processShotFile(video, shotFile):
 
 def truncate(num, n):
     integer = int(num * (10**n))/(10**n)
-    return float(integer)
\ No newline at end of file
+    return float(integer)
+
+def fingerprint_files(paths, params=""):
+    """Compute a fingerprint of the content of the given files and the parameters
+
+    Missing files are hashed by their name only, so adding a file changes the fingerprint.
+    """
+    sha = hashlib.sha1()
+    sha.update(str(params).encode())
+    for path in sorted(paths):
+        sha.update(os.path.basename(path).encode())
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_jsonl(filename):
+    """Read all records of a JSON Lines file (empty list if the file does not exist)"""
+    records = []
+    if not os.path.exists(filename):
+        return records
+    with open(filename, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def append_jsonl(filename, record):
+    with open(filename, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
+
+
+MATERIALIZE_MODES = ["copy", "hardlink", "reflink", "symlink"]
+
+# modes to try (in this order) if the file system does not support the chosen mode
+MATERIALIZE_FALLBACK = {
+    "copy": ["copy"],
+    "hardlink": ["hardlink", "copy"],
+    "reflink": ["reflink", "hardlink", "copy"],
+    "symlink": ["symlink", "copy"],
+}
+
+# ioctl to clone a file (linux/fs.h)
+FICLONE = 0x40049409
+
+_materialize_fallback_reported = set()
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def materialize(src, dst, mode="copy"):
+    """Make the file src available as dst without copying the data if possible
+
+    mode is one of copy, hardlink, reflink (copy on write clone) or symlink. If the
+    file system does not support the mode the next mode in MATERIALIZE_FALLBACK is
+    used. Returns the mode that was used. A missing src raises FileNotFoundError.
+    """
+    if not os.path.exists(src):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+
+    silentremove(dst)
+
+    for m in MATERIALIZE_FALLBACK[mode]:
+        try:
+            if m == "copy":
+                shutil.copy(src, dst)
+            elif m == "hardlink":
+                os.link(src, dst)
+            elif m == "reflink":
+                _reflink(src, dst)
+            else:
+                os.symlink(os.path.realpath(src), dst)
+        except OSError as e:
+            if m == "copy":
+                raise
+            if m not in _materialize_fallback_reported:
+                _materialize_fallback_reported.add(m)
+                print(f"Materialize mode {m} not supported ({e}). Falling back ...")
+            continue
+
+        return m
+
+
+def load_materialize_log(filename):
+    """Read a materialize log and return the mapping materialized file -> original file"""
+    mapping = {}
+    with open(filename, "r") as fp:
+        for line in fp:
+            if line.startswith("#") or not line.strip():
+                continue
+            dst, src = line.rstrip("\n").split(" ", 1)
+            mapping[dst] = src
+    return mapping
+
+
+def update_materialize_log(base_dir, moved):
+    """Update the materialize log of a data set after moving materialized files
+
+    moved maps the old path to the new path of the files (absolute or relative to
+    base_dir). The originals and the header of the log stay the same.
+    """
+    filename = os.path.join(base_dir, "meta", "materialize_log.txt")
+    if not moved or not os.path.exists(filename):
+        return
+    moved = {os.path.relpath(os.path.join(base_dir, old), base_dir):
+             os.path.relpath(os.path.join(base_dir, new), base_dir) for old, new in moved.items()}
+
+    with open(filename, "r") as fp:
+        header = [line for line in fp if line.startswith("#")]
+    mapping = load_materialize_log(filename)
+
+    with open(filename, "w") as fp:
+        fp.writelines(header)
+        for dst, src in mapping.items():
+            fp.write(moved.get(dst, dst) + " " + src + "\n")
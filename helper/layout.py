@@ -0,0 +1,177 @@
+"""
+    Directory layout of the per frame folders of a data set.
+
+    flat    - every file of a folder directly in it (image_left/out00012345.jpg)
+    sharded - the files are fanned out into subfolders of 10^shard_digits frames
+              named by the prefix of the frame id (image_left/out0001/out00012345.jpg),
+              so no folder has more than 10000 entries however large the data set is
+
+    The layout of a data set is stored in meta/layout.json (written by
+    helper/createDataSet.py, flat if the file does not exist). Writers resolve
+    the path of a frame with frame_file / output_file, readers list the files with
+    iter_frame_files / list_frame_files, which finds the files of both layouts.
+    The file names are the same in both layouts, only the folder differs.
+
+    An existing data set is converted with:
+        python helper/layout.py migrate /path/to/data_set --layout sharded
+"""
+import os
+import json
+import argparse
+
+try:
+    from helper.helpers import update_materialize_log
+except ImportError:
+    # run as script or imported by the scripts in helper/
+    from helpers import update_materialize_log
+
+
+LAYOUT_FILE = "layout.json"
+LAYOUTS = ["flat", "sharded"]
+SHARD_DIGITS = 4
+
+# length of the frame id (outXXXXXXXX), file names may have a suffix
+ID_LENGTH = 11
+
+# per frame folders of a data set
+FRAME_FOLDERS = ["image_left", "image_right", "flow_forward", "flow_backward", "sky_segmentation",
+                 "disparity", "uncertainty"]
+
+_created_dirs = set()
+# path -> (modification time of meta/layout.json, layout)
+_layouts = {}
+
+
+def get_layout(name="flat", shard_digits=SHARD_DIGITS):
+    return {"layout": name, "shard_digits": shard_digits}
+
+
+def load_layout(path):
+    """Layout of the data set in path (flat without meta/layout.json)
+
+    The layout is read again if meta/layout.json changed (e.g. migrated while the
+    processes of the worker service keep running).
+    """
+    filename = os.path.join(path, "meta", LAYOUT_FILE)
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if path not in _layouts or _layouts[path][0] != mtime:
+        layout = get_layout()
+        if mtime is not None:
+            with open(filename, "r") as fp:
+                layout = json.load(fp)
+        _layouts[path] = (mtime, layout)
+    return _layouts[path][1]
+
+
+def save_layout(path, layout):
+    os.makedirs(os.path.join(path, "meta"), exist_ok=True)
+    with open(os.path.join(path, "meta", LAYOUT_FILE), "w") as fp:
+        json.dump(layout, fp)
+    _layouts.pop(path, None)
+
+
+def clear_cache():
+    """Forget the layouts and created folders (between the jobs of the worker service)"""
+    _layouts.clear()
+    _created_dirs.clear()
+
+
+def shard_name(filename, layout):
+    """Subfolder of the file (empty for the flat layout)"""
+    if layout["layout"] == "flat":
+        return ""
+    return filename[0:ID_LENGTH - layout["shard_digits"]]
+
+
+def frame_file(folder, filename, layout):
+    """Path of the file of a frame (e.g. out00012345.jpg) in folder"""
+    return os.path.join(folder, shard_name(filename, layout), filename)
+
+
+def output_file(folder, filename, layout):
+    """Path of the file of a frame, the subfolder is created if needed"""
+    path = frame_file(folder, filename, layout)
+    directory = os.path.dirname(path)
+    if directory not in _created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _created_dirs.add(directory)
+    return path
+
+
+def is_shard(name):
+    return name.startswith("out") and len(name) < ID_LENGTH
+
+
+def iter_frame_files(folder, ext=""):
+    """Yield (file name, path) of the files with the extension ext in folder (any layout)"""
+    try:
+        with os.scandir(folder) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.endswith(ext) and entry.is_file():
+            yield entry.name, entry.path
+        elif is_shard(entry.name) and entry.is_dir():
+            with os.scandir(entry.path) as shard:
+                for e in shard:
+                    if e.name.endswith(ext) and e.is_file():
+                        yield e.name, e.path
+
+
+def list_frame_files(folder, ext=""):
+    """Sorted paths of the files with the extension ext in folder (any layout)"""
+    return [path for _, path in sorted(iter_frame_files(folder, ext))]
+
+
+def migrate(path, layout, folders=FRAME_FOLDERS):
+    """Move the files of the frame folders of the data set into the layout
+
+    Returns the number of moved files. The materialize log (relative paths of the
+    images) is updated, empty subfolders are removed.
+    """
+    moved = {}
+    for folder in folders:
+        folder_path = os.path.join(path, folder)
+        for filename, src in list(iter_frame_files(folder_path)):
+            dst = frame_file(folder_path, filename, layout)
+            if dst != src:
+                os.replace(src, output_file(folder_path, filename, layout))
+                moved[src] = dst
+        if os.path.isdir(folder_path):
+            for entry in os.scandir(folder_path):
+                if is_shard(entry.name) and entry.is_dir() and not os.listdir(entry.path):
+                    os.rmdir(entry.path)
+
+    update_materialize_log(path, moved)
+    save_layout(path, layout)
+    return len(moved)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="directory layout of the per frame folders of a data set")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("migrate", help="move the files of an existing data set into the layout")
+    p.add_argument("path", type=str, help="path to folder of the data set")
+    p.add_argument("--layout", type=str, default="sharded", choices=LAYOUTS, help="layout of the data set")
+    p.add_argument("--shard_digits", type=int, default=SHARD_DIGITS,
+                   help="number of digits of the frame id inside a subfolder (10^shard_digits files)")
+    p.add_argument("--folders", type=str, default=",".join(FRAME_FOLDERS),
+                   help="comma separated list of the folders to migrate")
+
+    p = subparsers.add_parser("show", help="print the layout of a data set")
+    p.add_argument("path", type=str, help="path to folder of the data set")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        layout = get_layout(args.layout, args.shard_digits)
+        moved = migrate(args.path, layout, args.folders.split(","))
+        print(f"Moved {moved} files into the {args.layout} layout")
+    else:
+        print(json.dumps(load_layout(args.path)))
@@ -0,0 +1,267 @@
+"""
+    Compact binary manifest of a data set.
+
+    Instead of repeating the full path of every frame, the manifest stores the
+    integer coded columns video, chapter, scene, sequence, frame and out (the
+    new name of the frame inside the data set) in a numpy structured array.
+    The names of the videos and the format of the frame paths are kept in a
+    small string table.
+
+    A manifest with the name <name>.manifest consists of two files:
+        <name>.manifest.npy   - the records (can be memory mapped)
+        <name>.manifest.json  - the string table
+
+    Columns that are not used by a data set are set to -1.
+"""
+import os
+import json
+import argparse
+import numpy as np
+
+
+MANIFEST_VERSION = 1
+
+MANIFEST_DTYPE = np.dtype([
+    ("video", np.int32),
+    ("chapter", np.int32),
+    ("scene", np.int32),
+    ("sequence", np.int64),
+    ("frame", np.int64),
+    ("out", np.int64),
+])
+
+
+def get_manifest_files(filename):
+    if filename.endswith(".npy") or filename.endswith(".json"):
+        filename = os.path.splitext(filename)[0]
+    return filename + ".npy", filename + ".json"
+
+
+def manifest_exists(filename):
+    return all(os.path.exists(f) for f in get_manifest_files(filename))
+
+
+def manifest_is_current(filename, data_file):
+    """True if the manifest exists and is not older than the text file data_file it was written with
+
+    A text file edited after the manifest was written (e.g. frames removed by hand)
+    is used instead of the manifest.
+    """
+    if not manifest_exists(filename):
+        return False
+    if os.path.exists(data_file) and \
+            os.path.getmtime(data_file) > min(os.path.getmtime(f) for f in get_manifest_files(filename)):
+        print(f"{data_file} is newer than the manifest {filename}, using {data_file}")
+        return False
+    return True
+
+
+def save_manifest(filename, records, strings):
+    file_records, file_strings = get_manifest_files(filename)
+
+    strings = dict(strings)
+    strings["version"] = MANIFEST_VERSION
+
+    np.save(file_records, np.asarray(records, dtype=MANIFEST_DTYPE))
+    with open(file_strings, "w") as fp:
+        json.dump(strings, fp, indent=True)
+
+
+def load_manifest(filename, mmap=True):
+    """Load the records and the string table of a manifest
+
+    With mmap the records are memory mapped (read only) and only the
+    accessed parts are read from disk.
+    """
+    file_records, file_strings = get_manifest_files(filename)
+
+    records = np.load(file_records, mmap_mode="r" if mmap else None)
+    with open(file_strings, "r") as fp:
+        strings = json.load(fp)
+
+    assert strings["version"] == MANIFEST_VERSION, \
+        f"manifest version {strings['version']} is not supported"
+
+    return records, strings
+
+
+def select(records, strings, videos=None, chapters=None, scenes=None, sequences=None):
+    """Get the records belonging to the given videos (names), chapters, scenes and sequences"""
+    mask = np.ones(records.shape[0], dtype=bool)
+
+    if videos is not None:
+        video_ids = [strings["videos"].index(v) for v in videos if v in strings["videos"]]
+        mask &= np.isin(records["video"], video_ids)
+    if chapters is not None:
+        mask &= np.isin(records["chapter"], chapters)
+    if scenes is not None:
+        mask &= np.isin(records["scene"], scenes)
+    if sequences is not None:
+        mask &= np.isin(records["sequence"], sequences)
+
+    return records[mask]
+
+
+def frame_path(record, strings, prefix=None, suffix=None):
+    """Get the path of a frame as written to the txt/json files
+
+    The prefix and suffix of the string table can be overwritten, e.g. to get the
+    path relative to image_left without file ending.
+    """
+    prefix = strings["prefix"] if prefix is None else prefix
+    suffix = strings["suffix"] if suffix is None else suffix
+
+    return prefix + strings["videos"][record["video"]] + "/chapter" + str(record["chapter"]) + \
+        "/out" + str(record["frame"]).zfill(8) + suffix
+
+
+def frame_paths(records, strings, prefix=None, suffix=None):
+    return [frame_path(r, strings, prefix, suffix) for r in records]
+
+
+def out_name(record):
+    return "out" + str(record["out"]).zfill(8)
+
+
+def sequence_name(record):
+    return "seq" + str(record["sequence"]).zfill(8)
+
+
+def parse_frame_path(path):
+    """Split a frame path (e.g. sbs_frames/image_left/video/chapter2/out00000012.jpg)
+
+    Returns the prefix, video, chapter, frame and suffix of the path.
+    """
+    split = path.split("/")
+    name, chapter, video = split[-1], split[-2], split[-3]
+    prefix = "/".join(split[:-3])
+    if prefix:
+        prefix += "/"
+    stem, ext = os.path.splitext(name)
+
+    return prefix, video, int(chapter[len("chapter"):]), int(stem[len("out"):]), ext
+
+
+def get_video_id(strings, video):
+    if video not in strings["videos"]:
+        strings["videos"].append(video)
+    return strings["videos"].index(video)
+
+
+def scene_dict_to_manifest(scene_dict):
+    """Convert the json format {video: {chapterN: {sceneN: [frame paths]}}} into a manifest
+
+    The frames are numbered (out) in the order they appear in the json file.
+    """
+    strings = {"videos": [], "prefix": "", "suffix": ""}
+    columns = []
+
+    for video, chapters in scene_dict.items():
+        video_id = get_video_id(strings, video)
+        for chapter, scenes in chapters.items():
+            for scene, frames in scenes.items():
+                for path in frames:
+                    prefix, _, chap, frame, ext = parse_frame_path(path)
+                    strings["prefix"], strings["suffix"] = prefix, ext
+                    columns.append((video_id, chap, int(scene[len("scene"):]), -1, frame, len(columns)))
+
+    return np.array(columns, dtype=MANIFEST_DTYPE), strings
+
+
+def manifest_to_scene_dict(records, strings):
+    """Convert a manifest into the json format {video: {chapterN: {sceneN: [frame paths]}}}
+
+    Note: empty scenes are not part of the manifest and therefore not exported.
+    """
+    scene_dict = {}
+    for r in records:
+        chapters = scene_dict.setdefault(strings["videos"][r["video"]], {})
+        scenes = chapters.setdefault("chapter{}".format(r["chapter"]), {})
+        scenes.setdefault("scene{}".format(r["scene"]), []).append(frame_path(r, strings))
+    return scene_dict
+
+
+def txt_to_manifest(filename):
+    """Convert a txt file with one frame path per line into a manifest"""
+    strings = {"videos": [], "prefix": "", "suffix": ""}
+    columns = []
+
+    with open(filename, "r") as fp:
+        for line in fp:
+            line = line.rstrip()
+            if not line:
+                continue
+            prefix, video, chap, frame, ext = parse_frame_path(line)
+            strings["prefix"], strings["suffix"] = prefix, ext
+            columns.append((get_video_id(strings, video), chap, -1, -1, frame, len(columns)))
+
+    return np.array(columns, dtype=MANIFEST_DTYPE), strings
+
+
+def manifest_to_txt(records, strings, filename):
+    with open(filename, "w") as fp:
+        for path in frame_paths(records, strings):
+            fp.write(path + "\n")
+
+
+def csv_to_manifest(filename):
+    """Convert a sequence data set csv (video,chapter,path,sequence,out) into a manifest"""
+    strings = {"videos": [], "prefix": "", "suffix": ""}
+    columns = []
+
+    with open(filename, "r") as fp:
+        for line in fp:
+            line = line.rstrip()
+            if not line:
+                continue
+            video, chap, path, seq, out = line.split(",")
+            _, _, _, frame, _ = parse_frame_path(path)
+            columns.append((get_video_id(strings, video), int(chap), -1,
+                            int(seq[len("seq"):]), frame, int(out[len("out"):])))
+
+    return np.array(columns, dtype=MANIFEST_DTYPE), strings
+
+
+def manifest_to_csv(records, strings, filename):
+    with open(filename, "w") as fp:
+        for r in records:
+            fp.write(strings["videos"][r["video"]] + "," + str(r["chapter"]) + "," +
+                     frame_path(r, strings, prefix="", suffix="") + "," +
+                     sequence_name(r) + "," + out_name(r) + "\n")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="convert data set files (json/csv/txt) into a manifest and back")
+    parser.add_argument("mode", type=str, choices=["import", "export"],
+                        help="import: old format -> manifest, export: manifest -> old format")
+    parser.add_argument("--manifest", type=str, required=True,
+                        help="name of the manifest (without .npy/.json)")
+    parser.add_argument("--file", type=str, required=True,
+                        help="data set file in the old format")
+    parser.add_argument("--format", type=str, choices=["json", "csv", "txt"], required=True,
+                        help="format of the data set file")
+
+    args = parser.parse_args()
+
+    if args.mode == "import":
+        if args.format == "json":
+            with open(args.file, "r") as fp:
+                records, strings = scene_dict_to_manifest(json.load(fp))
+        elif args.format == "csv":
+            records, strings = csv_to_manifest(args.file)
+        else:
+            records, strings = txt_to_manifest(args.file)
+        save_manifest(args.manifest, records, strings)
+        print(f"Saved manifest with {records.shape[0]} frames to {args.manifest}")
+    else:
+        records, strings = load_manifest(args.manifest)
+        if args.format == "json":
+            with open(args.file, "w") as fp:
+                json.dump(manifest_to_scene_dict(records, strings), fp, indent=True)
+        elif args.format == "csv":
+            manifest_to_csv(records, strings, args.file)
+        else:
+            manifest_to_txt(records, strings, args.file)
+        print(f"Exported {records.shape[0]} frames to {args.file}")
@@ -0,0 +1,281 @@
+"""
+    Metrics of the pipeline scripts (throughput, bytes, worker utilization, backlog, failures).
+
+    The metrics are only collected if enabled with environment variables, so the
+    scripts do not need additional arguments:
+        SBS_METRICS_DIR       - folder for the Prometheus text files (<stage>_<pid>.prom,
+                                e.g. for the textfile collector of the node exporter) and the
+                                end of run summaries (<stage>_<time>_<pid>_summary.json)
+        SBS_METRICS_PORT      - serve the metrics on http://127.0.0.1:<port>/metrics
+        SBS_METRICS_INTERVAL  - seconds between two updates (default 10)
+
+    A script creates the metrics of its stage with get_metrics and reports into it:
+        metrics = get_metrics("disparity", workers=num_cores, total=len(inputs))
+        metrics.add(frames=1, bytes_read=..., bytes_written=..., busy=seconds)
+        metrics.failure(reason)
+        metrics.add_result(res, busy=seconds, read_files=..., written_files=...)
+        metrics.close()
+
+    busy is the time a worker spent on the frame (see timed_call), the busy ratio is
+    the busy time divided by the elapsed time of all workers.
+
+    Metrics of a run that are only known at the end (e.g. the ffmpeg extraction of
+    run_extractFrames.sh) are recorded with:
+        python helper/metrics.py record --stage extract --frames N --seconds T
+"""
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def timed_call(func, *args, **kwargs):
+    """Call func and also return the time it took (used inside the workers)"""
+    start_time = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - start_time
+
+
+def failure_reason(res):
+    """Get the reason of a failure string "<name> <reason>\\n" returned by the workers"""
+    return res.strip().split(" ", 1)[-1]
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics:
+
+    def __init__(self, stage, workers=1, total=None, out_dir="", port=0, interval=10, labels=None):
+        self.stage = stage
+        self.workers = workers
+        self.total = total
+        self.out_dir = out_dir
+        self.interval = interval
+        self.labels = dict(labels or {})
+        self.labels.setdefault("stage", stage)
+        self.labels.setdefault("node", socket.gethostname())
+
+        self.enabled = bool(out_dir or port)
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.frames = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.busy = 0.0
+        self.failures = {}
+        self.backlog = None
+        self.finished = False
+
+        # frames/s of the last interval
+        self.last_time = self.start_time
+        self.last_frames = 0
+        self.rate = 0.0
+
+        self.prom_file = None
+        self.server = None
+        self.stop = threading.Event()
+
+        if not self.enabled:
+            return
+
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+            self.prom_file = os.path.join(out_dir, f"{stage}_{os.getpid()}.prom")
+        if port:
+            self.start_server(port)
+
+        threading.Thread(target=self.update_loop, daemon=True).start()
+
+    def add(self, frames=0, bytes_read=0, bytes_written=0, busy=0.0):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.frames += frames
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+            self.busy += busy
+
+    def failure(self, reason):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def add_result(self, res, busy=0.0, read_files=(), written_files=()):
+        """Add the result of a worker ("0" or "<name> <reason>\\n") and the sizes of its files"""
+        if not self.enabled:
+            return
+        bytes_read = sum(file_size(f) for f in read_files)
+        if res == "0":
+            self.add(frames=1, bytes_read=bytes_read, busy=busy,
+                     bytes_written=sum(file_size(f) for f in written_files))
+        else:
+            self.add(bytes_read=bytes_read, busy=busy)
+            self.failure(failure_reason(res))
+
+    def set_backlog(self, backlog):
+        self.backlog = backlog
+
+    def get_backlog(self):
+        if self.backlog is not None:
+            return self.backlog
+        if self.total is not None:
+            return max(self.total - self.frames - sum(self.failures.values()), 0)
+        return None
+
+    def summary(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start_time, 1e-6)
+            return {
+                "stage": self.stage,
+                "labels": self.labels,
+                "elapsed_seconds": elapsed,
+                "frames": self.frames,
+                "frames_per_second": self.frames / elapsed,
+                "frames_per_second_last_interval": self.rate,
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "workers": self.workers,
+                "worker_busy_ratio": self.busy / (elapsed * max(self.workers, 1)),
+                "backlog": self.get_backlog(),
+                "failures": dict(self.failures),
+                "finished": self.finished,
+            }
+
+    def render(self):
+        """Render the metrics in the Prometheus text format"""
+        s = self.summary()
+        labels = ",".join(f'{k}="{escape_label(v)}"' for k, v in sorted(self.labels.items()))
+
+        metrics = [
+            ("sbs_frames_total", "counter", "frames processed", s["frames"]),
+            ("sbs_frames_per_second", "gauge", "frames per second of the last interval",
+             s["frames_per_second_last_interval"]),
+            ("sbs_bytes_read_total", "counter", "bytes read", s["bytes_read"]),
+            ("sbs_bytes_written_total", "counter", "bytes written", s["bytes_written"]),
+            ("sbs_workers", "gauge", "number of workers", s["workers"]),
+            ("sbs_worker_busy_ratio", "gauge", "fraction of time the workers were busy", s["worker_busy_ratio"]),
+            ("sbs_elapsed_seconds", "gauge", "seconds since the start of the stage", s["elapsed_seconds"]),
+            ("sbs_finished", "gauge", "1 if the stage is finished", int(s["finished"])),
+        ]
+        if s["backlog"] is not None:
+            metrics.append(("sbs_backlog", "gauge", "frames not processed yet", s["backlog"]))
+
+        lines = []
+        for name, kind, description, value in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{{{labels}}} {value}")
+
+        lines.append("# HELP sbs_failures_total failed/filtered frames per reason")
+        lines.append("# TYPE sbs_failures_total counter")
+        for reason, count in sorted(s["failures"].items()):
+            lines.append(f'sbs_failures_total{{{labels},reason="{escape_label(reason)}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+    def update(self):
+        now = time.time()
+        with self.lock:
+            self.rate = (self.frames - self.last_frames) / max(now - self.last_time, 1e-6)
+            self.last_time, self.last_frames = now, self.frames
+
+        if self.prom_file:
+            # write atomically, the file may be read at any time
+            tmp_file = self.prom_file + ".tmp"
+            with open(tmp_file, "w") as fp:
+                fp.write(self.render())
+            os.replace(tmp_file, self.prom_file)
+
+    def update_loop(self):
+        while not self.stop.wait(self.interval):
+            self.update()
+
+    def start_server(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self.server = HTTPServer(("127.0.0.1", port), Handler)
+        except OSError as e:
+            print(f"Could not serve the metrics on port {port}: {e}")
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        """Write the end of run summary and stop the updates"""
+        if not self.enabled:
+            return
+        self.stop.set()
+        self.finished = True
+        self.update()
+        summary = self.summary()
+
+        if self.out_dir:
+            summary_file = os.path.join(
+                self.out_dir, f"{self.stage}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_summary.json")
+            with open(summary_file, "w") as fp:
+                json.dump(summary, fp, indent=True)
+            # the summary replaces the live metrics of the process
+            os.remove(self.prom_file)
+
+        if self.server is not None:
+            self.server.shutdown()
+
+        print(f"[metrics] {self.stage}: {summary['frames']} frames in {summary['elapsed_seconds']:.1f}s "
+              f"({summary['frames_per_second']:.2f} frames/s, busy ratio {summary['worker_busy_ratio']:.2f}, "
+              f"{sum(summary['failures'].values())} failures)")
+
+
+def get_metrics(stage, workers=1, total=None, **labels):
+    """Create the metrics of a stage as configured by the environment variables"""
+    return Metrics(stage, workers=workers, total=total,
+                   out_dir=os.environ.get("SBS_METRICS_DIR", ""),
+                   port=int(os.environ.get("SBS_METRICS_PORT", 0)),
+                   interval=float(os.environ.get("SBS_METRICS_INTERVAL", 10)),
+                   labels=labels)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="record the metrics of a finished run (e.g. of a shell script)")
+    parser.add_argument("mode", type=str, choices=["record"])
+    parser.add_argument("--stage", type=str, required=True, help="name of the stage")
+    parser.add_argument("--name", type=str, default="", help="additional label (e.g. the video)")
+    parser.add_argument("--frames", type=int, default=0, help="number of processed frames")
+    parser.add_argument("--seconds", type=float, default=0, help="run time of the stage")
+    parser.add_argument("--workers", type=int, default=1, help="number of workers")
+    parser.add_argument("--bytes_read", type=int, default=0, help="number of bytes read")
+    parser.add_argument("--bytes_written", type=int, default=0, help="number of bytes written")
+
+    args = parser.parse_args()
+
+    labels = {"name": args.name} if args.name else {}
+    metrics = get_metrics(args.stage, workers=args.workers, **labels)
+    metrics.start_time = time.time() - args.seconds
+    metrics.add(frames=args.frames, bytes_read=args.bytes_read, bytes_written=args.bytes_written,
+                busy=args.seconds * args.workers)
+    metrics.close()
@@ -1,73 +1,104 @@
 import argparse
 import os
 import numpy as np
-import pandas as pd
-import shutil
 from tqdm import tqdm
 
-from helpers import createDir
+from helpers import createDir, MATERIALIZE_MODES
+from copy_engine import copy_files, create_dirs, report_errors
+from manifest import manifest_is_current, load_manifest
+from layout import load_layout, frame_file
 
 
-def get_num_sequences(sequences):
-    return int(sequences[-1][3:11])
+def group_sequences(sequences):
+    """Group the rows of the data set by their sequence with a single sort
 
+    Returns a list of (sequence id, indices of the rows belonging to the sequence).
+    """
+    order = np.argsort(sequences, kind="stable")
+    seq_ids, starts = np.unique(sequences[order], return_index=True)
+    return list(zip(seq_ids, np.split(order, starts[1:])))
 
-def process_sequence(args, seq, sequences, image_names):
 
-    seq_str = "seq" + str(seq).zfill(8)
-    idx = np.where(sequences == seq_str)[0]
-
-    # Create required folders
+def get_sequence_folders(args, seq):
     image_out_folder = os.path.join(args.baseDir, "sequence_data", "images", "seq" + str(seq).zfill(4))
     depth_out_folder = os.path.join(args.baseDir, "sequence_data", "depth", "seq" + str(seq).zfill(4))
-    createDir(image_out_folder, verbose=False)
-    createDir(depth_out_folder, verbose=False)
+    return image_out_folder, depth_out_folder
+
+
+def process_sequence(args, seq, idx, image_names):
+    """Get the (src, dst) pairs of the images of a sequence (idx are the rows of the sequence)"""
+
+    image_out_folder, depth_out_folder = get_sequence_folders(args, seq)
+
+    jobs = []
 
     for i in idx:
 
         image_name = image_names[i]
 
-        image_path_src = os.path.join(args.baseDir, "image_left", image_name + ".jpg")
-        depth_path_src = os.path.join(args.baseDir, "disparity", image_name + ".png")
+        image_path_src = frame_file(os.path.join(args.baseDir, "image_left"), image_name + ".jpg",
+                                    load_layout(args.baseDir))
+        depth_path_src = frame_file(os.path.join(args.baseDir, "disparity"), image_name + ".png",
+                                    load_layout(args.baseDir))
 
-        image_path_dst = os.path.join(args.baseDir, "sequence_data", "images", "seq" + str(seq).zfill(4))
-        depth_path_dst = os.path.join(args.baseDir, "sequence_data", "depth", "seq" + str(seq).zfill(4))
+        image_path_dst = os.path.join(image_out_folder, image_name + ".jpg")
+        depth_path_dst = os.path.join(depth_out_folder, image_name + ".png")
 
-        try:
-            shutil.copy(image_path_src, image_path_dst)
-        except OSError as e:
-            print(e)
-            exit(-1)
-        """
-        try:
-            shutil.copy(depth_path_src, depth_path_dst)
-        except OSError as e:
-            print(e)
-            exit(-1)
-        """
+        jobs.append((image_path_src, image_path_dst))
+        # jobs.append((depth_path_src, depth_path_dst))
+
+    return jobs
 
 
 def run(args):
 
     data_file = os.path.join(args.baseDir, "meta", args.name + ".csv")
+    manifest_file = os.path.join(args.baseDir, "meta", args.name + ".manifest")
+
+    if manifest_is_current(manifest_file, data_file):
+        records, _ = load_manifest(manifest_file)
+        image_names = np.char.add("out", np.char.zfill(records["out"].astype(str), 8))
+        sequences = np.asarray(records["sequence"])
+    else:
+        # pandas is only needed without manifest (slow import)
+        import pandas as pd
+        try:
+            data = pd.read_csv(data_file, delimiter=",", header=None)
+        except OSError as e:
+            print("e")
+            print("Data set File does not exist. Aborting ...")
+            return -1
 
-    try:
-        data = pd.read_csv(data_file, delimiter=",", header=None)
-    except OSError as e:
-        print("e")
-        print("Data set File does not exist. Aborting ...")
-        return -1
-
-    image_names = data.iloc[:, 4].values
-    sequences = data.iloc[:, 3].values
+        image_names = data.iloc[:, 4].values
+        # integer id of the sequences (seqXXXXXXXX)
+        sequences = data.iloc[:, 3].str[3:].astype(np.int64).values
 
-    num_seq = get_num_sequences(sequences)
+    grouped_sequences = group_sequences(sequences)
 
     createDir(os.path.join(args.baseDir, "sequence_data", "images"))
     createDir(os.path.join(args.baseDir, "sequence_data", "depth"))
 
-    for seq in tqdm(range(num_seq + 1)):
-        process_sequence(args, seq, sequences, image_names)
+    # create the folders of all sequences at once
+    folders = []
+    for seq, _ in grouped_sequences:
+        folders += get_sequence_folders(args, seq)
+    create_dirs(folders, args.numThreads)
+
+    jobs = []
+    for seq, idx in tqdm(grouped_sequences):
+        jobs += process_sequence(args, seq, idx, image_names)
+
+    done, missing, failed = copy_files(jobs, args.materialize, args.numThreads,
+                                       args.queueDepth, args.retries)
+
+    # store the original of every file, so later stages can resolve it
+    out_dir = os.path.join(args.baseDir, "sequence_data")
+    with open(os.path.join(out_dir, "materialize_log.txt"), "w") as mapping_log:
+        mapping_log.write(f"# materialize: {args.materialize}\n")
+        for src, dst in done:
+            mapping_log.write(os.path.relpath(dst, out_dir) + " " + os.path.realpath(src) + "\n")
+
+    report_errors(missing, failed, os.path.join(out_dir, "copy_error_log.txt"))
 
 
 if __name__ == '__main__':
@@ -79,6 +110,15 @@ if __name__ == '__main__':
                         help="path to folder containing the expected folders (image_left, image_right, meta, disparity)",
                         required=True)
     parser.add_argument("--name", type=str, help="name of the generated dataset (csv file located in meta)", default="training")
+    parser.add_argument("--materialize", type=str, choices=MATERIALIZE_MODES, default="copy",
+                        help="how to create the images (copy, hardlink, reflink or symlink). \
+                              Falls back to the next possible mode if not supported by the file system")
+    parser.add_argument("--numThreads", type=int, default=16,
+                        help="number of threads copying the images")
+    parser.add_argument("--queueDepth", type=int, default=64,
+                        help="maximum number of copies in flight")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="number of retries if copying a file fails (missing files are not retried)")
 
     args = parser.parse_args()
 
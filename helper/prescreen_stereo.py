@@ -0,0 +1,189 @@
+"""
+    Pre-screen the stereo pairs of a data set before computing the optical flow.
+
+    The filtering of get_disp_and_uncertainty.py rejects frames with too many
+    pixels of a large vertical flow (v_threshold / max_v_fail) or a too small
+    range of the horizontal flow (range_threshold), but only after both flows
+    have been computed. Here sparse ORB features are matched between the left
+    and the right image (reduced jpeg decode, CPU only) and the same checks are
+    applied to the displacements of the matches (in pixels of the full image):
+        v_fail - fraction of the matches with |dy| > v_threshold
+        range  - range of dx of the matches passing the vertical check
+                 (percentiles 1 - 99, wrong matches are ignored), only features of the
+                 finest pyramid levels (MAX_OCTAVE) are used as the position of coarse
+                 features is too inaccurate
+    The matches only sample the textured parts of the image, so a frame is
+    only rejected if it fails the checks by a margin (--v_margin, --range_margin)
+    and enough matches were found (--min_matches), all other frames are kept.
+
+    The kept frames are written to meta/prescreen_list.txt and the rejected
+    frames with the reason to meta/prescreen_log.txt. With --remove the rejected
+    images are moved into the folder prescreen_rejected/ so that the flow and
+    the sky segmentation skip them.
+"""
+import os
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+from tqdm import tqdm
+from joblib import Parallel, delayed
+
+from helpers import createDir, update_materialize_log
+from layout import load_layout, frame_file, list_frame_files
+
+
+# pyramid level of the features used for the range and minimum number of them
+MAX_OCTAVE = 1
+MIN_RANGE_MATCHES = 10
+
+REDUCE_FLAGS = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def match_displacements(orb, matcher, left, right, ratio=0.8):
+    """Displacements (dx, dy) of the matched ORB features from the left to the right image
+
+    Returns the displacements and the pyramid level of the matches (maximum of both features).
+    """
+    kp_left, des_left = orb.detectAndCompute(left, None)
+    kp_right, des_right = orb.detectAndCompute(right, None)
+    if des_left is None or des_right is None or len(kp_right) < 2:
+        return np.zeros((0, 2), dtype=np.float32), np.zeros(0, dtype=int)
+
+    matches = [m[0] for m in matcher.knnMatch(des_left, des_right, k=2)
+               if len(m) == 2 and m[0].distance < ratio * m[1].distance]
+    if not matches:
+        return np.zeros((0, 2), dtype=np.float32), np.zeros(0, dtype=int)
+
+    pts_left = np.float32([kp_left[m.queryIdx].pt for m in matches])
+    pts_right = np.float32([kp_right[m.trainIdx].pt for m in matches])
+    octaves = np.array([max(kp_left[m.queryIdx].octave, kp_right[m.trainIdx].octave) for m in matches])
+    return pts_right - pts_left, octaves
+
+
+def screen_frame(args, name):
+    """Check a stereo pair, returns (name, verdict, number of matches, v_fail, range)
+
+    The verdict is "0" if the frame is kept, otherwise the reason (range is None if not checked).
+    """
+    layout = load_layout(args.baseDir)
+    left = cv2.imread(frame_file(os.path.join(args.baseDir, "image_left"), name + ".jpg", layout),
+                      REDUCE_FLAGS[args.reduce])
+    right = cv2.imread(frame_file(os.path.join(args.baseDir, "image_right"), name + ".jpg", layout),
+                       REDUCE_FLAGS[args.reduce])
+    if left is None or right is None:
+        # missing images are reported by the later stages
+        return name, "0", 0, 0.0, None
+
+    orb = cv2.ORB_create(nfeatures=args.features)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    disp, octaves = match_displacements(orb, matcher, left, right)
+    disp *= args.reduce
+    if len(disp) < args.min_matches:
+        return name, "0", len(disp), 0.0, None
+
+    dx, dy = disp[:, 0], disp[:, 1]
+    check_v = np.abs(dy) > args.v_threshold
+    v_fail = 1.0 * np.count_nonzero(check_v) / len(dy)
+    if v_fail >= args.max_v_fail + args.v_margin:
+        return name, "v_fail too large", len(disp), v_fail, None
+
+    fine = ~check_v & (octaves <= MAX_OCTAVE)
+    if np.count_nonzero(fine) < MIN_RANGE_MATCHES:
+        return name, "0", len(disp), v_fail, None
+    low, high = np.percentile(dx[fine], [1, 99])
+    u_range = float(high - low)
+    if u_range <= args.range_threshold * args.range_margin:
+        return name, "range too small", len(disp), v_fail, u_range
+    return name, "0", len(disp), v_fail, u_range
+
+
+def screen_frames(args, names):
+    return [screen_frame(args, name) for name in names]
+
+
+def move_rejected(args, rejected):
+    # the materialize log keeps the originals of the moved (linked) images
+    moved = {}
+    for folder in ["image_left", "image_right"]:
+        out_folder = os.path.join(args.baseDir, "prescreen_rejected", folder)
+        createDir(out_folder, verbose=False)
+        for name in rejected:
+            src = frame_file(os.path.join(args.baseDir, folder), name + ".jpg", load_layout(args.baseDir))
+            if os.path.exists(src):
+                os.replace(src, os.path.join(out_folder, name + ".jpg"))
+                moved[src] = os.path.join(out_folder, name + ".jpg")
+    update_materialize_log(args.baseDir, moved)
+
+
+def run(args):
+
+    names = sorted(os.path.basename(f)[:-len(".jpg")]
+                   for f in list_frame_files(os.path.join(args.baseDir, "image_left"), ".jpg"))
+
+    num_cores = min(args.numCores, multiprocessing.cpu_count())
+    print(f"Screening {len(names)} stereo pairs on {num_cores} cores ...")
+
+    # screen the frames in chunks to reduce the overhead of the workers
+    chunk_size = 64
+    chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+    results = Parallel(n_jobs=num_cores)(delayed(screen_frames)(args, chunk) for chunk in tqdm(chunks))
+    results = [r for chunk in results for r in chunk]
+
+    kept = [name for name, verdict, _, _, _ in results if verdict == "0"]
+    rejected = [r for r in results if r[1] != "0"]
+
+    createDir(os.path.join(args.baseDir, "meta"), verbose=False)
+    with open(os.path.join(args.baseDir, "meta", "prescreen_list.txt"), "w") as fp:
+        for name in kept:
+            fp.write(name + "\n")
+
+    with open(os.path.join(args.baseDir, "meta", "prescreen_log.txt"), "w") as fp:
+        fp.write("## Log file for the pre-screening of the stereo pairs\n\n")
+        fp.write(f"# v_threshold: {args.v_threshold} - threshold vertical displacement check\n")
+        fp.write(f"# max_v_fail: {args.max_v_fail} (+ v_margin {args.v_margin}) - max percentage of matches that "
+                 f"fail vertical displacement check\n")
+        fp.write(f"# range_threshold: {args.range_threshold} (* range_margin {args.range_margin}) - threshold for "
+                 f"horizontal displacement range check\n")
+        fp.write(f"# min_matches: {args.min_matches} - frames with less matches are kept\n\n")
+        for name, verdict, num_matches, v_fail, u_range in rejected:
+            range_text = f"{u_range:.2f}" if u_range is not None else "-"
+            fp.write(f"{name} {verdict} matches: {num_matches} v_fail: {v_fail:.3f} range: {range_text}\n")
+        fp.write(f"\nPercentage of rejected images: {len(rejected) / max(len(names), 1)}")
+
+    print(f"Kept {len(kept)} of {len(names)} frames ({len(rejected)} rejected)")
+
+    if args.remove:
+        move_rejected(args, [r[0] for r in rejected])
+        print(f"Moved the rejected frames to {os.path.join(args.baseDir, 'prescreen_rejected')}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="reject stereo pairs that would fail the filtering of the disparity before computing the flow \
+                     (run after createDataSet.py)")
+
+    parser.add_argument("--baseDir", type=str, required=True,
+                        help="path to folder of the data set (containing image_left, image_right, meta)")
+    parser.add_argument("--v_threshold", type=float, default=2, help="threshold vertical displacement check")
+    parser.add_argument("--max_v_fail", type=float, default=0.1,
+                        help="max percentage of matches that fail vertical displacement check")
+    parser.add_argument("--range_threshold", type=float, default=10,
+                        help="threshold for horizontal displacement range check")
+    parser.add_argument("--v_margin", type=float, default=0.2,
+                        help="frames are rejected if the percentage of failing matches exceeds max_v_fail by v_margin")
+    parser.add_argument("--range_margin", type=float, default=0.4,
+                        help="frames are rejected if the range is below range_threshold * range_margin")
+    parser.add_argument("--min_matches", type=int, default=50, help="frames with less matches are kept")
+    parser.add_argument("--features", type=int, default=1000, help="number of ORB features per image")
+    parser.add_argument("--reduce", type=int, default=2, choices=[1, 2, 4, 8],
+                        help="factor the images are reduced by when decoding")
+    parser.add_argument("--remove", action="store_true",
+                        help="move the rejected frames into the folder prescreen_rejected/")
+    parser.add_argument("--numCores", type=int, default=8, help="number of cores")
+
+    args = parser.parse_args()
+
+    run(args)
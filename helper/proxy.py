@@ -0,0 +1,37 @@
+"""
+    Access to the low resolution proxy frames written by splitImagesChapters.py.
+
+    For every chapter the proxies of the left images are stored in
+    sbs_frames/image_meta/<video>/proxy/ as
+        chapterN_color.npy - N x H x W x 3 uint8
+        chapterN_gray.npy  - N x H x W uint8
+        chapterN_index.txt - image name of every row
+"""
+import os
+import glob
+import numpy as np
+
+
+def get_proxy_dir(baseDir, videoName):
+    return os.path.join(baseDir, "sbs_frames", "image_meta", videoName, "proxy")
+
+
+def get_proxy_chapters(baseDir, videoName):
+    """Get the names (chapterN) of all chapters with proxies"""
+    files = glob.glob(os.path.join(get_proxy_dir(baseDir, videoName), "*_index.txt"))
+    return sorted((os.path.basename(f)[:-len("_index.txt")] for f in files),
+                  key=lambda c: int(c[len("chapter"):]))
+
+
+def load_proxies(baseDir, videoName, chapter, color=False):
+    """Memory map the proxies of a chapter
+
+    Returns the proxy array and a dict image name -> row.
+    """
+    prefix = os.path.join(get_proxy_dir(baseDir, videoName), chapter)
+
+    proxies = np.load(prefix + ("_color.npy" if color else "_gray.npy"), mmap_mode="r")
+    with open(prefix + "_index.txt", "r") as fp:
+        index = {name.rstrip("\n"): i for i, name in enumerate(fp)}
+
+    return proxies, index
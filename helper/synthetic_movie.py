@@ -0,0 +1,389 @@
+"""
+    Synthetic side-by-side stereo movies with known per-pixel disparity.
+
+    A movie consists of chapters, every chapter of scenes separated by hard cuts.
+    Every scene shows a textured background plane (disparity changing from the
+    top to the bottom of the frame) and a few textured objects in front of it.
+    The camera pans over the background and the objects move, so consecutive
+    frames differ like in a real movie. The content is letterboxed with black
+    bars at the top and bottom.
+
+    Everything is generated from the seed, so only the parameters of the movie
+    are stored (synthetic.json) and the ground truth disparity of any frame is
+    rendered again when needed (SyntheticMovie.render).
+
+    Disparity is given in pixels of the full resolution frame as
+    x_left - x_right, i.e. the same convention as get_disp_and_uncertainty.py
+    (disparity = -forward flow).
+
+    Two kinds of output are supported:
+        mkv     - sbs_videos/<name>/<name>.mkv (encoded with ffmpeg) as written by convertToSbs.sh
+        frames  - the output of the ffmpeg extraction in run_extractFrames.sh (stand-in if ffmpeg
+                  is not available): sbs_frames/image_raw/<name>/chapterN/out%08d.jpg,
+                  sbs_frames/image_meta/<name>/logN.txt and shots.txt
+        raw     - the decoded sbs stream (rawvideo yuv420p on stdout, like FRIMDecode -o - -sbs),
+                  stand-in decoder for convertToSbs.sh (--frames first:end to decode a segment)
+        chapters - only the chapters and the parameters (stand-in for the chapters of the mvc
+                  video, written before the stand-in decoder is run)
+    Except for raw the chapters are written to sbs_videos/<name>/chapters.txt.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+import cv2
+from joblib import Parallel, delayed
+
+
+class SyntheticMovie:
+
+    def __init__(self, seed=0, chapters=5, chapter_seconds=6.0, scene_seconds=3.0,
+                 width=1920, height=1080, letterbox=140, fps=(24000, 1001)):
+        self.params = {"seed": seed, "chapters": chapters, "chapter_seconds": chapter_seconds,
+                       "scene_seconds": scene_seconds, "width": width, "height": height,
+                       "letterbox": letterbox, "fps": list(fps)}
+        self.seed = seed
+        self.width = width
+        self.height = height
+        self.letterbox = letterbox
+        self.fps_fraction = tuple(fps)
+        self.fps = fps[0] / fps[1]
+
+        self.chapters, self.scenes = self.create_layout(chapters, chapter_seconds, scene_seconds)
+        self.num_frames = self.chapters[-1][1]
+        self.cache = (None, None)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, "r") as fp:
+            return SyntheticMovie(**json.load(fp))
+
+    def save(self, filename):
+        with open(filename, "w") as fp:
+            json.dump(self.params, fp, indent=True)
+
+    def create_layout(self, num_chapters, chapter_seconds, scene_seconds):
+        """Split the movie into chapters and scenes ([start, end) frame indices)
+
+        group_frames_to_scenes.py only uses the scenes between two cuts inside a
+        chapter (the last scene of a chapter is dropped), so every chapter has at
+        least three scenes.
+        """
+        rng = np.random.default_rng(self.seed)
+
+        chapters, scenes = [], []
+        start = 0
+        for _ in range(num_chapters):
+            num_frames = int(chapter_seconds * self.fps * rng.uniform(0.8, 1.2))
+            num_scenes = max(3, int(round(chapter_seconds / scene_seconds)))
+
+            weights = rng.uniform(0.6, 1.4, num_scenes)
+            bounds = start + np.round(np.cumsum(weights) / weights.sum() * num_frames).astype(int)
+            scene_start = start
+            for scene_end in bounds:
+                scenes.append((scene_start, int(scene_end)))
+                scene_start = int(scene_end)
+
+            chapters.append((start, start + num_frames))
+            start += num_frames
+
+        return chapters, scenes
+
+    def frame_time(self, frame):
+        return frame * self.fps_fraction[1] / self.fps_fraction[0]
+
+    def chapter_times(self):
+        """Start and end time of the chapters (half a frame before the first frame)"""
+        half_frame = 0.5 / self.fps
+        return [(max(self.frame_time(start) - half_frame, 0), self.frame_time(end) - half_frame)
+                for start, end in self.chapters]
+
+    def cut_times(self):
+        return [self.frame_time(start) for start, _ in self.scenes if start > 0]
+
+    def scene_index(self, frame):
+        for i, (start, end) in enumerate(self.scenes):
+            if start <= frame < end:
+                return i
+        raise IndexError(f"frame {frame} is not part of the movie ({self.num_frames} frames)")
+
+    def get_scene(self, idx):
+        if self.cache[0] != idx:
+            self.cache = (idx, create_scene(np.random.default_rng([self.seed, idx]),
+                                            self.width, self.height - 2 * self.letterbox,
+                                            self.scenes[idx][1] - self.scenes[idx][0]))
+        return self.cache[1]
+
+    def render(self, frame, images=True):
+        """Render a frame
+
+        Returns the sbs frame (height x 2 * width x 3, uint8, BGR - None if not images)
+        and the disparity of the left and the right view (height x width, float32).
+        """
+        idx = self.scene_index(frame)
+        scene = self.get_scene(idx)
+        left, right, disp_left, disp_right = render_scene(scene, frame - self.scenes[idx][0], images)
+
+        top = self.letterbox
+        bottom = self.height - self.letterbox
+
+        full_disp_left = np.zeros((self.height, self.width), dtype=np.float32)
+        full_disp_right = np.zeros((self.height, self.width), dtype=np.float32)
+        full_disp_left[top:bottom] = disp_left
+        full_disp_right[top:bottom] = disp_right
+
+        sbs = None
+        if images:
+            sbs = np.zeros((self.height, 2 * self.width, 3), dtype=np.uint8)
+            sbs[top:bottom, :self.width] = left
+            sbs[top:bottom, self.width:] = right
+
+        return sbs, full_disp_left, full_disp_right
+
+
+def make_texture(rng, height, width):
+    """Colored noise with structure on multiple scales"""
+    base = rng.uniform(40, 215, size=3)
+    contrast = rng.uniform(120, 220)
+
+    texture = np.zeros((height, width, 3), dtype=np.float32)
+    for cell, weight in ((96, 0.45), (24, 0.35), (6, 0.2)):
+        noise = rng.random((height // cell + 2, width // cell + 2, 3), dtype=np.float32)
+        texture += weight * cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    return np.clip(base + contrast * (texture - 0.5), 0, 255).astype(np.float32)
+
+
+def make_shape(rng, height, width):
+    """Alpha mask of an ellipse or a rectangle filling the sprite"""
+    if rng.random() < 0.5:
+        alpha = np.ones((height, width), dtype=np.float32)
+        alpha[[0, -1], :] = 0.5
+        alpha[:, [0, -1]] = 0.5
+        return alpha
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(mask, (width // 2, height // 2), (width // 2 - 1, height // 2 - 1), 0, 0, 360, 255, -1, cv2.LINE_AA)
+    return mask.astype(np.float32) / 255
+
+
+def create_scene(rng, width, height, num_frames):
+    """Random background plane and objects of a scene"""
+    # background: disparity changes linearly from the top to the bottom row
+    disp_top = rng.uniform(-12, 2)
+    disp_bottom = disp_top + rng.uniform(2, 20)
+    velocity = (rng.uniform(-3, 3), rng.uniform(-0.5, 0.5))
+
+    margin_x = int(abs(velocity[0]) * num_frames + 2 * max(abs(disp_top), abs(disp_bottom))) + 8
+    margin_y = int(abs(velocity[1]) * num_frames) + 8
+    background = {
+        "texture": make_texture(rng, height + margin_y, width + margin_x),
+        "start": (margin_x / 2 - velocity[0] * num_frames / 2, margin_y / 2 - velocity[1] * num_frames / 2),
+        "velocity": velocity,
+        "disparity": np.linspace(disp_top, disp_bottom, height, dtype=np.float32)[:, None],
+    }
+
+    objects = []
+    for _ in range(rng.integers(2, 6)):
+        h, w = int(rng.uniform(100, 400)), int(rng.uniform(120, 480))
+        alpha = make_shape(rng, h, w)
+        objects.append({
+            "sprite": make_texture(rng, h, w) * alpha[:, :, None],
+            "alpha": alpha,
+            "start": (rng.uniform(-w / 2, width - w / 2), rng.uniform(-h / 2, height - h / 2)),
+            "velocity": (rng.uniform(-4, 4), rng.uniform(-1.5, 1.5)),
+            "disparity": disp_bottom + rng.uniform(2, 25),
+        })
+    # paint from back to front
+    objects.sort(key=lambda o: o["disparity"])
+
+    return {"width": width, "height": height, "background": background, "objects": objects}
+
+
+def paste(image, disp, sprite, alpha, x, y, disparity):
+    """Blend a (premultiplied) sprite at the sub-pixel position x, y into the image and the disparity"""
+    ix, iy = int(np.floor(x)), int(np.floor(y))
+    h, w = alpha.shape
+    M = np.float32([[1, 0, x - ix], [0, 1, y - iy]])
+
+    alpha = cv2.warpAffine(alpha, M, (w + 1, h + 1), flags=cv2.INTER_LINEAR, borderValue=0)
+
+    height, width = disp.shape
+    x0, x1 = max(ix, 0), min(ix + w + 1, width)
+    y0, y1 = max(iy, 0), min(iy + h + 1, height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    a = alpha[y0 - iy:y1 - iy, x0 - ix:x1 - ix]
+
+    disp_region = disp[y0:y1, x0:x1]
+    disp_region[a >= 0.5] = disparity
+
+    if image is not None:
+        sprite = cv2.warpAffine(sprite, M, (w + 1, h + 1), flags=cv2.INTER_LINEAR, borderValue=0)
+        image[y0:y1, x0:x1] = image[y0:y1, x0:x1] * (1 - a[:, :, None]) + sprite[y0 - iy:y1 - iy, x0 - ix:x1 - ix]
+
+
+def render_scene(scene, t, images=True):
+    """Render the left and right view and their disparity at frame t of the scene"""
+    width, height = scene["width"], scene["height"]
+    bg = scene["background"]
+
+    pan_x = bg["start"][0] + bg["velocity"][0] * t
+    pan_y = bg["start"][1] + bg["velocity"][1] * t
+
+    disp_left = np.repeat(bg["disparity"], width, axis=1)
+    disp_right = disp_left.copy()
+
+    left, right = None, None
+    if images:
+        grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        # a pixel x of the left view is visible at x - disparity in the right view
+        left = cv2.remap(bg["texture"], grid_x + pan_x, grid_y + pan_y, cv2.INTER_LINEAR)
+        right = cv2.remap(bg["texture"], grid_x + pan_x + disp_left, grid_y + pan_y, cv2.INTER_LINEAR)
+
+    for o in scene["objects"]:
+        x = o["start"][0] + o["velocity"][0] * t
+        y = o["start"][1] + o["velocity"][1] * t
+        paste(left, disp_left, o["sprite"], o["alpha"], x, y, o["disparity"])
+        paste(right, disp_right, o["sprite"], o["alpha"], x - o["disparity"], y, o["disparity"])
+
+    if images:
+        left = np.clip(left, 0, 255).astype(np.uint8)
+        right = np.clip(right, 0, 255).astype(np.uint8)
+
+    return left, right, disp_left, disp_right
+
+
+def visible_in_right(disp_left, disp_right):
+    """Mask of the pixels of the left view that are not occluded in (or outside of) the right view"""
+    height, width = disp_left.shape
+    x_right = np.round(np.arange(width)[None, :] - disp_left).astype(np.int64)
+    inside = (x_right >= 0) & (x_right < width)
+
+    rows = np.repeat(np.arange(height)[:, None], width, axis=1)
+    disp_at_right = disp_right[rows, np.clip(x_right, 0, width - 1)]
+
+    return inside & (np.abs(disp_at_right - disp_left) < 0.5)
+
+
+def write_log_line(fp, n, pts_time):
+    # same fields as the showinfo filter of ffmpeg (parsed by group_frames_to_scenes.py)
+    fp.write(f"[Parsed_showinfo_0 @ 0x0] n:{n:5d} pts:{int(round(pts_time * 1000)):7d} "
+             f"pts_time:{pts_time:<10.6g} pos:-1 fmt:yuvj420p sar:1/1 s:3840x1080\n")
+
+
+def write_chapter_frames(movie, raw_dir, meta_dir, chapter_idx, quality):
+    start, end = movie.chapters[chapter_idx - 1]
+    out_dir = os.path.join(raw_dir, f"chapter{chapter_idx}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    with open(os.path.join(meta_dir, f"log{chapter_idx}.txt"), "w") as fp:
+        for n, frame in enumerate(range(start, end)):
+            sbs, _, _ = movie.render(frame)
+            cv2.imwrite(os.path.join(out_dir, "out{}.jpg".format(str(n + 1).zfill(8))), sbs,
+                        [cv2.IMWRITE_JPEG_QUALITY, quality])
+            write_log_line(fp, n, movie.frame_time(frame))
+
+    return end - start
+
+
+def write_frames(movie, base_dir, name, quality=95, num_cores=8):
+    """Write the extracted raw frames, the frame logs and the shot list (as run_extractFrames.sh)"""
+    raw_dir = os.path.join(base_dir, "sbs_frames", "image_raw", name)
+    meta_dir = os.path.join(base_dir, "sbs_frames", "image_meta", name)
+    os.makedirs(meta_dir, exist_ok=True)
+
+    # the cuts as detected by ffprobe (parsed by processShotFile)
+    with open(os.path.join(meta_dir, "shots.txt"), "w") as fp:
+        for t in movie.cut_times():
+            fp.write(f"media_type=video|stream_index=0|key_frame=0|pkt_pts={int(round(t * 1000))}|"
+                     f"pkt_pts_time={t:.6f}|lavfi.scene_score=1.000000\n")
+
+    # every chapter is rendered by its own worker
+    num_frames = Parallel(n_jobs=min(num_cores, len(movie.chapters)))(
+        delayed(write_chapter_frames)(movie, raw_dir, meta_dir, i + 1, quality)
+        for i in range(len(movie.chapters)))
+
+    return sum(num_frames)
+
+
+def write_video(movie, filename, crf=16, preset="veryfast"):
+    """Encode the movie with ffmpeg (x264, as convertToSbs.sh)"""
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "bgr24",
+           "-s:v", f"{2 * movie.width}x{movie.height}", "-r", "{}/{}".format(*movie.fps_fraction),
+           "-i", "-", "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p", filename]
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    for frame in range(movie.num_frames):
+        sbs, _, _ = movie.render(frame)
+        proc.stdin.write(sbs.tobytes())
+    proc.stdin.close()
+
+    if proc.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed with return code {proc.returncode}")
+
+    return movie.num_frames
+
+
+def write_stream(movie, stream, first=0, end=None):
+    """Write the decoded frames [first, end) as rawvideo (yuv420p) to the stream"""
+    end = movie.num_frames if end is None else min(end, movie.num_frames)
+    for frame in range(first, end):
+        sbs, _, _ = movie.render(frame)
+        stream.write(cv2.cvtColor(sbs, cv2.COLOR_BGR2YUV_I420).tobytes())
+    stream.flush()
+
+    return max(end - first, 0)
+
+
+def write_movie(movie, base_dir, name, source="frames", num_cores=8, frames=(0, None)):
+    """Write the movie, its chapters and its parameters into the base dir"""
+    if source == "raw":
+        return write_stream(movie, sys.stdout.buffer, *frames)
+
+    video_dir = os.path.join(base_dir, "sbs_videos", name)
+    os.makedirs(video_dir, exist_ok=True)
+
+    movie.save(os.path.join(video_dir, "synthetic.json"))
+    with open(os.path.join(video_dir, "chapters.txt"), "w") as fp:
+        for start, end in movie.chapter_times():
+            fp.write(f"{start:.6f},{end:.6f}\n")
+
+    if source == "mkv":
+        return write_video(movie, os.path.join(video_dir, name + ".mkv"))
+    if source == "chapters":
+        return 0
+    return write_frames(movie, base_dir, name, num_cores=num_cores)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="render a synthetic sbs stereo movie with known disparity")
+    parser.add_argument("--baseDir", type=str, required=True,
+                        help="path to folder containing the expected folders (sbs_videos, sbs_frames)")
+    parser.add_argument("--name", type=str, default="synthetic_SBS", help="name of the movie")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the movie")
+    parser.add_argument("--chapters", type=int, default=5,
+                        help="number of chapters (the first and the last two are not used for the data set)")
+    parser.add_argument("--chapterSeconds", type=float, default=6.0, help="mean length of a chapter")
+    parser.add_argument("--sceneSeconds", type=float, default=3.0, help="mean length of a scene")
+    parser.add_argument("--letterbox", type=int, default=140, help="height of the black bars at the top and bottom")
+    parser.add_argument("--source", type=str, default="frames", choices=["frames", "mkv", "raw", "chapters"],
+                        help="write an sbs video (mkv, requires ffmpeg), the extracted raw frames (frames), \
+                              the decoded stream to stdout (raw) or only the chapters (chapters)")
+    parser.add_argument("--frames", type=str, default="0:",
+                        help="frames first:end of the movie written to the stream (--source raw)")
+    parser.add_argument("--numCores", type=int, default=8, help="number of cores used to write the frames")
+
+    args = parser.parse_args()
+
+    first, end = args.frames.split(":")
+    movie = SyntheticMovie(seed=args.seed, chapters=args.chapters, chapter_seconds=args.chapterSeconds,
+                           scene_seconds=args.sceneSeconds, letterbox=args.letterbox)
+    num_frames = write_movie(movie, args.baseDir, args.name, args.source, args.numCores,
+                             (int(first or 0), int(end) if end else None))
+    # stdout is the stream with --source raw
+    print(f"Wrote {num_frames} frames ({len(movie.chapters)} chapters, {len(movie.scenes)} scenes) of {args.name}",
+          file=sys.stderr if args.source == "raw" else sys.stdout)
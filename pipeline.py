@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+"""
+    Run the complete movie -> disparity pipeline.
+
+    The individual steps (see README) are modeled as stages with declared
+    inputs, outputs and parameters. Every stage gets a fingerprint computed
+    from its command, its parameters, its external inputs and the fingerprints
+    of the stages it depends on. Stages whose fingerprint did not change and
+    whose outputs exist are skipped, so a parameter change only recomputes the
+    affected stage and everything downstream of it.
+
+    The per movie stages (convert, extract, group) of different movies run
+    concurrently (limited by --jobs). The data set stages run once for all
+    movies afterwards.
+
+    The state of the stages and the timing of the last run are stored in
+    ${base_dir}/pipeline_state/.
+"""
+import os
+import sys
+import json
+import time
+import glob
+import hashlib
+import argparse
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from helper.helpers import MATERIALIZE_MODES
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MOVIE_STAGES = ["convert", "extract", "group"]
+DATASET_STAGES = ["dataset", "create", "dedup", "prescreen", "flow", "skykeys", "sky", "skyprop", "disparity"]
+
+
+def stage(name, movie, cmd, deps, inputs=(), outputs=(), params=None, runtime_args=()):
+    """Create the description of a stage
+
+    cmd is the command to run (None for stages that are run manually),
+    deps the keys of the stages this stage depends on, inputs the external
+    input files and outputs the files/folders produced by the stage.
+    runtime_args are appended to cmd but do not change the result (e.g. the
+    number of jobs), so they are not part of the fingerprint.
+    """
+    return {
+        "name": name,
+        "movie": movie,
+        "key": name if movie is None else f"{name}:{movie}",
+        "cmd": cmd,
+        "deps": list(deps),
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "params": params or {},
+        "runtime_args": list(runtime_args),
+    }
+
+
+def movie_stages(args, movie):
+    base = args.baseDir
+    sbs_name = movie + "_SBS"
+    meta_dir = os.path.join(base, "sbs_frames", "image_meta", sbs_name)
+
+    # without the x264 sbs video the frames are extracted from the decoder output while converting
+    # (the default commands are unchanged, so the fingerprints of existing runs stay valid)
+    convert_cmd = ["bash", os.path.join(REPO_DIR, "convertToSbs.sh"), movie, base, args.frimDecode]
+    extract_cmd = ["bash", os.path.join(REPO_DIR, "run_extractFrames.sh"), sbs_name, base, args.crop]
+    convert_outputs = [os.path.join(base, "sbs_videos", sbs_name, "chapters.txt")]
+    if args.sbsMode != "x264" or args.convertJobs > 1:
+        convert_cmd.append(args.sbsMode)
+    if args.convertJobs > 1:
+        convert_cmd.append(str(args.convertJobs))
+    if args.sbsMode != "x264":
+        extract_cmd.append("raw")
+        convert_outputs.append(os.path.join(meta_dir, "shots.txt"))
+    if args.sbsMode != "raw":
+        convert_outputs.append(os.path.join(base, "sbs_videos", sbs_name, sbs_name + ".mkv"))
+
+    return [
+        stage("convert", movie,
+              convert_cmd,
+              deps=[],
+              inputs=[os.path.join(base, "mvc_videos", movie + ".mkv")],
+              outputs=convert_outputs),
+        stage("extract", movie,
+              extract_cmd,
+              deps=[f"convert:{movie}"],
+              outputs=[os.path.join(meta_dir, "shots.txt"),
+                       os.path.join(meta_dir, "timingChapters.txt")]),
+        stage("group", movie,
+              [sys.executable, os.path.join(REPO_DIR, "group_frames_to_scenes.py"),
+               "--baseDir", base, "--whitelist", sbs_name],
+              deps=[f"extract:{movie}"],
+              outputs=[os.path.join(meta_dir, "sceneFramesRaw.json")]),
+    ]
+
+
+def dataset_stages(args, movies):
+    base = args.baseDir
+    out = args.outDir
+    name = args.name + "_sampleFPS_{}".format(args.sampleFPS)
+    meta_dir = os.path.join(base, "sbs_frames", "image_meta")
+
+    # the stages reading the images run after the dedup / pre-screening (dropped frames are moved out of the data set)
+    dedup_dep = "dedup" if args.dedup else "create"
+    images_dep = "prescreen" if args.prescreen else dedup_dep
+
+    if args.disparityEngine == "stereo":
+        disparity_cmd = [sys.executable, os.path.join(REPO_DIR, "get_disp_stereo.py"), out, "--name", name]
+        disparity_deps = [images_dep]
+    else:
+        disparity_cmd = [sys.executable, os.path.join(REPO_DIR, "get_disp_and_uncertainty.py"), out]
+        disparity_deps = ["flow"]
+    disparity_deps.append("skyprop" if args.skyKeyframes else "sky")
+    if args.use_filtering:
+        disparity_cmd.append("--use_filtering")
+
+    if args.skyKeyframes:
+        # the segmentation runs only on the keyframes (layout of a data set in sky_keyframes/), the masks
+        # are propagated to the other frames afterwards (see sky_keyframes.py)
+        key_dir = os.path.join(out, "sky_keyframes")
+        sky_stages = [
+            stage("skykeys", None,
+                  [sys.executable, os.path.join(REPO_DIR, "sky_keyframes.py"), "select", out],
+                  deps=[images_dep],
+                  outputs=[os.path.join(out, "meta", "sky_keyframes.json"), os.path.join(key_dir, "image_left")]),
+            stage("sky", None,
+                  args.skyCmd.format(dataset=key_dir).split() if args.skyCmd else None,
+                  deps=["skykeys"],
+                  outputs=[os.path.join(key_dir, "sky_segmentation")]),
+            stage("skyprop", None,
+                  [sys.executable, os.path.join(REPO_DIR, "sky_keyframes.py"), "propagate", out],
+                  deps=["sky"],
+                  outputs=[os.path.join(out, "sky_segmentation")]),
+        ]
+    else:
+        sky_stages = [
+            stage("sky", None,
+                  args.skyCmd.format(dataset=out).split() if args.skyCmd else None,
+                  deps=[images_dep],
+                  outputs=[os.path.join(out, "sky_segmentation")]),
+        ]
+
+    stages = [
+        stage("dataset", None,
+              [sys.executable, os.path.join(REPO_DIR, "gen_data_set.py"), "--baseDir", base,
+               "--name", args.name, "--sampleFPS", str(args.sampleFPS),
+               "--sceneCoverage", str(args.sceneCoverage)],
+              runtime_args=["--jobs", str(args.jobs)],
+              deps=[f"group:{m}" for m in movies],
+              outputs=[os.path.join(meta_dir, name + ".txt"),
+                       os.path.join(meta_dir, name + ".json")]),
+        stage("create", None,
+              [sys.executable, os.path.join(REPO_DIR, "helper", "createDataSet.py"),
+               "--baseDir", base, "--name", name, "--outDir", out,
+               "--materialize", args.materialize],
+              deps=["dataset"],
+              outputs=[os.path.join(out, "meta", "image_mapping_log.txt")]),
+        stage("dedup", None,
+              [sys.executable, os.path.join(REPO_DIR, "helper", "dedup_data_set.py"), "--baseDir", out,
+               "--name", name, "--remove"],
+              deps=["create"],
+              outputs=[os.path.join(out, "meta", "dedup_list.txt")]),
+        stage("prescreen", None,
+              [sys.executable, os.path.join(REPO_DIR, "helper", "prescreen_stereo.py"), "--baseDir", out, "--remove"],
+              deps=[dedup_dep],
+              outputs=[os.path.join(out, "meta", "prescreen_list.txt")]),
+        stage("flow", None,
+              args.flowCmd.format(dataset=out).split() if args.flowCmd else None,
+              deps=[images_dep],
+              outputs=[os.path.join(out, "flow_forward"), os.path.join(out, "flow_backward")]),
+    ] + sky_stages + [
+        stage("disparity", None,
+              disparity_cmd,
+              deps=disparity_deps,
+              outputs=[os.path.join(out, "disparity"), os.path.join(out, "uncertainty")]),
+    ]
+
+    # the stereo engine computes the disparity directly from the images
+    if args.disparityEngine == "stereo":
+        stages = [s for s in stages if s["name"] != "flow"]
+    if not args.dedup:
+        stages = [s for s in stages if s["name"] != "dedup"]
+    if not args.prescreen:
+        stages = [s for s in stages if s["name"] != "prescreen"]
+    if args.layout != "flat":
+        next(s for s in stages if s["name"] == "create")["cmd"] += ["--layout", args.layout]
+
+    return stages
+
+
+def stat_fingerprint(path):
+    """Cheap fingerprint of an external input (size and modification time)"""
+    if not os.path.exists(path):
+        return [path, None]
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+def compute_fingerprints(stages):
+    """Compute the fingerprint of all stages (stages need to be topologically sorted)"""
+    fingerprints = {}
+    for s in stages:
+        content = {
+            "cmd": s["cmd"],
+            "params": s["params"],
+            "inputs": [stat_fingerprint(p) for p in s["inputs"]],
+            "deps": [fingerprints[d] for d in s["deps"]],
+        }
+        fingerprints[s["key"]] = hashlib.sha1(
+            json.dumps(content, sort_keys=True).encode()).hexdigest()
+    return fingerprints
+
+
+def get_state_file(args, s):
+    return os.path.join(args.baseDir, "pipeline_state", s["key"].replace(":", "__") + ".json")
+
+
+def outputs_exist(s):
+    return all(os.path.exists(p) for p in s["outputs"])
+
+
+def is_up_to_date(args, s, fingerprint):
+    if s["name"] in args.force:
+        return False
+
+    # inputs provided externally (e.g. a movie that is already in the SBS format)
+    if any(not os.path.exists(p) for p in s["inputs"]) and outputs_exist(s):
+        return True
+
+    state_file = get_state_file(args, s)
+    if not os.path.exists(state_file) or not outputs_exist(s):
+        return False
+
+    with open(state_file, "r") as fp:
+        return json.load(fp)["fingerprint"] == fingerprint
+
+
+class StageFailed(Exception):
+    pass
+
+
+print_lock = threading.Lock()
+
+
+def log(message):
+    with print_lock:
+        print(message, flush=True)
+
+
+def run_stage(args, s, fingerprint, timings, lock):
+    if is_up_to_date(args, s, fingerprint):
+        log(f"[{s['key']}] up to date")
+        return
+
+    if s["cmd"] is None:
+        if outputs_exist(s):
+            log(f"[{s['key']}] no command given - using existing outputs")
+            return
+        raise StageFailed(f"[{s['key']}] no command given and outputs missing: {s['outputs']}")
+
+    cmd = s["cmd"] + s["runtime_args"]
+    env = None
+    if args.service:
+        # run the python scripts (also the ones started by the shell scripts) in the worker service
+        if cmd[0] == sys.executable:
+            cmd = [sys.executable, os.path.join(REPO_DIR, "worker_service.py"), "run", "--socket", args.service] + cmd[1:]
+        env = dict(os.environ, WORKER_SOCKET=args.service)
+    log(f"[{s['key']}] running: {' '.join(cmd)}")
+    if args.dry_run:
+        return
+
+    log_file = os.path.join(args.baseDir, "pipeline_state", "logs",
+                            s["key"].replace(":", "__") + ".log")
+    start_time = time.time()
+    with open(log_file, "w") as log_fp:
+        ret = subprocess.call(cmd, cwd=REPO_DIR, stdout=log_fp, stderr=subprocess.STDOUT, env=env)
+    duration = time.time() - start_time
+
+    with lock:
+        timings.append({"stage": s["name"], "movie": s["movie"], "seconds": duration, "returncode": ret})
+
+    if ret != 0:
+        raise StageFailed(f"[{s['key']}] failed with return code {ret} (see {log_file})")
+
+    with open(get_state_file(args, s), "w") as fp:
+        json.dump({"fingerprint": fingerprint, "seconds": duration}, fp)
+    log(f"[{s['key']}] done in {duration:.1f}s")
+
+
+def run_movie(args, stages, fingerprints, timings, lock):
+    """Run the stages of a single movie one after the other"""
+    for s in stages:
+        run_stage(args, s, fingerprints[s["key"]], timings, lock)
+
+
+def print_timings(timings):
+    totals = {}
+    for t in timings:
+        totals.setdefault(t["stage"], []).append(t["seconds"])
+
+    print("")
+    print(f"{'stage':<12}{'runs':>6}{'total [s]':>12}{'mean [s]':>12}")
+    for name in MOVIE_STAGES + DATASET_STAGES:
+        if name in totals:
+            times = totals[name]
+            print(f"{name:<12}{len(times):>6}{sum(times):>12.1f}{sum(times) / len(times):>12.1f}")
+
+
+def get_movies(args):
+    if args.movies != "-1":
+        return args.movies.split(",")
+    return sorted(os.path.basename(p)[:-len(".mkv")]
+                  for p in glob.glob(os.path.join(args.baseDir, "mvc_videos", "*.mkv")))
+
+
+def run(args):
+    movies = get_movies(args)
+    print(f"Running pipeline for {len(movies)} movies: {', '.join(movies)}")
+
+    os.makedirs(os.path.join(args.baseDir, "pipeline_state", "logs"), exist_ok=True)
+
+    per_movie = {m: movie_stages(args, m) for m in movies}
+    global_stages = dataset_stages(args, movies)
+    all_stages = [s for m in movies for s in per_movie[m]] + global_stages
+    fingerprints = compute_fingerprints(all_stages)
+
+    timings = []
+    lock = threading.Lock()
+    start_time = time.time()
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {m: executor.submit(run_movie, args, per_movie[m], fingerprints, timings, lock)
+                   for m in movies}
+        for m, future in futures.items():
+            try:
+                future.result()
+            except StageFailed as e:
+                print(e)
+                failed.append(m)
+
+    try:
+        if failed:
+            raise StageFailed(f"Not running the data set stages. Failed movies: {', '.join(failed)}")
+        if not args.movies_only:
+            for s in global_stages:
+                run_stage(args, s, fingerprints[s["key"]], timings, lock)
+    except StageFailed as e:
+        print(e)
+        return -1
+    finally:
+        print_timings(timings)
+        print(f"\nTotal runtime: {time.time() - start_time:.1f}s")
+        with open(os.path.join(args.baseDir, "pipeline_state", "timings.json"), "w") as fp:
+            json.dump(timings, fp, indent=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="run the movie -> disparity pipeline and skip all stages that are up to date")
+
+    parser.add_argument("--baseDir", type=str, required=True,
+                        help="path to folder containing the expected folders (mvc_videos, sbs_videos, sbs_frames)")
+    parser.add_argument("--outDir", type=str, required=True,
+                        help="output folder of the data set (images, flow, disparity)")
+    parser.add_argument("--movies", type=str, default="-1",
+                        help="comma separated list of movies, if not set all movies in mvc_videos are used")
+    parser.add_argument("--jobs", type=int, default=2,
+                        help="maximum number of movies processed concurrently")
+    parser.add_argument("--frimDecode", type=str, default=os.environ.get("FRIMDECODE", ""),
+                        help="path to the binary of FRIMDecode (default: environment variable FRIMDECODE)")
+    parser.add_argument("--convertJobs", type=int, default=1,
+                        help="number of chapter segments of a movie converted concurrently")
+    parser.add_argument("--sbsMode", type=str, default="x264", choices=["x264", "raw", "ffv1", "lossless"],
+                        help="encode the sbs video with x264 (lossy) or extract the frames directly from the decoder \
+                              output (raw) and optionally keep a lossless sbs video (ffv1, lossless)")
+    parser.add_argument("--crop", type=str, default="auto", choices=["auto", "fixed"],
+                        help="detect the black bars of every movie (auto) or crop all frames to 1880x800 (fixed)")
+    parser.add_argument("--name", type=str, default="training", help="name of the data set")
+    parser.add_argument("--sampleFPS", type=int, default=4,
+                        help="fps to use to subsample from full fps of original stream")
+    parser.add_argument("--sceneCoverage", type=float, default=0.6,
+                        help="percentage of the scene to cover")
+    parser.add_argument("--materialize", type=str, default="copy", choices=MATERIALIZE_MODES,
+                        help="how to create the images of the data set (see helper/createDataSet.py)")
+    parser.add_argument("--layout", type=str, default="flat", choices=["flat", "sharded"],
+                        help="directory layout of the per frame folders of the data set (see helper/layout.py)")
+    parser.add_argument("--flowCmd", type=str, default="",
+                        help="command computing the optical flow ({dataset} is replaced by --outDir). \
+                              If not set the flow needs to be computed manually")
+    parser.add_argument("--skyCmd", type=str, default="",
+                        help="command computing the sky segmentation ({dataset} is replaced by --outDir). \
+                              If not set the segmentation needs to be computed manually")
+    parser.add_argument("--dedup", action="store_true",
+                        help="drop near-duplicate frames of the scenes before the flow and the sky segmentation \
+                              (helper/dedup_data_set.py)")
+    parser.add_argument("--prescreen", action="store_true",
+                        help="reject stereo pairs that would fail the filtering before the flow and the sky \
+                              segmentation (helper/prescreen_stereo.py)")
+    parser.add_argument("--skyKeyframes", action="store_true",
+                        help="run the sky segmentation only on keyframes of the scenes and propagate the masks \
+                              (see sky_keyframes.py, {dataset} of --skyCmd is replaced by --outDir/sky_keyframes)")
+    parser.add_argument("--disparityEngine", type=str, default="flow", choices=["flow", "stereo"],
+                        help="compute the disparity from the optical flow (flow) or directly with stereo matching \
+                              (stereo, see get_disp_stereo.py - no flow stage)")
+    parser.add_argument("-f", "--use_filtering", action="store_true",
+                        help="apply filtering when computing the disparity")
+    parser.add_argument("--service", type=str, default="",
+                        help="unix socket of a running worker service (see worker_service.py) used to run the \
+                              python scripts")
+    parser.add_argument("--force", type=str, default="",
+                        help="comma separated list of stages to run even if they are up to date")
+    parser.add_argument("--movies_only", action="store_true",
+                        help="only run the per movie stages (convert, extract, group)")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="only print which stages would be run")
+
+    args = parser.parse_args()
+    args.force = args.force.split(",") if args.force else []
+
+    # the external flow (RAFT) and sky segmentation scripts only read the flat layout, the keyframes of
+    # --skyKeyframes are always flat and get_flow_cpu.py reads both layouts
+    if args.layout != "flat":
+        if args.flowCmd and args.disparityEngine == "flow" and "get_flow_cpu.py" not in args.flowCmd:
+            parser.error("--layout sharded can only be used with the flow of get_flow_cpu.py (--flowCmd)")
+        if args.skyCmd and not args.skyKeyframes:
+            parser.error("--layout sharded requires --skyKeyframes with --skyCmd")
+
+    sys.exit(run(args))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+    Dry-run capacity planner for a batch of movies.
+
+    Estimates the number of frames, the disk space and the core-hours of every
+    stage before the batch is run. No images are read or written:
+
+    frames      - the frames of every movie are computed from its chapters (timingChapters.txt
+                  of image_meta, chapters.txt of sbs_videos or the chapters of the mkv in
+                  mvc_videos, in this order) at --fps, as they are assigned by the extraction
+                  (start <= t < end, see helper/extract_stream.py). If the showinfo logs of the
+                  extraction already exist, they are used instead. The showinfo logs and the
+                  shot list are written into a temporary folder and the functions of the data
+                  set generator (--generator) are run on them, so the number of selected
+                  frames is the same as in the real run (including the excluded chapters
+                  and scenes). Without a shot list (shots.txt of image_meta, written by the
+                  extraction or convertToSbs.sh raw) a cut at the start of every chapter and
+                  every --shotSeconds is assumed and the movie is marked as estimated.
+    calibration - the bytes written and the core-seconds per frame of every stage are taken
+                  from the metrics summaries (<stage>_..._summary.json, see helper/metrics.py)
+                  of a calibration run with SBS_METRICS_DIR set. The core-seconds are the busy
+                  time of the workers (elapsed time times workers if the stage reports no
+                  busy time). Stages without summaries are reported without an estimate.
+
+    The stages are counted in frames of their own:
+        extract   - frames of the movie (image_raw, removed after the split)
+        split     - frames of the movie (left and right image)
+        dataset   - selected frames
+        copy      - left and right image of the selected frames (no bytes for links)
+        flow      - selected frames (forward and backward flow)
+        disparity - selected frames (disparity and uncertainty)
+    The conversion to sbs and the sky segmentation do not report metrics and are not estimated.
+"""
+import os
+import io
+import glob
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+import group_frames_to_scenes
+import gen_data_set
+import gen_sequence_training_data
+import genTraining_recurr
+from helper.chapter_segments import read_chapters, first_frame
+
+
+# frame rate assumed by the data set generators
+GENERATOR_FPS = 24
+
+# stage, unit of its frames, kept in the data set
+STAGES = [
+    ("extract", "movie", False),
+    ("split", "movie", True),
+    ("dataset", "selected", True),
+    ("copy", "images", True),
+    ("flow", "selected", True),
+    ("disparity", "selected", True),
+]
+
+
+def get_movies(args):
+    if args.movies != "-1":
+        return args.movies.split(",")
+    names = [os.path.basename(p)[:-len(".mkv")]
+             for p in glob.glob(os.path.join(args.baseDir, "mvc_videos", "*.mkv"))]
+    names += [os.path.basename(p.rstrip("/"))[:-len("_SBS")]
+              for p in glob.glob(os.path.join(args.baseDir, "sbs_videos", "*_SBS/"))]
+    return sorted(set(names))
+
+
+def read_mkv_chapters(filename):
+    out = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "chapter=start_time,end_time",
+                          "-of", "csv=p=0", filename], capture_output=True, text=True, check=True).stdout
+    return [tuple(float(x) for x in line.split(",")) for line in out.splitlines() if line]
+
+
+def get_chapters(args, movie):
+    """Chapters (start, end) of the movie and the file they were read from"""
+    sbs_name = movie + "_SBS"
+    for filename in [os.path.join(args.baseDir, "sbs_frames", "image_meta", sbs_name, "timingChapters.txt"),
+                     os.path.join(args.baseDir, "sbs_videos", sbs_name, "chapters.txt")]:
+        if os.path.exists(filename):
+            return read_chapters(filename), filename
+    filename = os.path.join(args.baseDir, "mvc_videos", movie + ".mkv")
+    if os.path.exists(filename):
+        return read_mkv_chapters(filename), filename
+    return None, None
+
+
+def write_log_line(fp, n, pts_time):
+    # fields of the showinfo filter of ffmpeg parsed by the data set generators (as helper/extract_stream.py)
+    fp.write(f"[Parsed_showinfo_0 @ 0x0] n:{n:5d} pts:{int(round(pts_time * 1000)):7d} "
+             f"pts_time:{pts_time:<10.6g}\n")
+
+
+def write_shot_line(fp, pts_time):
+    # fields of ffprobe -show_frames parsed by processShotFile
+    fp.write(f"media_type=video|pkt_pts={int(round(pts_time * 1000))}|pkt_pts_time={pts_time:.6f}\n")
+
+
+def count_log_frames(filename):
+    with open(filename, "r") as fp:
+        return sum(1 for line in fp if "pts_time:" in line)
+
+
+def prepare_movie(args, movie, video):
+    """Write the meta files of the movie into the folder video (as written by the extraction)
+
+    Returns the description of the movie (number of frames, where the chapters and shots come from).
+    """
+    meta_dir = os.path.join(args.baseDir, "sbs_frames", "image_meta", movie + "_SBS")
+    chapters, chapter_file = get_chapters(args, movie)
+    if chapters is None:
+        return None
+    os.makedirs(video, exist_ok=True)
+
+    with open(os.path.join(video, "timingChapters.txt"), "w") as fp:
+        for start, end in chapters:
+            fp.write(f"{start:.6f},{end:.6f}\n")
+
+    info = {"movie": movie, "chapters": len(chapters), "chapter_file": chapter_file}
+
+    logs = sorted(glob.glob(os.path.join(meta_dir, "log*.txt")))
+    if len(logs) == len(chapters):
+        for filename in logs:
+            shutil.copy(filename, video)
+        info["frames"] = sum(count_log_frames(f) for f in logs)
+        info["frame_source"] = "logs"
+    else:
+        num_frames = 0
+        for c, (start, end) in enumerate(chapters):
+            with open(os.path.join(video, f"log{c + 1}.txt"), "w") as fp:
+                n = 0
+                for k in range(max(first_frame(start, args.fps) - 1, 0), first_frame(end, args.fps) + 1):
+                    t = k * args.fps_den / args.fps_num
+                    if start <= t < end:
+                        write_log_line(fp, n, t)
+                        n += 1
+            num_frames += n
+        info["frames"] = num_frames
+        info["frame_source"] = "chapters"
+
+    shot_file = os.path.join(meta_dir, "shots.txt")
+    if os.path.exists(shot_file):
+        shutil.copy(shot_file, video)
+        info["shot_source"] = "shots.txt"
+    else:
+        # the chapters start with a cut
+        with open(os.path.join(video, "shots.txt"), "w") as fp:
+            step = max(int(round(args.shotSeconds * args.fps)), 1)
+            for start, end in chapters:
+                for k in range(first_frame(start, args.fps), first_frame(end, args.fps), step):
+                    write_shot_line(fp, k * args.fps_den / args.fps_num)
+        info["shot_source"] = "estimated"
+    return info
+
+
+def count_selected(args, plan_dir, video):
+    """Number of frames the data set generator selects from the meta files in video"""
+    gen_args = argparse.Namespace(**vars(args))
+    gen_args.baseDir = plan_dir
+    gen_args.chapterTiming = "timingChapters.txt"
+
+    # the generators print their progress
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.generator == "dataset":
+            group_frames_to_scenes.process_video(gen_args, video)
+            frame_sample_factor = int(round(GENERATOR_FPS / args.sampleFPS))
+            _, _, selected = gen_data_set.process_video(gen_args, video, GENERATOR_FPS, frame_sample_factor)
+            return len(selected)
+        if args.generator == "sequence":
+            gen_args.fps = args.sequenceFPS
+            _, _, num_frames, _ = gen_sequence_training_data.process_video(gen_args, video, GENERATOR_FPS)
+            return num_frames
+        out_file = os.path.join(video, "single.txt")
+        genTraining_recurr.process_video(gen_args, video, GENERATOR_FPS, out_file)
+        if not os.path.exists(out_file):
+            return 0
+        with open(out_file, "r") as fp:
+            return sum(1 for _ in fp)
+
+
+def load_calibration(metrics_dir):
+    """Bytes written and core-seconds per frame of every stage in the metrics summaries"""
+    totals = {}
+    for filename in glob.glob(os.path.join(metrics_dir, "*_summary.json")):
+        with open(filename, "r") as fp:
+            s = json.load(fp)
+        busy = s["worker_busy_ratio"] * s["elapsed_seconds"] * max(s["workers"], 1)
+        if busy <= 0:
+            busy = s["elapsed_seconds"] * max(s["workers"], 1)
+        t = totals.setdefault(s["stage"], {"frames": 0, "bytes": 0, "core_seconds": 0.0})
+        t["frames"] += s["frames"]
+        t["bytes"] += s["bytes_written"]
+        t["core_seconds"] += busy
+
+    return {stage: {"bytes_per_frame": t["bytes"] / t["frames"],
+                    "core_seconds_per_frame": t["core_seconds"] / t["frames"],
+                    "frames": t["frames"]}
+            for stage, t in totals.items() if t["frames"] > 0}
+
+
+def plan(args):
+    movies = []
+    plan_dir = tempfile.mkdtemp(prefix="plan_capacity_")
+    try:
+        for movie in get_movies(args):
+            video = os.path.join(plan_dir, "sbs_frames", "image_meta", movie + "_SBS") + "/"
+            info = prepare_movie(args, movie, video)
+            if info is None:
+                print(f"No chapters found for {movie}, skipped")
+                continue
+            try:
+                info["selected"] = count_selected(args, plan_dir, video)
+            except (IndexError, ValueError) as e:
+                # the generator fails the same way in the real run (e.g. a chapter without a cut)
+                print(f"The data set generator failed for {movie}: {e!r}")
+                info["selected"] = None
+            movies.append(info)
+    finally:
+        shutil.rmtree(plan_dir)
+
+    calibration = load_calibration(args.calibration) if args.calibration else {}
+    units = {"movie": sum(m["frames"] for m in movies),
+             "selected": sum(m["selected"] or 0 for m in movies)}
+    units["images"] = 2 * units["selected"]
+
+    stages = []
+    for name, unit, kept in STAGES:
+        s = {"stage": name, "frames": units[unit], "kept": kept, "bytes": None, "core_hours": None}
+        if name in calibration:
+            s["bytes"] = units[unit] * calibration[name]["bytes_per_frame"]
+            s["core_hours"] = units[unit] * calibration[name]["core_seconds_per_frame"] / 3600
+        stages.append(s)
+
+    return {"movies": movies, "stages": stages, "calibration": calibration,
+            "generator": args.generator, "fps": args.fps}
+
+
+def format_value(value, scale, fmt):
+    return "-" if value is None else format(value / scale, fmt)
+
+
+def print_plan(result, cores):
+    print(f"{'movie':<30}{'chapters':>10}{'frames':>12}{'selected':>10}  source")
+    for m in result["movies"]:
+        estimated = " (shots estimated)" if m["shot_source"] == "estimated" else ""
+        selected = "failed" if m["selected"] is None else m["selected"]
+        print(f"{m['movie']:<30}{m['chapters']:>10}{m['frames']:>12}{selected:>10}  "
+              f"{m['frame_source']}{estimated}")
+
+    print("")
+    print(f"{'stage':<12}{'frames':>12}{'size [GB]':>12}{'core-hours':>12}{'hours':>10}")
+    for s in result["stages"]:
+        hours = None if s["core_hours"] is None else s["core_hours"] / cores
+        temporary = "" if s["kept"] else "  (temporary)"
+        print(f"{s['stage']:<12}{s['frames']:>12}{format_value(s['bytes'], 1e9, '.2f'):>12}"
+              f"{format_value(s['core_hours'], 1, '.2f'):>12}{format_value(hours, 1, '.2f'):>10}{temporary}")
+
+    known = [s for s in result["stages"] if s["bytes"] is not None]
+    kept = sum(s["bytes"] for s in known if s["kept"])
+    peak = kept + max([s["bytes"] for s in known if not s["kept"]], default=0)
+    print("")
+    print(f"disk: {kept / 1e9:.2f} GB kept, {peak / 1e9:.2f} GB peak")
+    print(f"compute: {sum(s['core_hours'] for s in known):.2f} core-hours "
+          f"({sum(s['core_hours'] for s in known) / cores:.2f} hours on {cores} cores)")
+    missing = [s["stage"] for s in result["stages"] if s["bytes"] is None]
+    if missing:
+        print(f"no calibration for: {', '.join(missing)}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="estimate the frames, disk space and core-hours of every stage for a batch of movies \
+                     (dry run, no images are read)")
+
+    parser.add_argument("--baseDir", type=str, required=True,
+                        help="path to folder containing the expected folders (mvc_videos, sbs_videos, sbs_frames)")
+    parser.add_argument("--movies", type=str, default="-1",
+                        help="comma separated list of movies, if not set all movies in mvc_videos and sbs_videos")
+    parser.add_argument("--calibration", type=str, default="",
+                        help="folder with the metrics summaries of a calibration run (SBS_METRICS_DIR)")
+    parser.add_argument("--fps", type=str, default="24000/1001", help="frame rate of the movies")
+    parser.add_argument("--shotSeconds", type=float, default=4.0,
+                        help="mean length of a shot assumed for movies without shot list")
+    parser.add_argument("--cores", type=int, default=8, help="number of cores the batch is run on")
+    parser.add_argument("--out", type=str, default="", help="write the plan to this json file")
+
+    parser.add_argument("--generator", type=str, default="dataset", choices=["dataset", "sequence", "recurrent"],
+                        help="data set generator: gen_data_set.py (dataset), gen_sequence_training_data.py \
+                              (sequence) or genTraining_recurr.py (recurrent)")
+    parser.add_argument("--sampleFPS", type=int, default=4, help="--sampleFPS of gen_data_set.py")
+    parser.add_argument("--sceneCoverage", type=float, default=0.6, help="--sceneCoverage of gen_data_set.py")
+    parser.add_argument("--sequenceFPS", type=int, default=2, help="--fps of gen_sequence_training_data.py")
+    parser.add_argument("--min_frames", type=int, default=30, help="--min_frames of gen_sequence_training_data.py")
+    parser.add_argument("--fpsSingle", type=int, default=2, help="--fpsSingle of genTraining_recurr.py")
+    parser.add_argument("--numRecurrent", type=int, default=3, help="--numRecurrent of genTraining_recurr.py")
+    parser.add_argument("--fpsRecurrent", type=int, default=24, help="--fpsRecurrent of genTraining_recurr.py")
+
+    args = parser.parse_args()
+    args.fps_num, args.fps_den = (int(x) for x in args.fps.split("/"))
+    args.fps = args.fps_num / args.fps_den
+
+    result = plan(args)
+    print_plan(result, args.cores)
+
+    if args.out:
+        with open(args.out, "w") as fp:
+            json.dump(result, fp, indent=True)
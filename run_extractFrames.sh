@@ -2,9 +2,16 @@
 
 # This script extracts the individual frames from the SBS videos und splits the left and right images
 
-#base_dir=$1    # base dir containing the folders mvc_videos, sbs_frames, sbs_videos
 video_name=$1  # Name of the SBS video (without the .mkv extension)
-base_dir=/home/hauke/Master/MasterThesis/data/3dmovies/
+base_dir=${2:-${SBS_BASE_DIR}}    # base dir containing the folders mvc_videos, sbs_frames, sbs_videos
+crop_mode=${3:-auto}   # auto: detect the black bars (see helper/detect_crop.py), fixed: crop 1880x800 as in the paper
+source=${4:-mkv}       # mkv: extract from the sbs video, raw: frames already extracted from the decoder output (convertToSbs.sh raw)
+
+if [ -z "${video_name}" ] || [ -z "${base_dir}" ]; then
+	echo "Usage: $0 video_name base_dir [auto|fixed] [mkv|raw]"
+	exit 1
+fi
+base_dir="${base_dir%/}/"
 frame_dir="sbs_frames/"
 output_dir="${base_dir}${frame_dir}"
 video_filename="${video_name}.mkv"
@@ -16,6 +23,12 @@ output_meta="${output_dir}image_meta/${video_name}/"
 output_frames_raw="${output_dir}image_raw/${video_name}/"
 chapter_file="${video_path}chapters.txt"
 chap_idx="0"
+# run the python scripts through the worker service if WORKER_SOCKET is set (see worker_service.py)
+if [ -n "${WORKER_SOCKET}" ]; then
+	python_cmd="python worker_service.py run --socket ${WORKER_SOCKET}"
+else
+	python_cmd="python"
+fi
 #
 
 echo "Created directories: " 
@@ -31,44 +44,74 @@ mkdir -p $output_meta
 mkdir -p $output_frames_raw
 
 
-# get cut information
-echo "Extracting scenes from ${video_name} ..."
-
-ffprobe -show_frames -of compact=p=0 -f lavfi "movie=${video_path}${video_filename},select=gt(scene\,0.1)" >> ${output_meta}shots.txt 2>&1
-
-echo " "
-
-# per chapter extract raw images (full frame rate, full resolution, no clipping, left and right image combined in one image sbs)
-# additional log info is stored
-echo "Extracting sbs images from ${video_name} into ${output_frames_raw} ..."
-start_time=$(date +%s.%N)
-
-while IFS='' read -r line
-do
-	((chap_idx++))
-	startTs=${line%%,*}
-	endTs=${line##*,}
-	duration=$(awk '{print $1-$2-$3}' <<< "$endTs $startTs 0.1")
-	echo "Started chapter ${chap_idx}: $startTs $endTs $duration"
-	mkdir -p ${output_frames_raw}chapter${chap_idx}/
-	ffmpeg -ss $startTs -i ${video_path}${video_filename} -to $endTs -copyts -vf showinfo -qscale:v 1 ${output_frames_raw}chapter${chap_idx}/out%08d.jpg </dev/null >> ${output_meta}log${chap_idx}.txt 2>&1 &
-done < "$chapter_file"
-wait     # wait for all the started processes to finish
-# convert the time to some useful values
-end_time=$(date +%s.%N)
-dt=$(echo "$end_time - $start_time" | bc)
-dd=$(echo "$dt/86400" | bc)
-dt2=$(echo "$dt-86400*$dd" | bc)
-dh=$(echo "$dt2/3600" | bc)
-dt3=$(echo "$dt2-3600*$dh" | bc)
-dm=$(echo "$dt3/60" | bc)
-ds=$(echo "$dt3-60*$dm" | bc)
-
-LC_NUMERIC=C printf "Total runtime: %d:%02d:%02d:%02.4f\n" $dd $dh $dm $ds
-
-echo " "
-
-# extract clipped left and right images from raw images (clipping is done to remove black borders)
+if [ "${source}" = "raw" ]; then
+	# the raw frames, logs and shots were written by helper/extract_stream.py, the crop is detected on the frames
+	echo "Using the frames of ${video_name} extracted from the decoder output ..."
+	if [ "${crop_mode}" = "auto" ]; then
+		split_crop="--crop $(${python_cmd} helper/detect_crop.py --frames ${output_frames_raw} --out ${output_meta}crop.json --print split)"
+	else
+		split_crop="--paddingAR 280 --paddingAR_side 40"
+	fi
+	echo " "
+else
+	# get cut information
+	echo "Extracting scenes from ${video_name} ..."
+
+	ffprobe -show_frames -of compact=p=0 -f lavfi "movie=${video_path}${video_filename},select=gt(scene\,0.1)" >> ${output_meta}shots.txt 2>&1
+
+	echo " "
+
+	# detect the black bars on sampled frames, the left and right image are cropped while decoding
+	if [ "${crop_mode}" = "auto" ]; then
+		echo "Detecting crop of ${video_name} ..."
+		video_filter=$(${python_cmd} helper/detect_crop.py --video ${video_path}${video_filename} --out ${output_meta}crop.json --print ffmpeg)
+		split_crop="--paddingAR 0 --paddingAR_side 0"
+	else
+		video_filter="showinfo"
+		split_crop="--paddingAR 280 --paddingAR_side 40"
+	fi
+
+	# per chapter extract raw images (full frame rate, full resolution, left and right image combined in one image sbs)
+	# additional log info is stored
+	echo "Extracting sbs images from ${video_name} into ${output_frames_raw} ..."
+	start_time=$(date +%s.%N)
+
+	while IFS='' read -r line
+	do
+		((chap_idx++))
+		startTs=${line%%,*}
+		endTs=${line##*,}
+		duration=$(awk '{print $1-$2-$3}' <<< "$endTs $startTs 0.1")
+		echo "Started chapter ${chap_idx}: $startTs $endTs $duration"
+		mkdir -p ${output_frames_raw}chapter${chap_idx}/
+		ffmpeg -ss $startTs -i ${video_path}${video_filename} -to $endTs -copyts -vf "${video_filter}" -qscale:v 1 ${output_frames_raw}chapter${chap_idx}/out%08d.jpg </dev/null >> ${output_meta}log${chap_idx}.txt 2>&1 &
+	done < "$chapter_file"
+	wait     # wait for all the started processes to finish
+	# convert the time to some useful values
+	end_time=$(date +%s.%N)
+	dt=$(echo "$end_time - $start_time" | bc)
+	dd=$(echo "$dt/86400" | bc)
+	dt2=$(echo "$dt-86400*$dd" | bc)
+	dh=$(echo "$dt2/3600" | bc)
+	dt3=$(echo "$dt2-3600*$dh" | bc)
+	dm=$(echo "$dt3/60" | bc)
+	ds=$(echo "$dt3-60*$dm" | bc)
+
+	LC_NUMERIC=C printf "Total runtime: %d:%02d:%02d:%02.4f\n" $dd $dh $dm $ds
+
+	# report the extraction to the metrics (see helper/metrics.py)
+	if [ -n "${SBS_METRICS_DIR}${SBS_METRICS_PORT}" ]; then
+		python helper/metrics.py record --stage extract --name ${video_name} --seconds $dt --workers $chap_idx \
+			--frames $(find ${output_frames_raw} -name "*.jpg" | wc -l) \
+			--bytes_read $(stat -L -c %s ${video_path}${video_filename}) \
+			--bytes_written $(du -sb ${output_frames_raw} | cut -f1)
+	fi
+
+	echo " "
+fi
+
+# extract clipped left and right images from raw images (clipping is done to remove black borders, with the
+# detected crop the raw images are already cropped)
 # see python script for parameters and details
 echo "Extracting left and right images from ${video_name} ..."
 
@@ -77,7 +120,7 @@ for subfolder in ${output_frames_raw}*/ ; do
 	echo $b_subfolder
 	mkdir -p ${output_frames_left}${b_subfolder}/
 	mkdir -p ${output_frames_right}${b_subfolder}/
-	python splitImagesChapters.py --raw ${output_frames_raw}${b_subfolder}/ --outLeft ${output_frames_left}${b_subfolder}/ --outRight ${output_frames_right}${b_subfolder}/ --txtList ${output_meta}${b_subfolder}.txt --paddingAR 280 --paddingAR_side 40 --numCores 8 
+	${python_cmd} splitImagesChapters.py --raw ${output_frames_raw}${b_subfolder}/ --outLeft ${output_frames_left}${b_subfolder}/ --outRight ${output_frames_right}${b_subfolder}/ --txtList ${output_meta}${b_subfolder}.txt ${split_crop} --numCores 8 --proxyOut ${output_meta}proxy/${b_subfolder}
 done
 
 # copy chapter info and remove unneeded files (esp raw files)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+    Sky segmentation on keyframes only.
+
+    Running the segmentation network on every image of image_left is one of the
+    most expensive steps, although consecutive frames of a scene hardly differ.
+    The frames of the data set are grouped by their scene / sequence (manifest,
+    sequence csv or chapter of the mapping log) and processed in frame order:
+
+    select    - a frame becomes a keyframe if it can not be predicted from the
+                last keyframe: the keyframe is warped to the frame with a low
+                resolution temporal flow (DIS) and the mean absolute error is
+                compared to --maxChange. The keyframes are linked into
+                sky_keyframes/image_left (same layout as the data set, so the
+                segmentation command can be run on it unchanged) and the
+                assignment is stored in meta/sky_keyframes.json
+    propagate - the masks of the keyframes (sky_keyframes/sky_segmentation) are
+                copied to the frames that differ less than --copyChange from their
+                keyframe and warped with the temporal flow otherwise. The masks are
+                written to sky_segmentation/ (255 = sky) as expected by
+                get_disp_and_uncertainty.py
+
+    The temporal flow is computed on the reduced images again in propagate (it
+    is cheap compared to the segmentation), so only the small json is stored.
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import numpy as np
+import cv2
+from PIL import Image
+from tqdm import tqdm
+from joblib import Parallel, delayed
+import multiprocessing
+
+from helper.helpers import materialize, MATERIALIZE_MODES
+from helper.disp_statistics import get_frame_groups
+from helper.layout import load_layout, output_file, list_frame_files
+from helper.frame_index import pruned_frames, report_missing
+
+
+KEYFRAME_DIR = "sky_keyframes"
+ASSIGNMENT_FILE = "sky_keyframes.json"
+
+
+def frame_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def get_groups(path, names):
+    """Group the frames of the data set (names without extension) by scene / sequence
+
+    The groups are taken from the manifest, the sequence csv or the chapters of
+    the mapping log (in this order). Frames of a group are sorted by name, which
+    is the order of the frames in the movie.
+    """
+    keys = {name: key for name, (_, key) in get_frame_groups(path).items()}
+
+    if not keys:
+        csv_files = glob.glob(os.path.join(path, "meta", "*.csv"))
+        log_file = os.path.join(path, "meta", "image_mapping_log.txt")
+        if len(csv_files) == 1:
+            with open(csv_files[0], "r") as f:
+                for line in f:
+                    cols = line.rstrip().split(",")
+                    if len(cols) >= 5:
+                        keys[cols[4]] = (cols[0], cols[3])
+        elif os.path.exists(log_file):
+            with open(log_file, "r") as f:
+                for line in f:
+                    cols = line.split()
+                    if len(cols) == 2:
+                        keys[cols[1]] = os.path.dirname(cols[0])
+
+    groups = {}
+    for name in names:
+        groups.setdefault(keys.get(name), []).append(name)
+    return [sorted(g) for g in groups.values()]
+
+
+def read_reduced(filename, reduce):
+    """Read the image as reduced grayscale (factor 2, 4 or 8)"""
+    flags = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+             4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+    return cv2.imread(filename, flags[reduce])
+
+
+def temporal_flow(dis, frame, key):
+    """Flow from frame to key (frame(p) ~ key(p + flow(p)))"""
+    return dis.calc(frame, key, None)
+
+
+def warp(image, flow, interpolation=cv2.INTER_LINEAR):
+    h, w = flow.shape[:2]
+    grid_x, grid_y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+    return cv2.remap(image, grid_x + flow[..., 0], grid_y + flow[..., 1], interpolation,
+                     borderMode=cv2.BORDER_REPLICATE)
+
+
+def change(frame, key, flow=None):
+    """Mean absolute difference of frame and the (warped) key"""
+    if flow is not None:
+        key = warp(key, flow)
+    return float(np.mean(cv2.absdiff(frame, key)))
+
+
+def select_group(args, files):
+    """Select the keyframes of a group of frames (in frame order)
+
+    Returns a dict name -> {"key", "mode", "change"} with mode key, copy or warp.
+    """
+    dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+    assignment = {}
+    key_name, key_image = None, None
+    frames_since_key = 0
+
+    for f in files:
+        name = frame_name(f)
+        image = read_reduced(f, args.reduce)
+
+        mode, value = "key", 0.0
+        if key_image is not None and image.shape == key_image.shape and frames_since_key < args.maxFrames:
+            value = change(image, key_image)
+            if value < args.copyChange:
+                mode = "copy"
+            else:
+                value = change(image, key_image, temporal_flow(dis, image, key_image))
+                if value < args.maxChange:
+                    mode = "warp"
+
+        if mode == "key":
+            key_name, key_image = name, image
+            frames_since_key = 0
+        else:
+            frames_since_key += 1
+        assignment[name] = {"key": key_name, "mode": mode, "change": round(value, 3)}
+
+    return assignment
+
+
+def select(args):
+    files = list_frame_files(os.path.join(args.path, "image_left"), ".jpg")
+    if not files:
+        sys.exit(f"No images found in {os.path.join(args.path, 'image_left')}")
+    by_name = {frame_name(f): f for f in files}
+    groups = get_groups(args.path, list(by_name))
+
+    results = Parallel(n_jobs=args.numCores)(
+        delayed(select_group)(args, [by_name[n] for n in g]) for g in tqdm(groups))
+    assignment = {}
+    for r in results:
+        assignment.update(r)
+
+    # link the keyframes into a folder with the layout of the data set
+    key_dir = os.path.join(args.path, KEYFRAME_DIR, "image_left")
+    os.makedirs(key_dir, exist_ok=True)
+    for f in glob.glob(os.path.join(key_dir, "*")):
+        os.remove(f)
+    keys = sorted(n for n, a in assignment.items() if a["mode"] == "key")
+    for n in keys:
+        materialize(by_name[n], os.path.join(key_dir, os.path.basename(by_name[n])), args.materialize)
+
+    os.makedirs(os.path.join(args.path, "meta"), exist_ok=True)
+    with open(os.path.join(args.path, "meta", ASSIGNMENT_FILE), "w") as fp:
+        json.dump({"reduce": args.reduce, "frames": assignment}, fp, indent=True, sort_keys=True)
+
+    modes = [a["mode"] for a in assignment.values()]
+    print(f"{len(groups)} groups, {len(files)} frames: {modes.count('key')} keyframes, "
+          f"{modes.count('copy')} copied, {modes.count('warp')} warped")
+    print(f"Run the sky segmentation on {key_dir} (output {os.path.join(args.path, KEYFRAME_DIR, 'sky_segmentation')})")
+
+
+def propagate_frame(reduce, mode, image_file, key_image_file, key_mask_file, out_file):
+    key_mask = np.asarray(Image.open(key_mask_file))
+    if mode == "warp":
+        dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+        image = read_reduced(image_file, reduce)
+        key_image = read_reduced(key_image_file, reduce)
+        flow = temporal_flow(dis, image, key_image)
+
+        # scale the flow to the resolution of the mask
+        h, w = key_mask.shape[:2]
+        flow = cv2.resize(flow, (w, h), interpolation=cv2.INTER_LINEAR)
+        flow[..., 0] *= w / image.shape[1]
+        flow[..., 1] *= h / image.shape[0]
+        mask = warp(key_mask, flow, cv2.INTER_NEAREST)
+    else:
+        mask = key_mask
+
+    Image.fromarray(mask).save(out_file)
+    return mode
+
+
+def propagate(args):
+    with open(os.path.join(args.path, "meta", ASSIGNMENT_FILE), "r") as fp:
+        data = json.load(fp)
+    assignment = data["frames"]
+
+    by_name = {frame_name(f): f for f in list_frame_files(os.path.join(args.path, "image_left"), ".jpg")}
+    # the segmentation may add a suffix to the name of the frame (e.g. out00000001_seg.png)
+    key_masks = {}
+    for f in glob.glob(os.path.join(args.path, KEYFRAME_DIR, "sky_segmentation", "*.png")):
+        key_masks[frame_name(f)[0:11]] = f
+
+    # frames removed after select (e.g. --remove of helper/prescreen_stereo.py) are skipped, the
+    # frames removed on purpose without a report
+    pruned = pruned_frames(args.path)
+    frames = []
+    missing = {}
+    for name, entry in sorted(assignment.items()):
+        if name in pruned:
+            continue
+        key_image_file = by_name.get(entry["key"]) if entry["mode"] == "warp" else None
+        if name not in by_name or (entry["mode"] == "warp" and key_image_file is None):
+            missing[name] = ["image_left"]
+            continue
+        frames.append((name, entry, key_image_file))
+    report_missing(args.path, missing, "missing_inputs_sky.txt")
+
+    missing_keys = sorted(set(entry["key"] for _, entry, _ in frames) - set(key_masks))
+    if missing_keys:
+        sys.exit(f"{len(missing_keys)} keyframes without sky segmentation (e.g. {missing_keys[0]}) - "
+                 f"run the segmentation on {os.path.join(args.path, KEYFRAME_DIR, 'image_left')} first")
+
+    out_dir = os.path.join(args.path, "sky_segmentation")
+    os.makedirs(out_dir, exist_ok=True)
+    layout = load_layout(args.path)
+
+    modes = Parallel(n_jobs=args.numCores)(
+        delayed(propagate_frame)(data["reduce"], entry["mode"], by_name[name], key_image_file,
+                                 key_masks[entry["key"]], output_file(out_dir, name + ".png", layout))
+        for name, entry, key_image_file in tqdm(frames))
+    print(f"Wrote {len(modes)} masks to {out_dir}: {modes.count('key')} keyframes, "
+          f"{modes.count('copy')} copied, {modes.count('warp')} warped")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="run the sky segmentation only on keyframes and propagate the masks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("select", help="select the keyframes of every scene / sequence")
+    p.add_argument("path", type=str, help="path to folder of dataset - needs to contain image_left")
+    p.add_argument("--reduce", type=int, default=4, choices=[1, 2, 4, 8],
+                   help="factor the images are reduced by to measure the change")
+    p.add_argument("--copyChange", type=float, default=2.0,
+                   help="frames with a mean absolute difference (gray values) below copyChange to the keyframe \
+                         get a copy of its mask")
+    p.add_argument("--maxChange", type=float, default=6.0,
+                   help="frames with a mean absolute difference above maxChange to the warped keyframe become \
+                         keyframes")
+    p.add_argument("--maxFrames", type=int, default=24, help="maximum number of frames per keyframe")
+    p.add_argument("--materialize", type=str, default="hardlink", choices=MATERIALIZE_MODES,
+                   help="how to create the keyframe images (see helper/createDataSet.py)")
+    p.add_argument("--numCores", type=int, default=multiprocessing.cpu_count(), help="number of cores")
+
+    p = subparsers.add_parser("propagate", help="propagate the masks of the keyframes to all frames")
+    p.add_argument("path", type=str, help="path to folder of dataset - needs to contain sky_keyframes/sky_segmentation")
+    p.add_argument("--numCores", type=int, default=multiprocessing.cpu_count(), help="number of cores")
+
+    args = parser.parse_args()
+
+    if args.command == "select":
+        select(args)
+    else:
+        propagate(args)
@@ -1,4 +1,5 @@
 from PIL import Image
+import numpy as np
 import argparse
 import glob
 import os
@@ -6,6 +7,8 @@ import multiprocessing
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from helper.metrics import get_metrics, timed_call
+
 parser = argparse.ArgumentParser(
     description='split sbs (side-by-side) stereo images.')
 
@@ -21,14 +24,20 @@ parser.add_argument('--paddingAR', type=int,
                     help='padding due to aspect ratio', default=0)
 parser.add_argument('--paddingAR_side', type=int,
                     help='padding due to aspect ratio left/right', default=0)
+parser.add_argument('--crop', type=str,
+                    help='crop w:h:x:y of the left and right image (x relative to the image, see helper/detect_crop.py) - overrides the padding', default='')
 parser.add_argument('--flip', type=bool,
                     help='RL instead of LR', default=False)
 parser.add_argument('--numCores', type=int,
                     help='number of cores to run the extraction on', default=8)
+parser.add_argument('--proxyOut', type=str,
+                    help='path prefix of the low resolution proxy files of the chapter (not written if not set)', default='')
+parser.add_argument('--proxySize', type=str,
+                    help='size (WxH) of the low resolution proxies', default='235x100')
 args = parser.parse_args()
 
 
-def process_single_image(args, imgPath):
+def process_single_image(args, imgPath, proxyIdx=None, proxyColor=None, proxyGray=None):
 
     imNameSplit = imgPath.split('/')
     imName = imNameSplit[-1]
@@ -36,27 +45,41 @@ def process_single_image(args, imgPath):
 
     (widthDouble, height) = im1.size
 
-    height = height - args.paddingAR
-    width = int(widthDouble/2 - args.paddingAR_side)
-
-    result1 = Image.new('RGB', (width, height))
-    result2 = Image.new('RGB', (width, height))
-    if args.flip:
-        result1 = im1.crop((width+args.paddingAR_side+args.paddingAR_side/2,
-                            args.paddingAR/2, widthDouble-args.paddingAR_side/2, height+args.paddingAR/2))
-        result2 = im1.crop(
-            (args.paddingAR_side/2, args.paddingAR/2, width, height+args.paddingAR/2))
+    if args.crop:
+        # same crop box in the left and the right half
+        width, height, x, y = [int(v) for v in args.crop.split(':')]
+        boxLeft = (x, y, x+width, y+height)
+        boxRight = (widthDouble//2+x, y, widthDouble//2+x+width, y+height)
+        if args.flip:
+            boxLeft, boxRight = boxRight, boxLeft
+        result1 = im1.crop(boxLeft)
+        result2 = im1.crop(boxRight)
     else:
-        result1 = im1.crop((args.paddingAR_side/2, args.paddingAR/2,
-                            width+args.paddingAR_side/2, height+args.paddingAR/2))
-        result2 = im1.crop((width+args.paddingAR_side+args.paddingAR_side/2,
-                            args.paddingAR/2, widthDouble-args.paddingAR_side/2, height+args.paddingAR/2))
+        height = height - args.paddingAR
+        width = int(widthDouble/2 - args.paddingAR_side)
+
+        if args.flip:
+            result1 = im1.crop((width+args.paddingAR_side+args.paddingAR_side/2,
+                                args.paddingAR/2, widthDouble-args.paddingAR_side/2, height+args.paddingAR/2))
+            result2 = im1.crop(
+                (args.paddingAR_side/2, args.paddingAR/2, width, height+args.paddingAR/2))
+        else:
+            result1 = im1.crop((args.paddingAR_side/2, args.paddingAR/2,
+                                width+args.paddingAR_side/2, height+args.paddingAR/2))
+            result2 = im1.crop((width+args.paddingAR_side+args.paddingAR_side/2,
+                                args.paddingAR/2, widthDouble-args.paddingAR_side/2, height+args.paddingAR/2))
 
     result1.save(args.outLeft+imName, format='JPEG',
                  quality=85, subsampling=0, optimize=True)
     result2.save(args.outRight+imName, format='JPEG',
                  quality=85, subsampling=0, optimize=True)
 
+    # write the low resolution proxy of the left image into the (memory mapped) proxy arrays
+    if proxyColor is not None:
+        proxy = result1.resize((proxyColor.shape[2], proxyColor.shape[1]), Image.BOX)
+        proxyColor[proxyIdx] = np.asarray(proxy)
+        proxyGray[proxyIdx] = np.asarray(proxy.convert('L'))
+
     # add image pair to data list - use relative paths so the data can be moved (base dir is the folder containing the folder sbs_frames/ and sbs_videos/)
     # first get relative path
 
@@ -74,8 +97,31 @@ def process_single_image(args, imgPath):
     file.close()
 
 
+def create_proxy_files(args, imgList):
+    """Create the memory mapped proxy arrays of the chapter and the frame index
+
+    <proxyOut>_color.npy - N x H x W x 3 uint8
+    <proxyOut>_gray.npy  - N x H x W uint8
+    <proxyOut>_index.txt - image name of every row
+    """
+    proxyWidth, proxyHeight = [int(x) for x in args.proxySize.split('x')]
+
+    os.makedirs(os.path.dirname(args.proxyOut), exist_ok=True)
+
+    proxyColor = np.lib.format.open_memmap(args.proxyOut + '_color.npy', mode='w+', dtype=np.uint8,
+                                           shape=(len(imgList), proxyHeight, proxyWidth, 3))
+    proxyGray = np.lib.format.open_memmap(args.proxyOut + '_gray.npy', mode='w+', dtype=np.uint8,
+                                          shape=(len(imgList), proxyHeight, proxyWidth))
+
+    with open(args.proxyOut + '_index.txt', 'w') as fp:
+        for imgPath in imgList:
+            fp.write(imgPath.split('/')[-1] + '\n')
+
+    return proxyColor, proxyGray
+
+
 def main():
-    imgList = glob.glob(args.raw + "*.jpg")
+    imgList = sorted(glob.glob(args.raw + "*.jpg"))
 
     num_cores = args.numCores
 
@@ -93,10 +139,27 @@ def main():
         else:
             print(f"Using {args.numCores} out of {num_cores} cores.")
 
+    proxyColor, proxyGray = None, None
+    if args.proxyOut:
+        proxyColor, proxyGray = create_proxy_files(args, imgList)
+
     inputs = tqdm(imgList)
+    metrics = get_metrics("split", workers=num_cores, total=len(imgList),
+                          chapter=os.path.basename(os.path.normpath(args.raw)))
+
+    returns = Parallel(n_jobs=num_cores, return_as="generator")(
+        delayed(timed_call)(process_single_image, args, image, i, proxyColor, proxyGray)
+        for i, image in enumerate(inputs))
+
+    for imgPath, (_, seconds) in zip(imgList, returns):
+        imName = imgPath.split('/')[-1]
+        metrics.add_result("0", seconds, [imgPath], [args.outLeft + imName, args.outRight + imName])
+
+    if args.proxyOut:
+        proxyColor.flush()
+        proxyGray.flush()
 
-    Parallel(n_jobs=num_cores)(
-        delayed(process_single_image)(args, image) for image in inputs)
+    metrics.close()
 
 
 main()
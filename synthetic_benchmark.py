@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+"""
+    End-to-end benchmark of the pipeline on synthetic stereo movies with known
+    disparity (see helper/synthetic_movie.py).
+
+    The movies are generated into <workDir>/base and the stages of the pipeline
+    are run one after the other on them:
+        convert   - convertToSbs.sh raw with the generator as stand-in decoder (only with --source raw,
+                    the frames are extracted directly from the decoder output, --convertJobs
+                    chapter segments concurrently)
+        extract   - run_extractFrames.sh (only with --source mkv, requires ffmpeg, or raw)
+        crop      - helper/detect_crop.py on the raw frames (--source frames)
+        split     - splitImagesChapters.py of every chapter (--source frames: the raw frames
+                    are written by the generator as a stand-in for the ffmpeg extraction)
+        group     - group_frames_to_scenes.py
+        dataset   - gen_data_set.py
+        create    - helper/createDataSet.py (data set in <workDir>/dataset)
+        sky       - empty sky segmentation (the synthetic movies have no sky)
+        flow      - get_flow_cpu.py (CPU stand-in of the optical flow)
+        disparity - get_disp_and_uncertainty.py (or get_flow_cpu.py --fused / get_disp_stereo.py)
+
+    For every stage the wall time, the CPU time of its processes and the peak
+    disk usage of the work dir are reported. The disparity maps of the data set
+    are compared to the ground truth (in pixels of the saved, half resolution
+    disparity; noc = pixels not occluded in the right view).
+
+    The report is written to <workDir>/benchmark_report.json. With --compare
+    the run is compared to the report of a previous run and the script fails if
+    the disparity error increased by more than --maxErrorIncrease.
+"""
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import socket
+import argparse
+import resource
+import subprocess
+import threading
+import numpy as np
+import cv2
+from PIL import Image
+
+from helper.synthetic_movie import SyntheticMovie, visible_in_right
+from helper.detect_crop import fixed_crop, load_crop
+from helper.layout import load_layout, frame_file, output_file, list_frame_files
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# fixed cropping of the sbs frames (run_extractFrames.sh with the crop mode fixed)
+PADDING_AR = 280
+PADDING_AR_SIDE = 40
+
+MARKER_FILE = ".synthetic_benchmark"
+
+
+class BenchmarkFailed(Exception):
+    pass
+
+
+def disk_usage(path):
+    """Allocated bytes of all files below path (hardlinks are counted once)"""
+    total = 0
+    seen = set()
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.lstat(os.path.join(root, f))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+class DiskSampler(threading.Thread):
+    """Sample the disk usage of a folder while a stage is running"""
+
+    def __init__(self, path, interval=0.5):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = disk_usage(path)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, disk_usage(self.path))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, disk_usage(self.path))
+        return self.peak
+
+
+def cpu_time_children():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_stage(args, name, cmds, report):
+    """Run the commands (argument lists or functions) of a stage and measure it"""
+    print(f"[{name}] running {len(cmds)} command(s)", flush=True)
+    log_file = os.path.join(args.workDir, "logs", name + ".log")
+
+    sampler = DiskSampler(args.workDir)
+    sampler.start()
+    cpu_start = cpu_time_children()
+    start_time = time.time()
+
+    with open(log_file, "w") as log_fp:
+        for cmd in cmds:
+            if callable(cmd):
+                cmd()
+                continue
+            log_fp.write("$ " + " ".join(cmd) + "\n")
+            log_fp.flush()
+            ret = subprocess.call(cmd, cwd=REPO_DIR, stdout=log_fp, stderr=subprocess.STDOUT)
+            if ret != 0:
+                sampler.stop()
+                raise BenchmarkFailed(f"[{name}] failed with return code {ret} (see {log_file})")
+
+    wall = time.time() - start_time
+    cpu = cpu_time_children() - cpu_start
+    peak = sampler.stop()
+
+    result = {"stage": name, "wall_seconds": wall, "cpu_seconds": cpu,
+              "peak_disk_bytes": peak, "disk_bytes": disk_usage(args.workDir)}
+    report["stages"].append(result)
+    print(f"[{name}] done in {wall:.1f}s (cpu {cpu:.1f}s, peak disk {peak / 1e9:.2f} GB)", flush=True)
+
+
+def prepare_work_dir(args):
+    """Create the work dir, the results of a previous benchmark run are removed"""
+    marker = os.path.join(args.workDir, MARKER_FILE)
+    if os.path.isdir(args.workDir) and os.listdir(args.workDir) and not os.path.exists(marker):
+        raise BenchmarkFailed(f"{args.workDir} is not empty and not the work dir of a previous benchmark")
+
+    for d in ["base", "dataset", "logs"]:
+        shutil.rmtree(os.path.join(args.workDir, d), ignore_errors=True)
+
+    os.makedirs(os.path.join(args.workDir, "logs"), exist_ok=True)
+    open(marker, "w").close()
+
+
+def get_movie_names(args):
+    return ["synthetic{}_SBS".format(i) for i in range(args.movies)]
+
+
+def generate_cmds(args, base):
+    return [[sys.executable, os.path.join("helper", "synthetic_movie.py"), "--baseDir", base, "--name", name,
+             "--seed", str(args.seed + i), "--chapters", str(args.chapters),
+             "--chapterSeconds", str(args.chapterSeconds), "--sceneSeconds", str(args.sceneSeconds),
+             "--letterbox", str(args.letterbox), "--source", args.source, "--numCores", str(args.numCores)]
+            for i, name in enumerate(get_movie_names(args))]
+
+
+def convert_cmds(args, base):
+    """convertToSbs.sh in the raw mode with the generator writing the decoded stream (--source raw)
+
+    The chapters are written first (chapters of the mvc video), the generator renders the
+    frames of the segment given by convertToSbs.sh.
+    """
+    cmds = []
+    for cmd, name in zip(generate_cmds(args, base), get_movie_names(args)):
+        source = cmd.index("--source") + 1
+        cmds.append(cmd[:source] + ["chapters"] + cmd[source + 1:])
+        decoder = cmd + ["--frames", "${SEGMENT_START_FRAME}:${SEGMENT_END_FRAME}"]
+        cmds.append(["env", "SBS_DECODER=" + " ".join(decoder), "bash", "convertToSbs.sh", name[:-len("_SBS")],
+                     base, "", "raw", str(args.convertJobs)])
+    return cmds
+
+
+def crop_cmds(base, name):
+    """Detection of the black bars on the raw frames (run_extractFrames.sh uses the video)"""
+    frames = os.path.join(base, "sbs_frames")
+    return [[sys.executable, os.path.join("helper", "detect_crop.py"), "--frames",
+             os.path.join(frames, "image_raw", name), "--out", os.path.join(frames, "image_meta", name, "crop.json")]]
+
+
+def split_cmds(args, base, name):
+    """Commands of the split part of run_extractFrames.sh (the raw frames exist already)"""
+    frames = os.path.join(base, "sbs_frames")
+    meta = os.path.join(frames, "image_meta", name)
+
+    if args.crop == "auto":
+        crop = load_crop(os.path.join(meta, "crop.json"))
+        crop = ["--crop", "{width}:{height}:{x}:{y}".format(**crop)]
+    else:
+        crop = ["--paddingAR", str(PADDING_AR), "--paddingAR_side", str(PADDING_AR_SIDE)]
+
+    cmds = []
+    for raw in sorted(glob.glob(os.path.join(frames, "image_raw", name, "*/"))):
+        chapter = os.path.basename(os.path.normpath(raw))
+        out_left = os.path.join(frames, "image_left", name, chapter) + "/"
+        out_right = os.path.join(frames, "image_right", name, chapter) + "/"
+        os.makedirs(out_left, exist_ok=True)
+        os.makedirs(out_right, exist_ok=True)
+        cmds.append([sys.executable, "splitImagesChapters.py", "--raw", raw, "--outLeft", out_left,
+                     "--outRight", out_right, "--txtList", os.path.join(meta, chapter + ".txt")] + crop +
+                    ["--numCores", str(args.numCores), "--proxyOut", os.path.join(meta, "proxy", chapter)])
+
+    def finish():
+        shutil.copy(os.path.join(base, "sbs_videos", name, "chapters.txt"), os.path.join(meta, "timingChapters.txt"))
+        shutil.rmtree(os.path.join(frames, "image_raw", name))
+
+    return cmds + [finish]
+
+
+def sky_cmds(out):
+    """Stand-in of the sky segmentation (the synthetic movies have no sky)"""
+
+    def write_masks():
+        os.makedirs(os.path.join(out, "sky_segmentation"), exist_ok=True)
+        for f in list_frame_files(os.path.join(out, "image_left"), ".jpg"):
+            width, height = Image.open(f).size
+            mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.imwrite(output_file(os.path.join(out, "sky_segmentation"), os.path.basename(f)[:-4] + ".png",
+                                    load_layout(out)), mask)
+
+    return [write_masks]
+
+
+def disparity_stages(args, out, name):
+    filtering = ["-f"] if args.use_filtering else []
+    cores = ["--numCores", str(args.numCores)]
+
+    if args.disparityEngine == "stereo":
+        return [("disparity", [[sys.executable, "get_disp_stereo.py", out, "--name", name] + cores + filtering])]
+    if args.disparityEngine == "fused":
+        return [("disparity", [[sys.executable, "get_flow_cpu.py", out, "--fused", "--preset", args.preset]
+                               + cores + filtering])]
+    return [("flow", [[sys.executable, "get_flow_cpu.py", out, "--preset", args.preset] + cores]),
+            ("disparity", [[sys.executable, "get_disp_and_uncertainty.py", out] + filtering])]
+
+
+def read_disparity(filename):
+    im = Image.open(filename)
+    disp = np.asarray(im).astype(np.float32)
+    return float(im.text["offset"]) + float(im.text["scale"]) * disp
+
+
+def read_frame_times(log_file):
+    """pts_time of the frames of a chapter (as parsed by group_frames_to_scenes.py)"""
+    times = {}
+    with open(log_file, "r") as fp:
+        for line in fp:
+            idx = line.find("pts_time:")
+            if idx == -1:
+                continue
+            idx2 = line.find("n:")
+            times[int(line[idx2 + 2: idx2 + 2 + 5]) + 1] = float(line[idx + 9:].split()[0])
+    return times
+
+
+def ground_truth(movie, frame, crop):
+    """Ground truth disparity and noc mask of a frame as saved by get_disp_and_uncertainty.py"""
+    _, disp_left, disp_right = movie.render(frame, images=False)
+    visible = visible_in_right(disp_left, disp_right)
+
+    x, y, width, height = crop["x"], crop["y"], crop["width"], crop["height"]
+    disp_left = disp_left[y:y + height, x:x + width]
+    visible = visible[y:y + height, x:x + width].astype(np.float32)
+
+    # downscaling of quantize_disp_and_uncertainty
+    disp = 0.5 * cv2.resize(disp_left, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
+    noc = cv2.resize(visible, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA) > 0.999
+
+    return disp, noc
+
+
+def error_summary(errors):
+    errors = np.concatenate(errors) if errors else np.zeros(0)
+    if errors.size == 0:
+        return {}
+    return {"epe": float(errors.mean()), "rmse": float(np.sqrt(np.mean(errors ** 2))),
+            "bad1": float(np.mean(errors > 1)), "bad3": float(np.mean(errors > 3)), "pixels": int(errors.size)}
+
+
+def evaluate_disparity(args, base, out):
+    """Compare the disparity maps of the data set with the ground truth"""
+    movies, crops, frame_times = {}, {}, {}
+    errors_all, errors_noc = [], []
+
+    with open(os.path.join(out, "meta", "image_mapping_log.txt"), "r") as fp:
+        mapping = [line.split() for line in fp if line.strip()]
+
+    for path, name in mapping:
+        filename = frame_file(os.path.join(out, "disparity"), name + ".png", load_layout(out))
+        if not os.path.exists(filename):
+            continue
+
+        video, chapter, image = path.split("/")[-3:]
+        if video not in movies:
+            movies[video] = SyntheticMovie.load(os.path.join(base, "sbs_videos", video, "synthetic.json"))
+            crop_file = os.path.join(base, "sbs_frames", "image_meta", video, "crop.json")
+            if os.path.exists(crop_file):
+                crops[video] = load_crop(crop_file)
+            else:
+                crops[video] = fixed_crop(2 * movies[video].width, movies[video].height, PADDING_AR, PADDING_AR_SIDE)
+        if (video, chapter) not in frame_times:
+            frame_times[video, chapter] = read_frame_times(
+                os.path.join(base, "sbs_frames", "image_meta", video, chapter.replace("chapter", "log") + ".txt"))
+
+        movie = movies[video]
+        frame = int(round(frame_times[video, chapter][int(image[3:11])] * movie.fps))
+        gt, noc = ground_truth(movie, frame, crops[video])
+
+        disp = read_disparity(filename)
+        assert disp.shape == gt.shape, f"shape of the disparity {disp.shape} is not {gt.shape}"
+        error = np.abs(disp - gt)
+        errors_all.append(error.ravel())
+        errors_noc.append(error[noc])
+
+    return {"frames": len(errors_all), "frames_in_data_set": len(mapping),
+            "all": error_summary(errors_all), "noc": error_summary(errors_noc)}
+
+
+def print_report(report):
+    print("")
+    print(f"{'stage':<12}{'wall [s]':>10}{'cpu [s]':>10}{'peak disk [GB]':>16}")
+    for s in report["stages"]:
+        print(f"{s['stage']:<12}{s['wall_seconds']:>10.1f}{s['cpu_seconds']:>10.1f}{s['peak_disk_bytes'] / 1e9:>16.2f}")
+    t = report["total"]
+    print(f"{'total':<12}{t['wall_seconds']:>10.1f}{t['cpu_seconds']:>10.1f}{t['peak_disk_bytes'] / 1e9:>16.2f}")
+    print("(total without generate)")
+
+    e = report["disparity_error"]
+    print(f"\nDisparity error of {e['frames']} of {e['frames_in_data_set']} frames (half resolution pixels):")
+    for region in ["all", "noc"]:
+        if e[region]:
+            print(f"    {region}: epe {e[region]['epe']:.3f}  rmse {e[region]['rmse']:.3f}  "
+                  f"bad1 {100 * e[region]['bad1']:.2f}%  bad3 {100 * e[region]['bad3']:.2f}%")
+
+
+def compare_reports(report, baseline, max_error_increase):
+    """Print the speedup of every stage, returns False if the disparity got worse"""
+    base_stages = {s["stage"]: s for s in baseline["stages"]}
+
+    print(f"\n{'stage':<12}{'base wall':>11}{'wall':>9}{'speedup':>9}{'base cpu':>10}{'cpu':>9}")
+    for s in report["stages"] + [dict(report["total"], stage="total")]:
+        b = base_stages.get(s["stage"], baseline["total"] if s["stage"] == "total" else None)
+        if b is None:
+            continue
+        print(f"{s['stage']:<12}{b['wall_seconds']:>11.1f}{s['wall_seconds']:>9.1f}"
+              f"{b['wall_seconds'] / max(s['wall_seconds'], 1e-6):>8.2f}x"
+              f"{b['cpu_seconds']:>10.1f}{s['cpu_seconds']:>9.1f}")
+
+    e, b = report["disparity_error"], baseline["disparity_error"]
+    if e["frames"] != b["frames"]:
+        print(f"\nWarning: {e['frames']} frames evaluated, baseline {b['frames']} frames")
+    if not e["noc"] or not b["noc"]:
+        print("\nNo disparity to compare")
+        return not b["noc"]
+
+    increase = e["noc"]["epe"] - b["noc"]["epe"]
+    print(f"\nepe (noc): baseline {b['noc']['epe']:.3f}, now {e['noc']['epe']:.3f} ({increase:+.3f})")
+    if increase > max_error_increase:
+        print(f"Disparity error increased by more than {max_error_increase}")
+        return False
+    return True
+
+
+def run(args):
+    prepare_work_dir(args)
+    base = os.path.join(args.workDir, "base")
+    out = os.path.join(args.workDir, "dataset")
+    names = get_movie_names(args)
+    data_set = "benchmark_sampleFPS_{}".format(args.sampleFPS)
+
+    report = {"config": vars(args), "node": socket.gethostname(),
+              "time": time.strftime("%Y-%m-%d %H:%M:%S"), "stages": []}
+
+    if args.source == "raw":
+        run_stage(args, "convert", convert_cmds(args, base), report)
+    else:
+        run_stage(args, "generate", generate_cmds(args, base), report)
+
+    if args.source in ["mkv", "raw"]:
+        run_stage(args, "extract", [["bash", "run_extractFrames.sh", name, base, args.crop, args.source]
+                                    for name in names], report)
+    else:
+        if args.crop == "auto":
+            run_stage(args, "crop", [cmd for name in names for cmd in crop_cmds(base, name)], report)
+        run_stage(args, "split", [cmd for name in names for cmd in split_cmds(args, base, name)], report)
+
+    run_stage(args, "group", [[sys.executable, "group_frames_to_scenes.py", "--baseDir", base,
+                               "--whitelist", ",".join(names), "--jobs", str(args.movies)]], report)
+    run_stage(args, "dataset", [[sys.executable, "gen_data_set.py", "--baseDir", base, "--name", "benchmark",
+                                 "--sampleFPS", str(args.sampleFPS), "--rebuild", "--jobs", str(args.movies)]], report)
+    run_stage(args, "create", [[sys.executable, os.path.join("helper", "createDataSet.py"), "--baseDir", base,
+                                "--name", data_set, "--outDir", out, "--layout", args.layout]], report)
+    run_stage(args, "sky", sky_cmds(out), report)
+    for name, cmds in disparity_stages(args, out, data_set):
+        run_stage(args, name, cmds, report)
+
+    stages = [s for s in report["stages"] if s["stage"] != "generate"]
+    report["total"] = {"wall_seconds": sum(s["wall_seconds"] for s in stages),
+                       "cpu_seconds": sum(s["cpu_seconds"] for s in stages),
+                       "peak_disk_bytes": max(s["peak_disk_bytes"] for s in stages)}
+    report["disparity_error"] = evaluate_disparity(args, base, out)
+
+    print_report(report)
+    report_file = args.report or os.path.join(args.workDir, "benchmark_report.json")
+    with open(report_file, "w") as fp:
+        json.dump(report, fp, indent=True)
+    print(f"\nWrote report to {report_file}")
+
+    if args.compare:
+        with open(args.compare, "r") as fp:
+            if not compare_reports(report, json.load(fp), args.maxErrorIncrease):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="run the pipeline on synthetic stereo movies and report the run time of every stage and \
+                     the error of the disparity")
+    parser.add_argument("--workDir", type=str, required=True,
+                        help="folder of the benchmark (the results of a previous run in it are removed)")
+    parser.add_argument("--movies", type=int, default=1, help="number of synthetic movies")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first movie")
+    parser.add_argument("--chapters", type=int, default=5, help="number of chapters per movie")
+    parser.add_argument("--chapterSeconds", type=float, default=6.0, help="mean length of a chapter")
+    parser.add_argument("--sceneSeconds", type=float, default=3.0, help="mean length of a scene")
+    parser.add_argument("--letterbox", type=int, default=140, help="height of the black bars at the top and bottom")
+    parser.add_argument("--source", type=str, default="frames", choices=["frames", "mkv", "raw"],
+                        help="start from an sbs video (mkv, runs run_extractFrames.sh - requires ffmpeg), from \
+                              the extracted raw frames (frames) or from the decoder output (raw, convertToSbs.sh raw)")
+    parser.add_argument("--convertJobs", type=int, default=1,
+                        help="number of chapter segments converted concurrently (--source raw)")
+    parser.add_argument("--crop", type=str, default="auto", choices=["auto", "fixed"],
+                        help="detect the black bars (auto) or crop to 1880x800 (fixed)")
+    parser.add_argument("--layout", type=str, default="flat", choices=["flat", "sharded"],
+                        help="directory layout of the data set (see helper/layout.py)")
+    parser.add_argument("--sampleFPS", type=int, default=4, help="fps of the data set (see gen_data_set.py)")
+    parser.add_argument("--disparityEngine", type=str, default="flow", choices=["flow", "fused", "stereo"],
+                        help="flow and disparity stage (flow), get_flow_cpu.py --fused (fused) or get_disp_stereo.py \
+                              (stereo)")
+    parser.add_argument("--preset", type=str, default="medium", help="preset of the CPU flow")
+    parser.add_argument("-f", "--use_filtering", action="store_true",
+                        help="apply filtering when computing the disparity")
+    parser.add_argument("--numCores", type=int, default=8, help="number of cores of the stages")
+    parser.add_argument("--report", type=str, default="",
+                        help="file of the report (default: <workDir>/benchmark_report.json)")
+    parser.add_argument("--compare", type=str, default="", help="report of a previous run to compare to")
+    parser.add_argument("--maxErrorIncrease", type=float, default=0.05,
+                        help="maximum increase of the epe (noc) compared to --compare")
+
+    args = parser.parse_args()
+
+    try:
+        sys.exit(run(args))
+    except BenchmarkFailed as e:
+        print(e)
+        sys.exit(1)
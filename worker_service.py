@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+    Local worker service that keeps the Python interpreter, the heavy modules
+    (numpy, cv2, PIL, imageio, pandas, joblib) and the joblib worker pool warm.
+
+    Every invocation of a script (e.g. splitImagesChapters.py once per chapter)
+    normally starts a new interpreter, imports all modules and starts a new pool
+    of workers. The service is started once:
+
+        python worker_service.py serve --socket /tmp/sbs_worker.sock
+
+    and the scripts are run through the thin client (only the standard library
+    is imported by the client):
+
+        python worker_service.py run --socket /tmp/sbs_worker.sock splitImagesChapters.py --raw ...
+
+    The jobs are executed one after the other inside the service process (the
+    scripts set global state like sys.argv), so the reusable joblib worker pool
+    is shared by all jobs. The output of the script is sent back to the client,
+    which exits with the return code of the script. If the service is not
+    running the client runs the script directly.
+
+    The service only listens on a Unix socket (no network access). Restart it
+    after changing the code of the repository, imported modules are cached.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import traceback
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# folders of the scripts run in the service (the scripts in helper/ import their sibling modules)
+SCRIPT_DIRS = [REPO_DIR, os.path.join(REPO_DIR, "helper")]
+DEFAULT_SOCKET = "/tmp/sbs_worker.sock"
+
+WARM_MODULES = ["numpy", "cv2", "PIL.Image", "PIL.PngImagePlugin", "imageio", "pandas", "tqdm", "joblib"]
+
+
+def import_modules(modules):
+    import importlib
+
+    for m in modules:
+        try:
+            importlib.import_module(m)
+        except ImportError:
+            pass
+
+
+def warm_up(num_workers):
+    """Import the heavy modules in the service and in the joblib workers"""
+    start_time = time.time()
+    import_modules(WARM_MODULES)
+
+    # the workers unpickle the functions of the jobs, so they need to import the modules of all script
+    # folders (set before the pool is started, the workers get the sys.path of the service)
+    sys.path += [d for d in SCRIPT_DIRS if d not in sys.path]
+
+    if num_workers > 0:
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=num_workers)(delayed(import_modules)(WARM_MODULES) for _ in range(num_workers))
+
+    return time.time() - start_time
+
+
+class SocketWriter:
+    """File like object sending everything written as json lines to the client"""
+
+    def __init__(self, conn, stream):
+        self.conn = conn
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        if text:
+            send(self.conn, {self.stream: text}, self.lock)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def send(conn, message, lock=None):
+    data = (json.dumps(message) + "\n").encode()
+    try:
+        if lock is None:
+            conn.sendall(data)
+        else:
+            with lock:
+                conn.sendall(data)
+    except OSError:
+        # client is gone - keep running the job
+        pass
+
+
+def run_script(script, argv, cwd):
+    """Run a script as __main__ with the given arguments, returns the return code"""
+    import runpy
+
+    old_argv, old_path, old_cwd = sys.argv, list(sys.path), os.getcwd()
+    sys.argv = [script] + argv
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+
+    # the data set layout may have been migrated since the last job
+    for name in ["helper.layout", "layout"]:
+        if name in sys.modules:
+            sys.modules[name].clear_cache()
+
+    try:
+        os.chdir(cwd)
+        runpy.run_path(script, run_name="__main__")
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.argv, sys.path[:] = old_argv, old_path
+        os.chdir(old_cwd)
+
+
+def handle_connection(conn, job_lock, warm_up_time):
+    with conn, conn.makefile("r") as fp:
+        request = json.loads(fp.readline())
+
+        queued_time = time.time()
+        with job_lock:
+            wait_time = time.time() - queued_time
+            print(f"[worker_service] running {request['script']} {' '.join(request['argv'])}", flush=True)
+
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = SocketWriter(conn, "stdout")
+            sys.stderr = SocketWriter(conn, "stderr")
+            start_time = time.time()
+            try:
+                returncode = run_script(request["script"], request["argv"], request["cwd"])
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+            duration = time.time() - start_time
+
+        print(f"[worker_service] finished with return code {returncode} in {duration:.2f}s", flush=True)
+        send(conn, {"returncode": returncode, "seconds": duration, "wait": wait_time, "warm_up": warm_up_time})
+
+
+def serve(args):
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    warm_up_time = warm_up(args.numWorkers)
+    print(f"[worker_service] imported modules and started {args.numWorkers} workers in {warm_up_time:.2f}s", flush=True)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    os.chmod(args.socket, 0o600)
+    server.listen()
+    print(f"[worker_service] listening on {args.socket}", flush=True)
+
+    job_lock = threading.Lock()
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle_connection, args=(conn, job_lock, warm_up_time), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(args.socket)
+
+
+def resolve_script(script):
+    if os.path.exists(script):
+        return os.path.abspath(script)
+    return os.path.join(REPO_DIR, script)
+
+
+def run_client(args, client_start):
+    script = resolve_script(args.script)
+
+    # the workers of the service can only import the modules of the repository
+    if os.path.dirname(script) not in SCRIPT_DIRS:
+        print(f"[worker_service] {args.script} is not part of the repository, running it directly", file=sys.stderr)
+        os.execv(sys.executable, [sys.executable, script] + args.argv)
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(args.socket)
+    except OSError:
+        # no service running - run the script directly
+        conn.close()
+        print(f"[worker_service] no service on {args.socket}, running {args.script} directly", file=sys.stderr)
+        os.execv(sys.executable, [sys.executable, script] + args.argv)
+
+    startup_time = time.time() - client_start
+    send(conn, {"script": script, "argv": args.argv, "cwd": os.getcwd()})
+
+    result = {"returncode": 1}
+    with conn, conn.makefile("r") as fp:
+        for line in fp:
+            message = json.loads(line)
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+                sys.stdout.flush()
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+                sys.stderr.flush()
+            else:
+                result = message
+
+    if "seconds" in result:
+        print(f"[worker_service] client startup {startup_time:.3f}s, queued {result['wait']:.2f}s, "
+              f"job {result['seconds']:.2f}s (warm up of {result['warm_up']:.2f}s saved)", file=sys.stderr)
+
+    return result["returncode"]
+
+
+if __name__ == "__main__":
+    client_start = time.time()
+
+    parser = argparse.ArgumentParser(description="local worker service keeping the modules and workers warm")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    parser_serve = subparsers.add_parser("serve", help="start the service")
+    parser_serve.add_argument("--socket", type=str, default=DEFAULT_SOCKET, help="path of the unix socket")
+    parser_serve.add_argument("--numWorkers", type=int, default=8,
+                              help="number of joblib workers started (and warmed up) in advance")
+
+    parser_run = subparsers.add_parser("run", help="run a script in the service")
+    parser_run.add_argument("--socket", type=str, default=DEFAULT_SOCKET, help="path of the unix socket")
+    parser_run.add_argument("script", type=str, help="script to run (path or relative to the repository)")
+    parser_run.add_argument("argv", nargs=argparse.REMAINDER, help="arguments of the script")
+
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        serve(args)
+    else:
+        sys.exit(run_client(args, client_start))